@@ -1,53 +1,125 @@
-from utils import get_db_connection
+from resources import db_connection
 from logger_config import setup_logger
 import nltk
 
 logger = setup_logger("database")
 
 
-conn = get_db_connection()
-
-cursor = conn.cursor()
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS novels (
-    id SERIAL PRIMARY KEY,
-    novel_title TEXT NOT NULL UNIQUE,
-    novel_image TEXT
-);
-"""
-)
-
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS chapters (
-    id SERIAL PRIMARY KEY,
-    novel_id INTEGER REFERENCES novels(id) ON DELETE CASCADE,
-    chapter_number INT NOT NULL,
-    chapter_title TEXT,
-    chapter_url TEXT,
-    chapter_content TEXT
-);
-"""
-)
-
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS chunks (
-    id SERIAL PRIMARY KEY,
-    chapter_id INTEGER REFERENCES chapters(id) ON DELETE CASCADE,
-    novel_id INTEGER REFERENCES novels(id) ON DELETE CASCADE,
-    chunk_number INT NOT NULL,
-    chunk_content TEXT,
-    preprocessed_chunk_content TEXT[]
-);
-"""
-)
-
-conn.commit()
-
-cursor.close()
-conn.close()
+with db_connection() as conn:
+    cursor = conn.cursor()
+
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS novels (
+        id SERIAL PRIMARY KEY,
+        novel_title TEXT NOT NULL UNIQUE,
+        novel_image TEXT
+    );
+    """
+    )
+
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS chapters (
+        id SERIAL PRIMARY KEY,
+        novel_id INTEGER REFERENCES novels(id) ON DELETE CASCADE,
+        chapter_number INT NOT NULL,
+        chapter_title TEXT,
+        chapter_url TEXT,
+        chapter_content TEXT
+    );
+    """
+    )
+
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS chunks (
+        id SERIAL PRIMARY KEY,
+        chapter_id INTEGER REFERENCES chapters(id) ON DELETE CASCADE,
+        novel_id INTEGER REFERENCES novels(id) ON DELETE CASCADE,
+        chunk_number INT NOT NULL,
+        chunk_content TEXT,
+        preprocessed_chunk_content TEXT[]
+    );
+    """
+    )
+
+    # Chunks are character spans of their chapter's content; chunk_content is
+    # only set on chunks from before offsets (see chunker.migrate_chunks_to_offsets)
+    cursor.execute(
+        """
+    ALTER TABLE chunks
+        ADD COLUMN IF NOT EXISTS start_char INT,
+        ADD COLUMN IF NOT EXISTS end_char INT;
+    """
+    )
+
+    # sha256 of the cleaned chapter text, see utils.content_hash
+    cursor.execute(
+        "ALTER TABLE chapters ADD COLUMN IF NOT EXISTS content_hash TEXT;"
+    )
+
+    # Validators of fetched pages; body is only kept for chapter list pages,
+    # chapter text already lives in chapters
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS http_cache (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        content_hash TEXT,
+        body TEXT,
+        fetched_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """
+    )
+
+    # What each chapter was last chunked from (see chunker.processing_version),
+    # and the model each chunk was embedded with
+    cursor.execute(
+        """
+    ALTER TABLE chapters
+        ADD COLUMN IF NOT EXISTS chunked_hash TEXT,
+        ADD COLUMN IF NOT EXISTS chunk_version TEXT;
+    ALTER TABLE chunks ADD COLUMN IF NOT EXISTS embedding_model TEXT;
+    CREATE INDEX IF NOT EXISTS chunks_chapter_id_idx ON chunks (chapter_id);
+    """
+    )
+
+    # Preprocess mode (utils.PREPROCESS_MODE) of preprocessed_chunk_content;
+    # NULL on tokens stored before it was recorded, which are never reused
+    cursor.execute(
+        "ALTER TABLE chunks ADD COLUMN IF NOT EXISTS preprocess_mode TEXT;"
+    )
+
+    # Chunks deleted by re-chunking whose vectors are still in Chroma
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS stale_chunks (
+        chunk_id INTEGER PRIMARY KEY,
+        novel_id INTEGER REFERENCES novels(id) ON DELETE CASCADE
+    );
+    """
+    )
+
+    # Per-chapter scrape checkpoint: pending, done or failed
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS chapter_fetch_state (
+        chapter_url TEXT PRIMARY KEY,
+        novel_id INTEGER REFERENCES novels(id) ON DELETE CASCADE,
+        chapter_title TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INT NOT NULL DEFAULT 0,
+        last_error TEXT,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """
+    )
+
+    conn.commit()
+
+    cursor.close()
 
 logger.info("Database setup completed.")
 
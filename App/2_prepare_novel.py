@@ -1,7 +1,12 @@
 from scraper import refresh_database
 from logger_config import setup_logger
 from chunker import chunking_novel
-from indexer import indexing_novel_chunks_chroma, indexing_novel_chunks_bm25
+from indexer import (
+    indexing_novel_chunks_chroma,
+    indexing_novel_chunks_bm25,
+    indexing_novel_chunks_vectors,
+)
+from vector_index import VECTOR_BACKEND
 import asyncio
 
 logger = setup_logger("get_novel")
@@ -24,6 +29,8 @@ async def main():
     logger.info("Calling indexer to index the chunks...")
     indexing_novel_chunks_chroma(novel_name)
     indexing_novel_chunks_bm25(novel_name)
+    if VECTOR_BACKEND == "local":
+        indexing_novel_chunks_vectors(novel_name)
     logger.info("Indexer completed successfully.")
 
     logger.info("Novel preparation completed.")
@@ -1,26 +1,40 @@
-from generator import generate_response
+from time import perf_counter
+
+startup_start = perf_counter()
+
+from generator import generate_response_stream
 import gradio as gr
-from sentence_transformers import SentenceTransformer
+import metrics
+from retriever import load_query_model, warm_up
 from logger_config import setup_logger
 
 logger = setup_logger("app")
 logger.info("Initializing SentenceTransformer model")
-model = SentenceTransformer("mixedbread-ai/mxbai-embed-large-v1", device="cuda")
+# QUERY_DEVICE / QUERY_BACKEND pick cuda or cpu and torch or a quantized ONNX export
+model = load_query_model()
 logger.info("Model initialized successfully")
+warm_up(model)
+metrics.observe("app.startup_seconds", perf_counter() - startup_start)
+metrics.log_snapshot("app.")
+metrics.log_snapshot("query_model.")
 
 def respond(message, history, novel_name, spoiler_threshold):
     """
-    Function that gets the complete response directly
+    Function that streams the response, yielding the text received so far
     """
     logger.info("Received input - Novel: %s, Spoiler Threshold: %s, Query: %s",
                 novel_name, spoiler_threshold, message)
+    response = ""
     try:
-        response = generate_response(message, novel_name, model, spoiler_threshold)
+        for piece in generate_response_stream(message, novel_name, model, spoiler_threshold):
+            response += piece
+            yield response
+        response = response.strip()
         logger.info("Generated response: %s", response[:100] + "..." if len(response) > 100 else response)
-        return response
+        yield response
     except Exception as e:
         logger.error("Error generating response: %s", str(e))
-        return f"Sorry, I encountered an error: {str(e)}"
+        yield f"Sorry, I encountered an error: {str(e)}"
 
 # Create the Gradio interface with ChatInterface for better UX
 with gr.Blocks(title="Novel Assistant Chatbot", theme=gr.themes.Soft()) as demo:
@@ -67,17 +81,21 @@ with gr.Blocks(title="Novel Assistant Chatbot", theme=gr.themes.Soft()) as demo:
         return "", history + [[message, None]]
 
     def bot_response(history, novel_name, spoiler_threshold):
-        """Generate bot response"""
+        """Stream the bot response into the last chat bubble"""
         if not history or not history[-1][0]:  # Check if history exists and has user message
             logger.warning("No history or empty user message")
-            return history
+            yield history
+            return
            
         user_message = history[-1][0]
         logger.info("Processing user message: %s", user_message)
        
         try:
-            # Get the complete response
-            response = respond(user_message, history, novel_name, spoiler_threshold)
+            response = ""
+            # Push every partial response to the chatbot as it arrives
+            for response in respond(user_message, history, novel_name, spoiler_threshold):
+                history[-1][1] = response
+                yield history
             
             # Ensure response is not None or empty
             if not response:
@@ -92,7 +110,7 @@ with gr.Blocks(title="Novel Assistant Chatbot", theme=gr.themes.Soft()) as demo:
             logger.error("Error in bot_response: %s", str(e))
             history[-1][1] = f"Sorry, I encountered an error: {str(e)}"
         
-        return history
+        yield history
 
     # Event handlers
     msg.submit(
@@ -104,7 +122,7 @@ with gr.Blocks(title="Novel Assistant Chatbot", theme=gr.themes.Soft()) as demo:
         bot_response,
         [chatbot, novel_name, spoiler_threshold],
         [chatbot],  # Only return chatbot, not multiple outputs
-        queue=False
+        queue=True  # streaming generators need the queue
     )
    
     submit.click(
@@ -116,7 +134,7 @@ with gr.Blocks(title="Novel Assistant Chatbot", theme=gr.themes.Soft()) as demo:
         bot_response,
         [chatbot, novel_name, spoiler_threshold],
         [chatbot],  # Only return chatbot, not multiple outputs
-        queue=False
+        queue=True  # streaming generators need the queue
     )
    
     clear.click(lambda: ([], ""), outputs=[chatbot, msg])
@@ -0,0 +1,129 @@
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+import numpy as np
+import metrics
+from logger_config import setup_logger
+
+logger = setup_logger("answer_cache")
+
+# Cosine similarity above which two questions count as the same question
+SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600)))
+MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_SIZE", "5000"))
+# Readers within the same BUCKET_SIZE chapters share cached answers
+BUCKET_SIZE = int(os.getenv("ANSWER_CACHE_BUCKET", "50"))
+
+
+def threshold_bucket(spoiler_threshold):
+    if not spoiler_threshold:
+        return "all"
+    return int(spoiler_threshold) // BUCKET_SIZE
+
+
+class SemanticAnswerCache:
+    """
+    Cache of generated answers keyed by (novel, spoiler threshold bucket,
+    normalized query embedding).
+
+    Every entry remembers the highest chapter its context came from, and a
+    lookup only returns entries whose chapters are all within the asker's
+    spoiler threshold, even though the bucket spans several chapters.
+    """
+
+    def __init__(
+        self,
+        similarity_threshold=SIMILARITY_THRESHOLD,
+        ttl=TTL_SECONDS,
+        max_entries=MAX_ENTRIES,
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # (novel, bucket) -> {entry id: entry}, plus one LRU order over all entries
+        self._buckets = {}
+        self._lru = OrderedDict()
+        self._next_id = 0
+
+    def lookup(self, novel_name, spoiler_threshold, query_vector):
+        """
+        Return the cached answer of the most similar allowed question, or None.
+        """
+        key = (novel_name, threshold_bucket(spoiler_threshold))
+        best_id, best_similarity = None, self.similarity_threshold
+        with self._lock:
+            bucket = self._buckets.get(key, {})
+            self._expire(bucket, monotonic())
+            for entry_id, entry in bucket.items():
+                if spoiler_threshold and entry["max_chapter"] > spoiler_threshold:
+                    continue
+                similarity = float(np.dot(entry["vector"], query_vector))
+                if similarity >= best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+            if best_id is not None:
+                self._lru.move_to_end(best_id)
+                answer = bucket[best_id]["answer"]
+
+        if best_id is None:
+            metrics.increment("answer_cache.misses")
+            self._log_hit_rate()
+            return None
+
+        metrics.increment("answer_cache.hits")
+        metrics.observe("answer_cache.hit_similarity", best_similarity)
+        logger.info(
+            "Answer cache hit for %s (similarity %.3f)", novel_name, best_similarity
+        )
+        self._log_hit_rate()
+        return answer
+
+    def store(self, novel_name, spoiler_threshold, query_vector, answer, max_chapter):
+        """
+        Cache an answer generated from chunks whose highest chapter is max_chapter.
+        """
+        key = (novel_name, threshold_bucket(spoiler_threshold))
+        entry = {
+            "vector": np.asarray(query_vector, dtype=np.float32),
+            "answer": answer,
+            "max_chapter": max_chapter,
+            "created": monotonic(),
+        }
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._buckets.setdefault(key, {})[entry_id] = entry
+            self._lru[entry_id] = key
+            while len(self._lru) > self.max_entries:
+                old_id, old_key = self._lru.popitem(last=False)
+                del self._buckets[old_key][old_id]
+                metrics.increment("answer_cache.evictions")
+            size = len(self._lru)
+        metrics.increment("answer_cache.stores")
+        metrics.observe("answer_cache.size", size)
+
+    def _expire(self, bucket, now):
+        expired = [
+            entry_id
+            for entry_id, entry in bucket.items()
+            if now - entry["created"] > self.ttl
+        ]
+        for entry_id in expired:
+            del bucket[entry_id]
+            del self._lru[entry_id]
+        if expired:
+            metrics.increment("answer_cache.expired", len(expired))
+
+    def _log_hit_rate(self):
+        hit_rate = metrics.ratio(
+            "answer_cache.hits", ["answer_cache.hits", "answer_cache.misses"]
+        )
+        logger.info(
+            "Answer cache hit rate: %.1f%% (%s entries)",
+            100 * hit_rate,
+            len(self._lru),
+        )
+
+
+answer_cache = SemanticAnswerCache()
@@ -0,0 +1,784 @@
+import argparse
+import shutil
+import tempfile
+from time import perf_counter
+import numpy as np
+from logger_config import setup_logger
+
+logger = setup_logger("benchmark")
+
+
+# ----------------------------------------
+# BM25
+# ----------------------------------------
+
+
+def synthetic_postings(
+    num_docs, num_chapters=3_000, vocab_size=50_000, mean_length=120, seed=0
+):
+    """
+    Generate a Zipf-distributed corpus directly as (term, doc, tf) postings.
+    """
+    rng = np.random.default_rng(seed)
+    doc_lens = rng.poisson(mean_length, num_docs).astype(np.int32)
+    token_docs = np.repeat(np.arange(num_docs, dtype=np.int64), doc_lens)
+    token_terms = (rng.zipf(1.2, len(token_docs)) - 1) % vocab_size
+    keys, tfs = np.unique(token_docs * vocab_size + token_terms, return_counts=True)
+    docs, terms = np.divmod(keys, vocab_size)
+    # spread the chunks over the chapters of a long novel
+    doc_chapters = (np.arange(num_docs) * num_chapters // num_docs + 1).astype(np.int32)
+    return terms, docs, tfs.astype(np.uint16), doc_chapters, doc_lens
+
+
+def synthetic_queries(num_queries, vocab_size=50_000, seed=1):
+    rng = np.random.default_rng(seed)
+    return [
+        [f"t{t}" for t in (rng.zipf(1.2, rng.integers(2, 8)) - 1) % vocab_size]
+        for _ in range(num_queries)
+    ]
+
+
+def benchmark_bm25(sizes, num_queries=20, rank_bm25_max=100_000):
+    """
+    Compare the rank_bm25 path of the original retrieve_context_bm25 (build
+    BM25Okapi, get_scores, full argsort) with the sparse BM25 index.
+    """
+    from bm25_index import BM25Index, write_index
+
+    queries = synthetic_queries(num_queries)
+    rows = []
+    for num_docs in sizes:
+        logger.info("Generating %s synthetic chunks...", num_docs)
+        terms, docs, tfs, doc_chapters, doc_lens = synthetic_postings(num_docs)
+        vocab = [f"t{t}" for t in range(int(terms.max()) + 1)]
+
+        path = tempfile.mkdtemp(prefix="bm25_bench_")
+        try:
+            start = perf_counter()
+            write_index(
+                path,
+                vocab,
+                terms,
+                docs,
+                tfs,
+                np.arange(num_docs, dtype=np.int64),
+                doc_chapters,
+                doc_lens,
+            )
+            build_time = perf_counter() - start
+            index = BM25Index.load(path)
+
+            start = perf_counter()
+            for query in queries:
+                index.top_k(query, k=10)
+            single_time = (perf_counter() - start) / num_queries
+
+            start = perf_counter()
+            index.top_k_batch(queries, k=10)
+            batch_time = (perf_counter() - start) / num_queries
+
+            threshold = int(doc_chapters[-1]) // 2
+            start = perf_counter()
+            for query in queries:
+                index.top_k(query, k=10, spoiler_threshold=threshold)
+            spoiler_time = (perf_counter() - start) / num_queries
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+        rank_build_time = rank_query_time = None
+        if num_docs <= rank_bm25_max:
+            from rank_bm25 import BM25Okapi
+
+            order = np.argsort(docs, kind="stable")
+            bounds = np.searchsorted(docs[order], np.arange(num_docs + 1))
+            term_strings = np.array(vocab, dtype=object)
+            tokenized_docs = []
+            for d in range(num_docs):
+                sel = order[bounds[d] : bounds[d + 1]]
+                tokenized_docs.append(
+                    list(np.repeat(term_strings[terms[sel]], tfs[sel]))
+                )
+
+            start = perf_counter()
+            bm25 = BM25Okapi(tokenized_docs)
+            rank_build_time = perf_counter() - start
+
+            start = perf_counter()
+            for query in queries:
+                scores = bm25.get_scores(query)
+                np.argsort(scores)[::-1][:10]
+            rank_query_time = (perf_counter() - start) / num_queries
+        rows.append(
+            (
+                num_docs,
+                rank_build_time,
+                rank_query_time,
+                build_time,
+                single_time,
+                batch_time,
+                spoiler_time,
+            )
+        )
+
+    def fmt(value):
+        return "skipped" if value is None else f"{value * 1000:.1f}ms"
+
+    print(
+        f"{'chunks':>9} | {'rank_bm25 build':>15} | {'rank_bm25 query':>15} | "
+        f"{'index build':>11} | {'query':>9} | {'batched':>9} | {'spoiler':>9}"
+    )
+    for num_docs, rb, rq, ib, q, bq, sq in rows:
+        print(
+            f"{num_docs:>9} | {fmt(rb):>15} | {fmt(rq):>15} | "
+            f"{fmt(ib):>11} | {fmt(q):>9} | {fmt(bq):>9} | {fmt(sq):>9}"
+        )
+    return rows
+
+
+# ----------------------------------------
+# CHUNKING
+# ----------------------------------------
+
+
+def synthetic_chapter(num_paragraphs=2_000, huge_every=100, seed=0):
+    """
+    A long chapter of short dialogue-like paragraphs, with an oversized
+    paragraph of many sentences every huge_every paragraphs.
+    """
+    rng = np.random.default_rng(seed)
+    words = [f"word{i}" for i in range(5_000)]
+
+    def sentence():
+        return " ".join(rng.choice(words, rng.integers(5, 25))).capitalize() + "."
+
+    paragraphs = []
+    for i in range(num_paragraphs):
+        num_sentences = 60 if huge_every and i % huge_every == huge_every - 1 else 3
+        paragraphs.append(" ".join(sentence() for _ in range(num_sentences)))
+    return "\n".join(paragraphs)
+
+
+def legacy_segment_text(text, max_chunk_size, overlap, tokenizer):
+    """
+    segment_text before batched counting: one encode per paragraph, and the
+    whole text re-split into sentences as soon as one paragraph is too big.
+    """
+    from nltk.tokenize import sent_tokenize
+
+    paragraphs = [p.strip() for p in text.split("\n") if p.strip()]
+    paragraphs = [
+        (p, len(tokenizer.encode(p, add_special_tokens=False))) for p in paragraphs
+    ]
+    if any(size + overlap > max_chunk_size for _, size in paragraphs):
+        sentences = sent_tokenize(text)
+        paragraphs = [
+            (s, len(tokenizer.encode(s, add_special_tokens=False))) for s in sentences
+        ]
+        if any(size > max_chunk_size for _, size in paragraphs):
+            pars = []
+            for s, size in paragraphs:
+                if size <= max_chunk_size:
+                    pars.append((s, size))
+                else:
+                    pars += [
+                        (
+                            line.strip(),
+                            len(tokenizer.encode(line.strip(), add_special_tokens=False)),
+                        )
+                        for line in s.split("\n")
+                        if line.strip()
+                    ]
+            paragraphs = pars
+    return paragraphs
+
+
+def benchmark_chunk_spans(repeats=3, max_chunk_size=512, overlap=200):
+    """
+    Time chunk_spans on pathological paragraph sizes. Its equivalence with
+    the legacy chunking loop is checked in tests/test_chunker.py.
+    """
+    from chunker import chunk_spans
+
+    cases = {
+        "100k tiny paragraphs": [1] * 100_000,
+        "20k mixed paragraphs": np.random.default_rng(0)
+        .integers(1, max_chunk_size, 20_000)
+        .tolist(),
+        "one huge paragraph": [10] * 1_000 + [10 * max_chunk_size] + [10] * 1_000,
+    }
+    print(f"{'case':>22} | {'spans':>10} | {'chunks':>8}")
+    rows = []
+    for name, sizes in cases.items():
+        span_time = best_time(
+            lambda: chunk_spans(sizes, max_chunk_size, overlap), repeats
+        )
+        span_count = len(chunk_spans(sizes, max_chunk_size, overlap))
+        rows.append((name, span_time, span_count))
+        print(f"{name:>22} | {span_time * 1000:>8.1f}ms | {span_count:>8}")
+    return rows
+
+
+def best_time(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def benchmark_chunk(
+    num_paragraphs=2_000,
+    repeats=3,
+    max_chunk_size=512,
+    overlap=200,
+    embedding_model="mixedbread-ai/mxbai-embed-large-v1",
+):
+    """
+    Time segmentation and chunking of one large synthetic chapter with the
+    embedding model's tokenizer.
+    """
+    from chunker import chunk_text, load_tokenizer, segment_text
+
+    tokenizer = load_tokenizer(embedding_model)
+    text = synthetic_chapter(num_paragraphs)
+    logger.info(
+        "Synthetic chapter: %s paragraphs, %s characters", num_paragraphs, len(text)
+    )
+
+    rows = [
+        (
+            "legacy segment_text",
+            best_time(
+                lambda: legacy_segment_text(text, max_chunk_size, overlap, tokenizer),
+                repeats,
+            ),
+        ),
+        (
+            "segment_text",
+            best_time(
+                lambda: segment_text(text, max_chunk_size, overlap, tokenizer),
+                repeats,
+            ),
+        ),
+        (
+            "chunk_text",
+            best_time(
+                lambda: chunk_text(text, max_chunk_size, overlap, tokenizer),
+                repeats,
+            ),
+        ),
+    ]
+
+    print(f"{'step':>20} | {'time':>10}")
+    for name, seconds in rows:
+        print(f"{name:>20} | {seconds * 1000:>8.1f}ms")
+    return rows
+
+
+def chunk_storage_stats(novel_title, samples=200, batch=10, seed=0):
+    """
+    Size of the chunks table and latency of fetch_chunks on random batches
+    of a novel's chunk ids, as retrieval fetches them.
+    """
+    from resources import db_connection
+    from retriever import fetch_chunks
+    from utils import get_novel_id
+
+    with db_connection() as conn, conn.cursor() as cursor:
+        novel_id = get_novel_id(novel_title, cursor)
+        cursor.execute(
+            """
+            SELECT pg_total_relation_size('chunks'),
+                   COALESCE(SUM(pg_column_size(chunk_content)), 0),
+                   COUNT(*) FILTER (WHERE chunk_content IS NULL),
+                   COUNT(*)
+            FROM chunks
+            """
+        )
+        table_size, text_size, offset_chunks, total_chunks = cursor.fetchone()
+        cursor.execute("SELECT id FROM chunks WHERE novel_id = %s", (novel_id,))
+        chunk_ids = np.array([row[0] for row in cursor.fetchall()])
+
+    rng = np.random.default_rng(seed)
+    fetch_chunks(rng.choice(chunk_ids, batch).tolist())
+    times = []
+    for _ in range(samples):
+        ids = rng.choice(chunk_ids, batch).tolist()
+        start = perf_counter()
+        fetch_chunks(ids)
+        times.append(perf_counter() - start)
+    return {
+        "table size (MB)": table_size / 2**20,
+        "chunk_content (MB)": text_size / 2**20,
+        "offset chunks": f"{offset_chunks}/{total_chunks}",
+        "fetch p50 (ms)": float(np.percentile(times, 50)) * 1000,
+        "fetch p95 (ms)": float(np.percentile(times, 95)) * 1000,
+    }
+
+
+def benchmark_chunk_storage(novel_title, migrate=False, samples=200):
+    """
+    Chunk storage size and fetch latency, before and after migrating the
+    novel's text chunks to offsets when migrate is set.
+    """
+    from chunker import migrate_chunks_to_offsets
+
+    results = [("before", chunk_storage_stats(novel_title, samples))]
+    if migrate:
+        migrate_chunks_to_offsets(novel_title, vacuum=True)
+        results.append(("after", chunk_storage_stats(novel_title, samples)))
+
+    for label, stats in results:
+        print(label)
+        for name, value in stats.items():
+            print(f"  {name:>20}: {value:.2f}" if isinstance(value, float) else f"  {name:>20}: {value}")
+    return results
+
+
+# ----------------------------------------
+# EMBEDDING
+# ----------------------------------------
+
+
+def synthetic_documents(num_docs=512, seed=0):
+    """
+    Chunk-like documents of very different lengths, from a synthetic chapter.
+    """
+    rng = np.random.default_rng(seed)
+    words = synthetic_chapter(num_paragraphs=200, huge_every=0, seed=seed).split()
+    lengths = rng.integers(20, 400, num_docs)
+    starts = rng.integers(0, len(words) - 400, num_docs)
+    return [" ".join(words[s : s + n]) for s, n in zip(starts, lengths)]
+
+
+def benchmark_embed(
+    num_docs=512, device="cpu", embedding_model="mixedbread-ai/mxbai-embed-large-v1"
+):
+    """
+    Documents per second of the old indexer loop (fixed batch of 32, NumPy
+    normalization) against embedder.encode_documents.
+    """
+    from embedder import encode_documents, get_embedding_model
+
+    model = get_embedding_model(embedding_model, device=device)
+    documents = synthetic_documents(num_docs)
+    model.encode(documents[:8])
+
+    def legacy():
+        embeddings = model.encode(documents, convert_to_numpy=True, batch_size=32)
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    rows = [
+        ("legacy batch_size=32", best_time(legacy, 1)),
+        ("pipeline", best_time(lambda: encode_documents(model, documents), 1)),
+    ]
+
+    print(f"{num_docs} documents on {device}")
+    print(f"{'path':>22} | {'time':>8} | {'docs/s':>7}")
+    for name, seconds in rows:
+        print(f"{name:>22} | {seconds:>7.1f}s | {num_docs / seconds:>7.1f}")
+    return rows
+
+
+# ----------------------------------------
+# VECTOR SEARCH
+# ----------------------------------------
+
+
+def synthetic_embeddings(num_docs, dimension=1024, num_topics=500, num_chapters=3_000, seed=0):
+    """
+    Normalized embeddings drawn around topic centers, spread over chapters
+    in order, plus one noisy copy of a random document per query.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_topics, dimension)).astype(np.float32)
+    embeddings = centers[rng.integers(0, num_topics, num_docs)]
+    embeddings += 0.8 * rng.standard_normal((num_docs, dimension)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    doc_chapters = (np.arange(num_docs) * num_chapters // num_docs + 1).astype(np.int32)
+    return embeddings, doc_chapters
+
+
+def noisy_queries(embeddings, num_queries, seed=1):
+    rng = np.random.default_rng(seed)
+    queries = embeddings[rng.integers(0, len(embeddings), num_queries)]
+    queries = queries + 0.5 * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(queries.shape[1])
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def benchmark_vectors(num_docs=100_000, num_queries=50, k=10, dimension=1024, chroma=True):
+    """
+    Latency and recall@k of the local vector index (exact float16 / int8,
+    IVF) and of ChromaDB's filtered HNSW search, for spoiler thresholds
+    covering 5%, 25% and 100% of the chapters. Recall is measured against
+    an exact float32 search.
+    """
+    import vector_index
+    from vector_index import VectorIndex, write_index
+
+    embeddings, doc_chapters = synthetic_embeddings(num_docs, dimension)
+    doc_ids = np.arange(num_docs, dtype=np.int64)
+    queries = noisy_queries(embeddings, num_queries)
+    last_chapter = int(doc_chapters[-1])
+    thresholds = [max(1, last_chapter // 20), last_chapter // 4, None]
+
+    truth = {}
+    for threshold in thresholds:
+        prefix = num_docs if threshold is None else int(np.searchsorted(doc_chapters, threshold, side="right"))
+        scores = queries @ embeddings[:prefix].T
+        truth[threshold] = [set(np.argsort(-row)[:k].tolist()) for row in scores]
+
+    def measure(search):
+        rows = []
+        for threshold in thresholds:
+            latencies, recalls = [], []
+            for query, expected in zip(queries, truth[threshold]):
+                start = perf_counter()
+                hits = search(query, threshold)
+                latencies.append(perf_counter() - start)
+                recalls.append(len(expected & {chunk_id for chunk_id, _ in hits}) / k)
+            rows.append((threshold, np.percentile(latencies, 50), np.percentile(latencies, 95), np.mean(recalls)))
+        return rows
+
+    results = {}
+    paths = []
+    try:
+        for name, precision, exact in [
+            ("local exact float16", "float16", True),
+            ("local exact int8", "int8", True),
+            ("local ivf float16", "float16", False),
+        ]:
+            path = tempfile.mkdtemp(prefix="vector_bench_")
+            paths.append(path)
+            ivf_min_rows = vector_index.IVF_MIN_ROWS
+            # build IVF lists at any size for the IVF variant only
+            vector_index.IVF_MIN_ROWS = num_docs if exact else 0
+            try:
+                start = perf_counter()
+                write_index(path, doc_ids, doc_chapters, embeddings, "synthetic", precision)
+                logger.info("Built %s in %.1fs", name, perf_counter() - start)
+            finally:
+                vector_index.IVF_MIN_ROWS = ivf_min_rows
+            index = VectorIndex.load(path)
+            results[name] = measure(
+                lambda query, threshold, index=index, exact=exact: index.search(
+                    query, k, threshold, exact=exact
+                )
+            )
+
+        if chroma:
+            try:
+                import chromadb
+            except ImportError:
+                logger.warning("chromadb is not installed, skipping it")
+            else:
+                collection = chromadb.EphemeralClient().get_or_create_collection("vector_bench")
+                start = perf_counter()
+                for begin in range(0, num_docs, 5_000):
+                    end = min(begin + 5_000, num_docs)
+                    collection.add(
+                        ids=[str(i) for i in range(begin, end)],
+                        embeddings=embeddings[begin:end].tolist(),
+                        metadatas=[{"chapter_number": int(c)} for c in doc_chapters[begin:end]],
+                    )
+                logger.info("Built chroma in %.1fs", perf_counter() - start)
+
+                def chroma_search(query, threshold):
+                    where = {"chapter_number": {"$lte": threshold}} if threshold else None
+                    result = collection.query(
+                        query_embeddings=[query.tolist()], n_results=k, where=where, include=[]
+                    )
+                    return [(int(i), None) for i in result["ids"][0]]
+
+                results["chroma hnsw"] = measure(chroma_search)
+    finally:
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
+
+    print(f"{num_docs} vectors of dimension {dimension}, {num_queries} queries, k={k}")
+    print(f"{'backend':>20} | {'chapters <=':>11} | {'p50':>8} | {'p95':>8} | {'recall':>6}")
+    for name, rows in results.items():
+        for threshold, p50, p95, recall in rows:
+            print(
+                f"{name:>20} | {threshold or 'all':>11} | {p50 * 1000:>6.2f}ms | {p95 * 1000:>6.2f}ms | {recall:>6.3f}"
+            )
+    return results
+
+
+# ----------------------------------------
+# PREPROCESSING
+# ----------------------------------------
+
+
+def known_item_queries(texts, num_queries=200, query_words=12, seed=0):
+    """
+    Pseudo-queries for retrieval quality: a run of words from the middle of a
+    random chunk, paired with the chunk's position in texts.
+    """
+    rng = np.random.default_rng(seed)
+    queries = []
+    for position in rng.choice(len(texts), min(num_queries, len(texts)), replace=False):
+        words = texts[position].split()
+        if len(words) < query_words:
+            continue
+        start = (len(words) - query_words) // 2
+        queries.append((int(position), " ".join(words[start : start + query_words])))
+    return queries
+
+
+def benchmark_preprocess(novel_title, max_chunks=20_000, num_queries=200, k=10, serial_sample=500):
+    """
+    Speed and retrieval quality of the preprocess modes on a novel's chunks.
+
+    Speed: serial preprocess on a sample, and preprocess_many on every
+    chunk. Quality: a BM25 index per mode over the same chunks, queried with
+    known_item_queries; a hit is any top-k chunk containing the query text,
+    since overlapping chunks share it.
+    """
+    from bm25_index import BM25Index, update_index
+    from resources import db_connection
+    from utils import CHUNK_TEXT_SQL, get_novel_id, preprocess, preprocess_many
+
+    with db_connection() as conn, conn.cursor() as cursor:
+        novel_id = get_novel_id(novel_title, cursor)
+        cursor.execute(
+            f"SELECT chunks.id, chapters.chapter_number, {CHUNK_TEXT_SQL} FROM chunks JOIN chapters ON chunks.chapter_id = chapters.id WHERE chunks.novel_id = %s ORDER BY chunks.id LIMIT %s",
+            (novel_id, max_chunks),
+        )
+        rows = cursor.fetchall()
+    chunk_ids = [row[0] for row in rows]
+    chapters = [row[1] for row in rows]
+    texts = [row[2] or "" for row in rows]
+    positions = {chunk_id: position for position, chunk_id in enumerate(chunk_ids)}
+    queries = known_item_queries(texts, num_queries)
+    logger.info("Benchmarking preprocessing on %s chunks, %s queries", len(texts), len(queries))
+
+    results = []
+    for mode in ("pos", "light"):
+        sample = texts[:serial_sample]
+        start = perf_counter()
+        for text in sample:
+            preprocess(text, mode=mode)
+        serial_time = (perf_counter() - start) / max(len(sample), 1)
+
+        start = perf_counter()
+        tokens = preprocess_many(texts, mode=mode)
+        pooled_time = perf_counter() - start
+
+        path = tempfile.mkdtemp(prefix=f"preprocess_bench_{mode}_")
+        try:
+            update_index(path, zip(chunk_ids, chapters, tokens), preprocess_mode=mode)
+            index = BM25Index.load(path)
+            hits, reciprocal_ranks = 0, 0.0
+            for _, query in queries:
+                top = index.top_k(preprocess(query, mode=mode), k=k)
+                ranks = [
+                    rank
+                    for rank, chunk_id in enumerate(top, 1)
+                    if query in " ".join(texts[positions[int(chunk_id)]].split())
+                ]
+                if ranks:
+                    hits += 1
+                    reciprocal_ranks += 1 / ranks[0]
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+        results.append(
+            (
+                mode,
+                serial_time,
+                pooled_time,
+                len(texts) / pooled_time if pooled_time else 0.0,
+                hits / max(len(queries), 1),
+                reciprocal_ranks / max(len(queries), 1),
+            )
+        )
+
+    print(
+        f"{'mode':>6} | {'serial/chunk':>12} | {'pooled total':>12} | "
+        f"{'chunks/s':>9} | {f'recall@{k}':>9} | {'MRR':>6}"
+    )
+    for mode, serial_time, pooled_time, rate, recall, mrr in results:
+        print(
+            f"{mode:>6} | {serial_time * 1000:>10.2f}ms | {pooled_time:>11.1f}s | "
+            f"{rate:>9.0f} | {recall:>9.3f} | {mrr:>6.3f}"
+        )
+    return results
+
+
+# ----------------------------------------
+# BULK WRITES
+# ----------------------------------------
+
+
+def benchmark_bulk_write(num_rows=100_000, per_row_max=20_000, tokens_per_row=60):
+    """
+    Store tokens for num_rows chunk-like rows three ways in a temporary
+    table: one UPDATE per row (the old indexer path, capped at per_row_max
+    rows), execute_values batches, and COPY + UPDATE ... FROM batches.
+    """
+    from psycopg2.extras import execute_values
+    from bulk import BULK_BATCH_SIZE, batches, copy_update
+    from resources import db_connection
+
+    rng = np.random.default_rng(0)
+    words = [f"word{i}" for i in range(20_000)]
+    rows = [
+        (i + 1, rng.choice(words, tokens_per_row).tolist()) for i in range(num_rows)
+    ]
+
+    results = []
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMP TABLE bench_chunks (id INT PRIMARY KEY, preprocessed_chunk_content TEXT[])"
+        )
+        cursor.execute(
+            "INSERT INTO bench_chunks (id) SELECT generate_series(1, %s)", (num_rows,)
+        )
+        conn.commit()
+
+        def run(name, write, count):
+            cursor.execute("UPDATE bench_chunks SET preprocessed_chunk_content = NULL")
+            conn.commit()
+            start = perf_counter()
+            write(rows[:count])
+            elapsed = perf_counter() - start
+            results.append((name, count, elapsed, count / elapsed))
+
+        def per_row(rows):
+            for doc_id, tokens in rows:
+                cursor.execute(
+                    "UPDATE bench_chunks SET preprocessed_chunk_content = %s WHERE id = %s",
+                    (tokens, doc_id),
+                )
+            conn.commit()
+
+        def with_execute_values(rows):
+            for batch in batches(rows):
+                execute_values(
+                    cursor,
+                    "UPDATE bench_chunks SET preprocessed_chunk_content = data.tokens FROM (VALUES %s) AS data(id, tokens) WHERE bench_chunks.id = data.id",
+                    batch,
+                    template="(%s, %s::text[])",
+                    page_size=BULK_BATCH_SIZE,
+                )
+                conn.commit()
+
+        def with_copy(rows):
+            for batch in batches(rows):
+                copy_update(cursor, "bench_chunks", "id", ["preprocessed_chunk_content"], batch)
+                conn.commit()
+
+        run("per-row UPDATE", per_row, min(per_row_max, num_rows))
+        run("execute_values", with_execute_values, num_rows)
+        run("COPY + UPDATE FROM", with_copy, num_rows)
+        cursor.execute("DROP TABLE bench_chunks")
+
+    print(f"batch size {BULK_BATCH_SIZE}, {tokens_per_row} tokens per row")
+    print(f"{'path':>20} | {'rows':>8} | {'time':>8} | {'rows/s':>8}")
+    for name, count, elapsed, rate in results:
+        print(f"{name:>20} | {count:>8} | {elapsed:>7.1f}s | {rate:>8.0f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Novai QA micro-benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    bm25_parser = subparsers.add_parser("bm25", help="rank_bm25 vs sparse BM25 index")
+    bm25_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    bm25_parser.add_argument("--queries", type=int, default=20)
+    bm25_parser.add_argument(
+        "--rank-bm25-max",
+        type=int,
+        default=100_000,
+        help="largest corpus to run rank_bm25 on (it needs tens of GB at 1M chunks)",
+    )
+
+    chunk_parser = subparsers.add_parser(
+        "chunk", help="segment_text/chunk_text on a large synthetic chapter"
+    )
+    chunk_parser.add_argument("--paragraphs", type=int, default=2_000)
+    chunk_parser.add_argument("--repeats", type=int, default=3)
+    chunk_parser.add_argument(
+        "--model", default="mixedbread-ai/mxbai-embed-large-v1"
+    )
+
+    subparsers.add_parser(
+        "chunk-spans",
+        help="chunk_spans on pathological paragraph sizes",
+    )
+
+    storage_parser = subparsers.add_parser(
+        "chunk-storage", help="chunks table size and fetch latency, text vs offsets"
+    )
+    storage_parser.add_argument("novel", help="novel title")
+    storage_parser.add_argument("--samples", type=int, default=200)
+    storage_parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="migrate the novel's text chunks to offsets between the two measurements",
+    )
+
+    preprocess_parser = subparsers.add_parser(
+        "preprocess", help="speed and retrieval quality of the preprocess modes"
+    )
+    preprocess_parser.add_argument("novel", help="novel title")
+    preprocess_parser.add_argument("--max-chunks", type=int, default=20_000)
+    preprocess_parser.add_argument("--queries", type=int, default=200)
+    preprocess_parser.add_argument("--k", type=int, default=10)
+
+    bulk_parser = subparsers.add_parser(
+        "bulk-write", help="per-row UPDATE vs execute_values vs COPY for token storage"
+    )
+    bulk_parser.add_argument("--rows", type=int, default=100_000)
+    bulk_parser.add_argument(
+        "--per-row-max",
+        type=int,
+        default=20_000,
+        help="rows written with the per-row path (it is the slow one)",
+    )
+
+    embed_parser = subparsers.add_parser(
+        "embed", help="documents/s of the embedding pipeline against the old loop"
+    )
+    embed_parser.add_argument("--docs", type=int, default=512)
+    embed_parser.add_argument("--device", default="cpu")
+    embed_parser.add_argument(
+        "--model", default="mixedbread-ai/mxbai-embed-large-v1"
+    )
+
+    vectors_parser = subparsers.add_parser(
+        "vectors", help="latency/recall of the local vector index against ChromaDB"
+    )
+    vectors_parser.add_argument("--docs", type=int, default=100_000)
+    vectors_parser.add_argument("--queries", type=int, default=50)
+    vectors_parser.add_argument("--dimension", type=int, default=1024)
+    vectors_parser.add_argument("--no-chroma", action="store_true")
+
+    args = parser.parse_args()
+    if args.benchmark == "bm25":
+        benchmark_bm25(args.sizes, args.queries, args.rank_bm25_max)
+    elif args.benchmark == "chunk":
+        benchmark_chunk(args.paragraphs, args.repeats, embedding_model=args.model)
+    elif args.benchmark == "chunk-spans":
+        benchmark_chunk_spans()
+    elif args.benchmark == "chunk-storage":
+        benchmark_chunk_storage(args.novel, args.migrate, args.samples)
+    elif args.benchmark == "preprocess":
+        benchmark_preprocess(args.novel, args.max_chunks, args.queries, args.k)
+    elif args.benchmark == "bulk-write":
+        benchmark_bulk_write(args.rows, args.per_row_max)
+    elif args.benchmark == "embed":
+        benchmark_embed(args.docs, args.device, args.model)
+    elif args.benchmark == "vectors":
+        benchmark_vectors(
+            args.docs, args.queries, dimension=args.dimension, chroma=not args.no_chroma
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,479 @@
+import json
+import os
+from collections import Counter
+import numpy as np
+from scipy.sparse import csr_matrix
+from index_versions import LiveIndexes, read_current_version, write_new_version
+from logger_config import setup_logger
+
+logger = setup_logger("bm25_index")
+
+# Same defaults as rank_bm25.BM25Okapi so scores stay comparable
+K1 = 1.5
+B = 0.75
+EPSILON = 0.25
+
+INDEX_ROOT = "./bm25_index"
+
+# ----------------------------------------
+# ON-DISK LAYOUT
+# ----------------------------------------
+#
+# bm25_index/<collection_name>/
+#     CURRENT                -> name of the live version directory
+#     v<n>/meta.json         -> num_docs, total_length, average_idf
+#     v<n>/vocab.json        -> list of terms, position = term id
+#     v<n>/doc_ids.npy       -> chunk id of every document (int64)
+#     v<n>/doc_chapters.npy  -> chapter number of every document (int32)
+#     v<n>/doc_lens.npy      -> token count of every document (int32)
+#     v<n>/cum_lens.npy      -> running total of doc_lens, cum_lens[0] = 0 (int64)
+#     v<n>/offsets.npy       -> postings list boundaries per term (int64)
+#     v<n>/postings_docs.npy -> document index of every posting (int32)
+#     v<n>/postings_tfs.npy  -> term frequency of every posting (uint16)
+#     v<n>/idf.npy           -> BM25 idf of every term (float32)
+#     v<n>/weights.npy       -> whole-novel BM25 weight of every posting (float32)
+#     v<n>/chapter_bounds.npy      -> distinct chapter numbers, ascending (int32)
+#     v<n>/prefix_average_idf.npy  -> average idf of "chapters <= bound" (float64)
+#
+# Documents are numbered in (chapter_number, chunk id) order and every
+# postings list is sorted by document, so "chapters <= N" is always a prefix
+# [0, P) of the documents and a prefix of each postings list. The BM25
+# statistics of that subset come straight from the shared arrays: the
+# document count is P, the total length is cum_lens[P], and the document
+# frequency of a term is the position of P in its postings list. Only the
+# average idf (used to floor negative idfs) needs a whole-vocabulary pass, so
+# it is precomputed once per chapter at update time.
+#
+# offsets/postings_docs/weights are the indptr/indices/data of a CSR
+# term x document matrix, so a query is scored as a sparse row vector of
+# query term counts times the rows of its terms.
+#
+# Updates write a new version directory and then swap CURRENT, so a reader
+# never sees a half-written index (see index_versions.py).
+
+
+def index_path(collection_name):
+    return os.path.join(INDEX_ROOT, collection_name)
+
+
+def compute_idf(df, num_docs):
+    """
+    Compute the BM25Okapi idf of every term, flooring negative values the
+    same way rank_bm25 does.
+    """
+    idf = np.log(num_docs - df + 0.5) - np.log(df + 0.5)
+    average_idf = float(idf.mean()) if len(idf) else 0.0
+    idf[idf < 0] = EPSILON * average_idf
+    return idf, average_idf
+
+
+def compute_prefix_average_idf(terms, docs, doc_chapters, vocab_size):
+    """
+    Sweep the documents in chapter order and record, for every chapter
+    boundary, the average idf over the terms seen so far.
+
+    Only the terms of each new chapter are touched: the idf sum over the seen
+    terms is kept as a running sum of log(df + 0.5) and a count of seen terms
+    per document frequency, so the part that depends on the document count
+    costs one log per distinct document frequency rather than per term.
+    """
+    chapter_bounds, bound_ends = np.unique(doc_chapters[::-1], return_index=True)
+    # return_index on the reversed array gives the last document of each chapter
+    bound_ends = len(doc_chapters) - bound_ends
+
+    by_doc = np.argsort(docs, kind="stable")
+    sorted_docs = docs[by_doc]
+    sorted_terms = terms[by_doc]
+
+    df = np.zeros(vocab_size, dtype=np.int64)
+    # document frequency -> number of seen terms with it
+    df_counts = {}
+    prefix_average_idf = np.zeros(len(chapter_bounds))
+    ends = np.searchsorted(sorted_docs, bound_ends)
+    log_df_sum = 0.0
+    num_seen = 0
+    start = 0
+    for j, (doc_end, end) in enumerate(zip(bound_ends, ends)):
+        chapter_terms, counts = np.unique(sorted_terms[start:end], return_counts=True)
+        before = df[chapter_terms]
+        after = before + counts
+        num_seen += int(np.count_nonzero(before == 0))
+        log_df_sum += float(
+            np.sum(np.log(after + 0.5)) - np.sum(np.log(before[before > 0] + 0.5))
+        )
+        for value, count in zip(*np.unique(before[before > 0], return_counts=True)):
+            remaining = df_counts[value] - count
+            if remaining:
+                df_counts[value] = remaining
+            else:
+                del df_counts[value]
+        for value, count in zip(*np.unique(after, return_counts=True)):
+            df_counts[value] = df_counts.get(value, 0) + count
+        df[chapter_terms] = after
+        start = end
+        if num_seen:
+            values = np.fromiter(df_counts.keys(), dtype=np.int64, count=len(df_counts))
+            multiplicity = np.fromiter(
+                df_counts.values(), dtype=np.int64, count=len(df_counts)
+            )
+            prefix_average_idf[j] = (
+                np.dot(multiplicity, np.log(doc_end - values + 0.5)) - log_df_sum
+            ) / num_seen
+    return chapter_bounds.astype(np.int32), prefix_average_idf
+
+
+class BM25Index:
+    """
+    Memory-mapped BM25 inverted index for the chunks of one novel.
+    """
+
+    def __init__(self, path, version, meta, vocab, arrays):
+        self.path = path
+        self.version = version
+        self.num_docs = meta["num_docs"]
+        self.total_length = meta["total_length"]
+        self.average_idf = meta["average_idf"]
+        # indexes from before the mode was recorded were built with POS tagging
+        self.preprocess_mode = meta.get("preprocess_mode", "pos")
+        self.vocab = vocab
+        self.term_ids = {term: i for i, term in enumerate(vocab)}
+        self.doc_ids = arrays["doc_ids"]
+        self.doc_chapters = arrays["doc_chapters"]
+        self.doc_lens = arrays["doc_lens"]
+        self.cum_lens = arrays["cum_lens"]
+        self.offsets = arrays["offsets"]
+        self.postings_docs = arrays["postings_docs"]
+        self.postings_tfs = arrays["postings_tfs"]
+        self.idf = arrays["idf"]
+        self.weights = arrays["weights"]
+        self.chapter_bounds = arrays["chapter_bounds"]
+        self.prefix_average_idf = arrays["prefix_average_idf"]
+
+    ARRAYS = (
+        "doc_ids",
+        "doc_chapters",
+        "doc_lens",
+        "cum_lens",
+        "offsets",
+        "postings_docs",
+        "postings_tfs",
+        "idf",
+        "weights",
+        "chapter_bounds",
+        "prefix_average_idf",
+    )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Open the live version of the index at path, or return None if the
+        index has not been built yet.
+        """
+        version = read_current_version(path)
+        if version is None:
+            return None
+        version_dir = os.path.join(path, version)
+        with open(os.path.join(version_dir, "meta.json")) as f:
+            meta = json.load(f)
+        with open(os.path.join(version_dir, "vocab.json")) as f:
+            vocab = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(version_dir, f"{name}.npy"), mmap_mode="r")
+            for name in cls.ARRAYS
+        }
+        logger.info(
+            "Loaded BM25 index %s (%s docs, %s terms)", version_dir, meta["num_docs"], len(vocab)
+        )
+        return cls(path, version, meta, vocab, arrays)
+
+    def prefix_size(self, spoiler_threshold=None):
+        """
+        Number of documents in chapters up to spoiler_threshold.
+        """
+        if not spoiler_threshold:
+            return self.num_docs
+        return int(np.searchsorted(self.doc_chapters, spoiler_threshold, side="right"))
+
+    def prefix_average_idf_at(self, prefix):
+        if prefix == self.num_docs:
+            return self.average_idf
+        j = int(np.searchsorted(self.chapter_bounds, self.doc_chapters[prefix - 1]))
+        return float(self.prefix_average_idf[j])
+
+    def term_rows(self, term_ids, prefix):
+        """
+        Build the BM25 weight rows of term_ids over the first prefix
+        documents as a CSR matrix of shape (len(term_ids), prefix).
+
+        For the whole novel the weights precomputed at update time are
+        reused. For a spoiler prefix they are recomputed, but only for the
+        requested terms, from the prefix of their postings lists.
+        """
+        starts = np.asarray(self.offsets[term_ids], dtype=np.int64)
+        ends = np.asarray(self.offsets[np.asarray(term_ids) + 1], dtype=np.int64)
+        if prefix < self.num_docs:
+            ends = np.array(
+                [
+                    start + np.searchsorted(self.postings_docs[start:end], prefix)
+                    for start, end in zip(starts, ends)
+                ],
+                dtype=np.int64,
+            )
+        lengths = ends - starts
+        indptr = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        selected = (
+            np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+            if len(term_ids)
+            else np.zeros(0, dtype=np.int64)
+        )
+        docs = self.postings_docs[selected]
+
+        if prefix == self.num_docs:
+            data = self.weights[selected]
+        else:
+            avgdl = self.cum_lens[prefix] / prefix
+            idf = np.log(prefix - lengths + 0.5) - np.log(lengths + 0.5)
+            idf[idf < 0] = EPSILON * self.prefix_average_idf_at(prefix)
+            tfs = self.postings_tfs[selected].astype(np.float64)
+            denom = tfs + K1 * (1 - B + B * self.doc_lens[docs] / avgdl)
+            data = np.repeat(idf, lengths) * tfs * (K1 + 1) / denom
+
+        return csr_matrix((data, docs, indptr), shape=(len(term_ids), prefix))
+
+    def get_scores_batch(self, queries_tokens, spoiler_threshold=None):
+        """
+        Score a batch of tokenized queries in one sparse matrix multiply.
+
+        Returns a dense array of shape (len(queries_tokens), prefix), where
+        prefix is the number of documents up to spoiler_threshold.
+        """
+        prefix = self.prefix_size(spoiler_threshold)
+        if not prefix:
+            return np.zeros((len(queries_tokens), 0))
+
+        # columns of the query matrix are the union of the batch's known terms
+        columns = {}
+        rows, cols = [], []
+        for row, tokens in enumerate(queries_tokens):
+            for token in tokens:
+                term_id = self.term_ids.get(token)
+                if term_id is None:
+                    continue
+                rows.append(row)
+                cols.append(columns.setdefault(term_id, len(columns)))
+        # duplicate (row, col) pairs are summed, so repeated query tokens count twice
+        queries = csr_matrix(
+            (np.ones(len(rows)), (rows, cols)),
+            shape=(len(queries_tokens), len(columns)),
+        )
+        weights = self.term_rows(np.fromiter(columns, dtype=np.int64), prefix)
+        return (queries @ weights).toarray()
+
+    def get_scores(self, query_tokens, spoiler_threshold=None):
+        """
+        Score the documents of chapters up to spoiler_threshold against the
+        query, with BM25 statistics computed over exactly that subset.
+        """
+        return self.get_scores_batch([query_tokens], spoiler_threshold)[0]
+
+    def top_k_batch(self, queries_tokens, k=5, spoiler_threshold=None, with_scores=False):
+        """
+        Return the chunk IDs of the k best scoring documents for every query
+        of the batch, best first, as (chunk_id, score) pairs if with_scores.
+        """
+        scores = self.get_scores_batch(queries_tokens, spoiler_threshold)
+        results = []
+        for row in scores:
+            indices = top_k_indices(row, k)
+            if with_scores:
+                results.append([(int(self.doc_ids[i]), float(row[i])) for i in indices])
+            else:
+                results.append([int(self.doc_ids[i]) for i in indices])
+        return results
+
+    def top_k(self, query_tokens, k=5, spoiler_threshold=None, with_scores=False):
+        """
+        Return the chunk IDs of the k best scoring documents, optionally
+        restricted to chapters up to spoiler_threshold.
+        """
+        return self.top_k_batch([query_tokens], k, spoiler_threshold, with_scores)[0]
+
+    def triples(self):
+        """
+        Expand the postings back into (term id, doc index, tf) arrays.
+        """
+        term_ids = np.repeat(
+            np.arange(len(self.vocab), dtype=np.int64), np.diff(self.offsets)
+        )
+        return (
+            term_ids,
+            np.asarray(self.postings_docs, dtype=np.int64),
+            np.asarray(self.postings_tfs),
+        )
+
+
+def top_k_indices(scores, k):
+    """
+    Indices of the k largest scores, best first, without sorting the rest.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    candidates = np.argpartition(scores, len(scores) - k)[len(scores) - k :]
+    return candidates[np.argsort(scores[candidates])[::-1]]
+
+
+def update_index(path, new_docs, removed_ids=(), preprocess_mode="pos", rebuild=False):
+    """
+    Merge new documents into the index at path and drop removed ones.
+
+    new_docs is an iterable of (chunk_id, chapter_number, tokens). Existing
+    postings are reused as-is, so only the new chunks need to be tokenized.
+    rebuild=True ignores the current version, e.g. when the documents were
+    tokenized with another preprocess_mode.
+    """
+    current = None if rebuild else BM25Index.load(path)
+    new_docs = list(new_docs)
+    removed_ids = set(int(i) for i in removed_ids)
+
+    if current is not None:
+        vocab = list(current.vocab)
+        term_ids_map = dict(current.term_ids)
+        terms, docs, tfs = current.triples()
+        doc_ids = np.asarray(current.doc_ids, dtype=np.int64)
+        doc_chapters = np.asarray(current.doc_chapters, dtype=np.int32)
+        doc_lens = np.asarray(current.doc_lens, dtype=np.int32)
+
+        # Drop removed and re-added documents, then renumber the survivors
+        replaced = removed_ids | set(int(doc[0]) for doc in new_docs)
+        keep = ~np.isin(doc_ids, np.fromiter(replaced, dtype=np.int64, count=len(replaced)))
+        remap = np.cumsum(keep) - 1
+        posting_keep = keep[docs]
+        terms, docs, tfs = terms[posting_keep], remap[docs[posting_keep]], tfs[posting_keep]
+        doc_ids, doc_chapters, doc_lens = doc_ids[keep], doc_chapters[keep], doc_lens[keep]
+    else:
+        vocab, term_ids_map = [], {}
+        terms = docs = np.zeros(0, dtype=np.int64)
+        tfs = np.zeros(0, dtype=np.uint16)
+        doc_ids = np.zeros(0, dtype=np.int64)
+        doc_chapters = np.zeros(0, dtype=np.int32)
+        doc_lens = np.zeros(0, dtype=np.int32)
+
+    new_terms, new_docs_idx, new_tfs = [], [], []
+    new_doc_ids, new_chapters, new_lens = [], [], []
+    base = len(doc_ids)
+    for offset, (chunk_id, chapter_number, tokens) in enumerate(new_docs):
+        tokens = tokens or []
+        for token, tf in Counter(tokens).items():
+            term_id = term_ids_map.get(token)
+            if term_id is None:
+                term_id = term_ids_map[token] = len(vocab)
+                vocab.append(token)
+            new_terms.append(term_id)
+            new_docs_idx.append(base + offset)
+            new_tfs.append(tf)
+        new_doc_ids.append(chunk_id)
+        new_chapters.append(chapter_number)
+        new_lens.append(len(tokens))
+
+    version = write_index(
+        path,
+        vocab,
+        np.concatenate([terms, np.asarray(new_terms, dtype=np.int64)]),
+        np.concatenate([docs, np.asarray(new_docs_idx, dtype=np.int64)]),
+        np.concatenate([tfs, np.asarray(new_tfs, dtype=np.uint16)]),
+        np.concatenate([doc_ids, np.asarray(new_doc_ids, dtype=np.int64)]),
+        np.concatenate([doc_chapters, np.asarray(new_chapters, dtype=np.int32)]),
+        np.concatenate([doc_lens, np.asarray(new_lens, dtype=np.int32)]),
+        preprocess_mode=preprocess_mode,
+    )
+    logger.info(
+        "BM25 index %s updated to %s: +%s docs, -%s docs",
+        path,
+        version,
+        len(new_docs),
+        len(removed_ids),
+    )
+
+
+def write_index(
+    path, vocab, terms, docs, tfs, doc_ids, doc_chapters, doc_lens, preprocess_mode="pos"
+):
+    """
+    Write a new version of the index from unordered (term, doc, tf) postings
+    and per-document arrays, and make it the live version.
+    """
+    # Renumber documents in chapter order so spoiler limits become prefixes
+    doc_order = np.lexsort((doc_ids, doc_chapters))
+    doc_rank = np.empty_like(doc_order)
+    doc_rank[doc_order] = np.arange(len(doc_order))
+    docs = doc_rank[docs]
+    doc_ids, doc_chapters, doc_lens = (
+        doc_ids[doc_order],
+        doc_chapters[doc_order],
+        doc_lens[doc_order],
+    )
+
+    # Drop terms that no longer appear in any document
+    df = np.bincount(terms, minlength=len(vocab))
+    used = df > 0
+    term_remap = np.cumsum(used) - 1
+    vocab = [term for term, is_used in zip(vocab, used) if is_used]
+    terms = term_remap[terms]
+    df = df[used]
+
+    order = np.lexsort((docs, terms))
+    terms, docs, tfs = terms[order], docs[order], tfs[order]
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    np.cumsum(df, out=offsets[1:])
+
+    num_docs = len(doc_ids)
+    idf, average_idf = compute_idf(df.astype(np.float64), num_docs)
+    cum_lens = np.zeros(num_docs + 1, dtype=np.int64)
+    np.cumsum(doc_lens, out=cum_lens[1:])
+    chapter_bounds, prefix_average_idf = compute_prefix_average_idf(
+        terms, docs, doc_chapters, len(vocab)
+    )
+
+    # whole-novel BM25 weight of every posting, the data of the CSR matrix
+    avgdl = cum_lens[-1] / num_docs if num_docs else 1.0
+    tfs_float = tfs.astype(np.float64)
+    weights = (
+        idf[terms]
+        * tfs_float
+        * (K1 + 1)
+        / (tfs_float + K1 * (1 - B + B * doc_lens[docs] / avgdl))
+    )
+
+    meta = {
+        "num_docs": num_docs,
+        "total_length": int(cum_lens[-1]),
+        "average_idf": average_idf,
+        "preprocess_mode": preprocess_mode,
+    }
+    arrays = {
+        "doc_ids": doc_ids,
+        "doc_chapters": doc_chapters,
+        "doc_lens": doc_lens,
+        "cum_lens": cum_lens,
+        "offsets": offsets,
+        "postings_docs": docs.astype(np.int32),
+        "postings_tfs": tfs.astype(np.uint16),
+        "idf": idf.astype(np.float32),
+        "weights": weights.astype(np.float32),
+        "chapter_bounds": chapter_bounds,
+        "prefix_average_idf": prefix_average_idf,
+    }
+    return write_new_version(path, {"meta": meta, "vocab": vocab}, arrays)
+
+
+_live_indexes = LiveIndexes(BM25Index.load, index_path)
+
+
+def get_index(collection_name):
+    """
+    Return the live index for a collection, reopening it only when an
+    update has swapped in a new version.
+    """
+    return _live_indexes.get(collection_name)
@@ -0,0 +1,138 @@
+import io
+import os
+from time import perf_counter
+from psycopg2 import sql
+from logger_config import setup_logger
+
+logger = setup_logger("bulk")
+
+# Rows per COPY + set-based statement; callers commit once per batch
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "10000"))
+
+# ----------------------------------------
+# COPY-BASED BULK WRITES
+# ----------------------------------------
+#
+# Rows are streamed with COPY into a temporary staging table shaped like the
+# target columns, then applied with a single INSERT ... SELECT or
+# UPDATE ... FROM. Nothing here commits: the caller decides what else goes
+# in the same transaction.
+
+
+def array_literal(values):
+    """
+    Postgres array literal of a list of texts.
+    """
+    return (
+        "{"
+        + ",".join(
+            "NULL"
+            if value is None
+            else '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+            for value in values
+        )
+        + "}"
+    )
+
+
+def copy_value(value):
+    """
+    One field of COPY's text format.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, (list, tuple)):
+        value = array_literal(value)
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_to_staging(cursor, table, columns, rows):
+    """
+    Create a fresh staging table with the types of table's columns and COPY
+    the rows into it. Returns the staging table's name.
+    """
+    staging = f"staging_{table}"
+    column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+    cursor.execute(
+        sql.SQL("DROP TABLE IF EXISTS pg_temp.{}").format(sql.Identifier(staging))
+    )
+    cursor.execute(
+        sql.SQL(
+            "CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA"
+        ).format(sql.Identifier(staging), column_list, sql.Identifier(table))
+    )
+
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor.copy_expert(
+        sql.SQL("COPY {} ({}) FROM STDIN")
+        .format(sql.Identifier(staging), column_list)
+        .as_string(cursor),
+        buffer,
+    )
+    return staging
+
+
+def copy_insert(cursor, table, columns, rows):
+    """
+    Insert rows (tuples in columns order) into table through a staging table.
+    """
+    if not rows:
+        return 0
+    start = perf_counter()
+    staging = copy_to_staging(cursor, table, columns, rows)
+    column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+    cursor.execute(
+        sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(
+            sql.Identifier(table), column_list, column_list, sql.Identifier(staging)
+        )
+    )
+    log_rate("Inserted", table, len(rows), perf_counter() - start)
+    return len(rows)
+
+
+def copy_update(cursor, table, key, columns, rows):
+    """
+    Update columns of table for rows of (key, *columns) through a staging
+    table, matching on key.
+    """
+    if not rows:
+        return 0
+    start = perf_counter()
+    staging = copy_to_staging(cursor, table, [key, *columns], rows)
+    cursor.execute(
+        sql.SQL("UPDATE {table} SET {assignments} FROM {staging} WHERE {table}.{key} = {staging}.{key}").format(
+            table=sql.Identifier(table),
+            staging=sql.Identifier(staging),
+            key=sql.Identifier(key),
+            assignments=sql.SQL(", ").join(
+                sql.SQL("{} = {}.{}").format(
+                    sql.Identifier(column), sql.Identifier(staging), sql.Identifier(column)
+                )
+                for column in columns
+            ),
+        )
+    )
+    log_rate("Updated", table, len(rows), perf_counter() - start)
+    return len(rows)
+
+
+def batches(rows, batch_size=BULK_BATCH_SIZE):
+    for start in range(0, len(rows), batch_size):
+        yield rows[start : start + batch_size]
+
+
+def log_rate(action, table, count, elapsed):
+    logger.info(
+        f"{action} {count} rows of {table} in {elapsed:.2f}s "
+        f"({count / elapsed if elapsed else 0:.0f} rows/s)"
+    )
@@ -1,128 +1,203 @@
-from sentence_transformers import SentenceTransformer
+import os
+import re
+from itertools import accumulate
+from multiprocessing import Pool
+from time import perf_counter
+import numpy as np
 from nltk.tokenize import sent_tokenize
+from psycopg2.extras import execute_values
+from tqdm import tqdm
 from logger_config import setup_logger
-from utils import get_novel_id, get_db_connection
+from utils import get_novel_id, CHAPTER_HASH_SQL
+from resources import db_connection
+from bulk import BULK_BATCH_SIZE, copy_insert, copy_update
 
 logger = setup_logger("chunker")
 
+# Worker processes for chunking; 1 chunks in-process
+CHUNK_WORKERS = int(os.getenv("CHUNK_WORKERS", str(os.cpu_count() or 1)))
+# Chunk rows per bulk write and commit
+CHUNK_WRITE_BATCH_SIZE = int(os.getenv("CHUNK_WRITE_BATCH_SIZE", str(BULK_BATCH_SIZE)))
 
-def segment_text(text, max_chunk_size, overlap, tokenizer=None):
+# Bump when a change to segmenting or chunking changes the chunks produced
+CHUNKER_VERSION = "offsets-1"
+
+_worker_tokenizer = None
+
+
+def count_tokens(tokenizer, texts, with_offsets=False):
+    """
+    Token counts of texts (no special tokens) from one batched tokenizer call.
+    With with_offsets, also return each text's token character offsets.
+    """
+    if not texts:
+        return ([], []) if with_offsets else []
+    encoded = tokenizer(
+        texts,
+        add_special_tokens=False,
+        return_offsets_mapping=with_offsets,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+    )
+    sizes = [len(ids) for ids in encoded["input_ids"]]
+    if with_offsets:
+        return sizes, encoded["offset_mapping"]
+    return sizes
+
+
+def split_sentences(paragraph, offsets, tokenizer):
+    """
+    Split an oversized paragraph into (start_char, end_char, size) sentence
+    spans relative to the paragraph. With the paragraph's token offsets the
+    sizes are counted without re-encoding.
+    """
+    spans = []
+    position = 0
+    for sentence in sent_tokenize(paragraph):
+        start = paragraph.find(sentence, position)
+        if start < 0:
+            # sent_tokenize normalised the text, keep the paragraph whole
+            return None
+        position = start + len(sentence)
+        spans.append((start, position))
+    if not spans:
+        return None
+
+    if offsets is None:
+        sizes = count_tokens(tokenizer, [paragraph[s:e] for s, e in spans])
+    else:
+        token_starts = np.array([start for start, _ in offsets])
+        bounds = np.array(spans)
+        sizes = (
+            np.searchsorted(token_starts, bounds[:, 1])
+            - np.searchsorted(token_starts, bounds[:, 0])
+        ).tolist()
+    return [(s, e, size) for (s, e), size in zip(spans, sizes)]
+
+
+def segment_spans(text, max_chunk_size, overlap, tokenizer=None):
+    """
+    Split text into (start_char, end_char, token size) segments: its
+    paragraphs, with the ones too large to fit with the overlap split into
+    sentences.
+
+    All paragraphs are counted in one batched call to the (fast) tokenizer,
+    and oversized paragraphs reuse their token offsets for the sentences.
+    """
     logger.info(
         f"Segmenting text into paragraphs with max size {max_chunk_size} and overlap {overlap}"
     )
-    paragraphs = [p.strip() for p in text.split("\n") if p.strip()]
-    paragraphs = [
-        (p, len(tokenizer.encode(p, add_special_tokens=False))) for p in paragraphs
-    ]
-
-    # adding a check for very large paragraphs
-    if any(size + overlap > max_chunk_size for _, size in paragraphs):
+    bounds = []
+    position = 0
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if stripped:
+            start = position + len(line) - len(line.lstrip())
+            bounds.append((start, start + len(stripped)))
+        position += len(line) + 1
+    paragraphs = [text[start:end] for start, end in bounds]
+
+    with_offsets = getattr(tokenizer, "is_fast", False)
+    if with_offsets:
+        sizes, offsets = count_tokens(tokenizer, paragraphs, with_offsets=True)
+    else:
+        sizes, offsets = count_tokens(tokenizer, paragraphs), [None] * len(paragraphs)
+
+    segments = []
+    for (start, end), paragraph, size, paragraph_offsets in zip(
+        bounds, paragraphs, sizes, offsets
+    ):
+        sentences = None
+        if size + overlap > max_chunk_size:
+            sentences = split_sentences(paragraph, paragraph_offsets, tokenizer)
+        if sentences is None:
+            segments.append((start, end, size))
+        else:
+            segments += [(start + s, start + e, n) for s, e, n in sentences]
 
-        # we go to sentence level tokenization
-        logger.info(
-            f"Some paragraphs are too large, going to sentence level tokenization"
-        )
-        sentences = sent_tokenize(text)
-        # the rest of the code remains the same so we use the same name for the variable
-        paragraphs = [
-            (s, len(tokenizer.encode(s, add_special_tokens=False))) for s in sentences
-        ]
-
-        # adding a check for very large sentences
-        if any(size > max_chunk_size for _, size in paragraphs):
-            logger.info(f"Some sentences are too large, breaking them down further")
-            pars = []
-            for s, size in paragraphs:
-                if size <= max_chunk_size:
-                    pars.append((s, size))
-                else:
-                    sentences = [
-                        (
-                            sentence.strip(),
-                            len(
-                                tokenizer.encode(
-                                    sentence.strip(), add_special_tokens=False
-                                )
-                            ),
-                        )
-                        for sentence in s.split("\n")
-                        if sentence.strip()
-                    ]
-                    pars += sentences
-
-            paragraphs = pars
-
-    logger.info(f"Segmented text into {len(paragraphs)} paragraphs")
-    return paragraphs
+    logger.info(f"Segmented text into {len(segments)} paragraphs")
+    return segments
 
 
-def chunk_text(text, max_chunk_size=512, overlap=200, tokenizer=None):
+def segment_text(text, max_chunk_size, overlap, tokenizer=None):
     """
-    This function chunks the text into smaller pieces based on the max_chunk_size and overlap.
-    It uses the tokenizer to calculate the size of each chunk.
-    If the first paragraph is too large, it will reduce the overlap down to a minimum of 0.
-    It will still try to keep the overlap as large as possible, but it will not exceed the overlap size.
-    When the overlap is done, it will add the next paragraph to the chunk until the max_chunk_size is reached.
-    It will then create a new chunk and repeat the process until all paragraphs are processed.
-    The first paragraph that is added first to the chunk should have a size less than the max_chunk_size.
-    Really hopes this doesn't break, the logic of it all melted my brain.
+    segment_spans as (segment text, token size) pairs.
     """
+    return [
+        (text[start:end], size)
+        for start, end, size in segment_spans(text, max_chunk_size, overlap, tokenizer)
+    ]
 
-    paragraphs = segment_text(text, max_chunk_size, overlap, tokenizer=tokenizer)
-
-    chunks = []
-    current_chunk = []
-    current_chunk_size = 0
 
-    k = 0
-    finished = False
+def chunk_spans(sizes, max_chunk_size=512, overlap=200):
+    """
+    Group paragraphs of the given token sizes into chunks, returned as
+    (start, end) paragraph index spans.
+
+    Each chunk is anchored on the first paragraph that did not fit in the
+    previous one. Paragraphs before the anchor are prepended as overlap while
+    the overlap is at most `overlap` tokens (so the last one may exceed it)
+    and the chunk stays within max_chunk_size; then paragraphs after it are
+    appended while they fit. A paragraph larger than max_chunk_size becomes
+    a chunk of its own.
+
+    Prefix sums make every size check O(1), and both span ends only move
+    forward over the chapter, so the whole pass is linear.
+    """
+    prefix = list(accumulate(sizes, initial=0))
+    spans = []
+    anchor = 0
+    while anchor < len(sizes):
+        start = anchor
+        while (
+            start > 0
+            and prefix[anchor] - prefix[start] <= overlap
+            and prefix[anchor + 1] - prefix[start - 1] <= max_chunk_size
+        ):
+            start -= 1
+        end = anchor + 1
+        while end < len(sizes) and prefix[end + 1] - prefix[start] <= max_chunk_size:
+            end += 1
+        spans.append((start, end))
+        anchor = end
+    return spans
+
+
+def chunk_offsets(text, max_chunk_size=512, overlap=200, tokenizer=None):
+    """
+    Chunk the text and return each chunk as a (start_char, end_char) span of
+    it, see chunk_spans for how paragraphs are grouped into chunks.
+    """
+    segments = segment_spans(text, max_chunk_size, overlap, tokenizer=tokenizer)
 
     logger.info(
         f"Starting chunking with max size {max_chunk_size} and overlap {overlap}"
     )
+    spans = chunk_spans([size for _, _, size in segments], max_chunk_size, overlap)
+    offsets = [(segments[start][0], segments[end - 1][1]) for start, end in spans]
+
+    logger.info(f"Chunked text into {len(offsets)} chunks.")
+    return offsets
+
+
+def chunk_text(text, max_chunk_size=512, overlap=200, tokenizer=None):
+    """
+    This function chunks the text into smaller pieces based on the max_chunk_size and overlap.
+    Every chunk is a verbatim slice of the text, paragraph breaks included, so it is
+    exactly what the database materializes from the chunk's offsets.
+    """
+    return [
+        text[start:end]
+        for start, end in chunk_offsets(text, max_chunk_size, overlap, tokenizer)
+    ]
 
-    for i, (paragraph, size) in enumerate(paragraphs):
-        if i != k:
-            continue
-        if not current_chunk:
-            current_chunk.append(paragraph)
-            current_chunk_size += size
-            j = i - 1
-            while current_chunk_size <= size + overlap:
-                if j >= 0:
-                    if current_chunk_size <= max_chunk_size - paragraphs[j][1]:
-                        current_chunk.insert(0, paragraphs[j][0])
-                        current_chunk_size += paragraphs[j][1]
-                        j -= 1
-                    else:
-                        break
-                else:
-                    break
-
-            while current_chunk_size <= max_chunk_size:
-                k += 1
-                if (
-                    k < len(paragraphs)
-                    and current_chunk_size + paragraphs[k][1] <= max_chunk_size
-                ):
-                    current_chunk.append(paragraphs[k][0])
-                    current_chunk_size += paragraphs[k][1]
-                elif k >= len(paragraphs):
-                    finished = True
-                    chunks.append(" ".join(current_chunk))
-                    break
-                elif current_chunk_size + paragraphs[k][1] > max_chunk_size:
-                    chunks.append(" ".join(current_chunk))
-                    break
-
-            current_chunk = []
-            current_chunk_size = 0
-
-        if finished:
-            break
-
-    logger.info(f"Chunked text into {len(chunks)} chunks.")
-    return chunks
+
+def processing_version(embedding_model, max_chunk_size, overlap):
+    """
+    Everything that decides a chapter's chunks. A chapter is re-chunked when
+    this or its content hash differs from what it was chunked with.
+    """
+    return f"{CHUNKER_VERSION}:{embedding_model}:{max_chunk_size}:{overlap}"
 
 
 def chunking_novel(
@@ -130,73 +205,333 @@ def chunking_novel(
     max_chunk_size=512,
     overlap=200,
     embedding_model="mixedbread-ai/mxbai-embed-large-v1",
+    workers=CHUNK_WORKERS,
+    force=False,
 ):
+    """
+    Chunk the chapters of a novel that are new, changed or chunked with other
+    settings since the last run; force=True re-chunks every chapter.
 
-    conn = get_db_connection()
+    The old chunks of a re-chunked chapter are deleted in the same
+    transaction that inserts the new ones, and queued in stale_chunks so the
+    Chroma indexer removes their vectors.
+    """
 
-    cursor = conn.cursor()
+    with db_connection() as conn:
+        cursor = conn.cursor()
 
-    novel_id = get_novel_id(novel_title, cursor)
-    if not novel_id:
-        logger.info(f"Novel '{novel_title}' not found in the database.")
-        return
+        novel_id = get_novel_id(novel_title, cursor)
+        if not novel_id:
+            logger.info(f"Novel '{novel_title}' not found in the database.")
+            return
 
-    cursor.execute("SELECT * FROM chunks WHERE novel_id = %s", (novel_id,))
-    existing_chunks = cursor.fetchall()
-    if existing_chunks:
-        logger.info(f"Chunks for novel '{novel_title}' already exist in the database.")
-        response = input("Do you want to delete them and rechunk? (y/n): ")
-        if response.lower() == "y":
-            cursor.execute("DELETE FROM chunks WHERE novel_id = %s", (novel_id,))
-            conn.commit()
-            logger.info(f"Deleted existing chunks for novel '{novel_title}'.")
-        else:
-            logger.info("Exiting without chunking.")
+        version = processing_version(embedding_model, max_chunk_size, overlap)
+        adopt_chunked_chapters(cursor, conn, novel_id, version)
+
+        logger.info(f"Chunking novel '{novel_title}'...")
+        logger.info(f"Using embedding model: {embedding_model}")
+        logger.info(f"Using max_chunk_size: {max_chunk_size}")
+        logger.info(f"Using overlap: {overlap}")
+
+        cursor.execute(
+            f"""
+            SELECT id, chapter_content, hash
+            FROM (
+                SELECT id, chapter_content, chunked_hash, chunk_version,
+                       COALESCE(content_hash, {CHAPTER_HASH_SQL}) AS hash
+                FROM chapters
+                WHERE novel_id = %s AND chapter_content IS NOT NULL
+            ) AS chapters
+            WHERE %s OR chunked_hash IS DISTINCT FROM hash
+               OR chunk_version IS DISTINCT FROM %s
+            """,
+            (novel_id, force, version),
+        )
+        chapters = cursor.fetchall()
+        logger.info(f"Chapters to chunk: {len(chapters)}")
+        if not chapters:
+            logger.info("All chapters are chunked and up to date.")
             return
 
-    logger.info(f"Chunking novel '{novel_title}'...")
-    logger.info(f"Using embedding model: {embedding_model}")
-    logger.info(f"Using max_chunk_size: {max_chunk_size}")
-    logger.info(f"Using overlap: {overlap}")
+        hashes = {chapter_id: chapter_hash for chapter_id, _, chapter_hash in chapters}
+        chunky = []
+        rows = []
+        done = []
+        num_chunks = 0
+        start = perf_counter()
+        for chapter_id, chunks in tqdm(
+            chunk_chapters(
+                [(chapter_id, content) for chapter_id, content, _ in chapters],
+                embedding_model,
+                max_chunk_size,
+                overlap,
+                workers,
+            ),
+            total=len(chapters),
+            desc="Chunking chapters",
+        ):
+            rows += [
+                (chapter_id, novel_id, i + 1, start_char, end_char)
+                for i, (start_char, end_char) in enumerate(chunks)
+            ]
+            done.append((chapter_id, hashes[chapter_id], version))
+            num_chunks += len(chunks)
+            if len(chunks) > 5:
+                chunky.append((chapter_id, len(chunks)))
+            if len(rows) >= CHUNK_WRITE_BATCH_SIZE:
+                replace_chapter_chunks(cursor, conn, novel_id, rows, done)
+                rows, done = [], []
+        replace_chapter_chunks(cursor, conn, novel_id, rows, done)
+
+        elapsed = perf_counter() - start
+        logger.info(
+            f"Chunked {len(chapters)} chapters into {num_chunks} chunks in "
+            f"{elapsed:.1f}s ({len(chapters) / elapsed if elapsed else 0:.1f} "
+            f"chapters/s, {num_chunks / elapsed if elapsed else 0:.1f} chunks/s)"
+        )
+
+        cursor.close()
+    logger.info("Chunking completed")
+    logger.info(f"Here are the chunky chapters:")
+    for chapter_id, num_chunks in chunky:
+        logger.info(f"Chapter ID {chapter_id} has {num_chunks} chunks.")
+    return
+
 
-    model = SentenceTransformer(embedding_model)
-    tokenizer = model.tokenizer
+def adopt_chunked_chapters(cursor, conn, novel_id, version):
+    """
+    Chapters chunked before hashes were tracked have chunks but no
+    chunked_hash; take their chunks as current instead of re-chunking the
+    whole novel once.
 
+    Only chapters the scraper has not touched since (no content_hash) are
+    adopted: a chapter it rewrote, such as a repaired Cloudflare page, has
+    chunks of its old content and must be re-chunked.
+    """
+    cursor.execute(
+        f"""
+        UPDATE chapters
+        SET chunked_hash = {CHAPTER_HASH_SQL}, chunk_version = %s
+        WHERE novel_id = %s AND chunked_hash IS NULL AND content_hash IS NULL
+          AND EXISTS (SELECT 1 FROM chunks WHERE chunks.chapter_id = chapters.id)
+        """,
+        (version, novel_id),
+    )
+    if cursor.rowcount:
+        logger.info(f"Adopted the existing chunks of {cursor.rowcount} chapters")
+    conn.commit()
+
+
+def replace_chapter_chunks(cursor, conn, novel_id, rows, chapters):
+    """
+    Swap in the new chunk rows of (chapter_id, content_hash, version)
+    chapters in one transaction: old chunks are deleted and queued in
+    stale_chunks, new ones inserted, and the chapters stamped.
+    """
+    if not chapters:
+        return
+    chapter_ids = [chapter_id for chapter_id, _, _ in chapters]
     cursor.execute(
-        "SELECT id, chapter_content FROM chapters WHERE novel_id = %s", (novel_id,)
+        """
+        WITH deleted AS (
+            DELETE FROM chunks WHERE chapter_id = ANY(%s) RETURNING id
+        )
+        INSERT INTO stale_chunks (chunk_id, novel_id)
+        SELECT id, %s FROM deleted
+        ON CONFLICT DO NOTHING
+        """,
+        (chapter_ids, novel_id),
+    )
+    insert_chunks(cursor, rows)
+    execute_values(
+        cursor,
+        """
+        UPDATE chapters SET chunked_hash = data.hash, chunk_version = data.version
+        FROM (VALUES %s) AS data(id, hash, version)
+        WHERE chapters.id = data.id
+        """,
+        chapters,
+        page_size=CHUNK_WRITE_BATCH_SIZE,
+    )
+    conn.commit()
+
+
+def load_tokenizer(embedding_model):
+    """
+    The tokenizer of the embedding model, without loading the model itself.
+    """
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(embedding_model)
+
+
+def _init_worker(embedding_model):
+    global _worker_tokenizer
+    _worker_tokenizer = load_tokenizer(embedding_model)
+
+
+def _chunk_chapter(args):
+    chapter_id, chapter_content, max_chunk_size, overlap = args
+    chunks = chunk_offsets(
+        chapter_content,
+        max_chunk_size=max_chunk_size,
+        overlap=overlap,
+        tokenizer=_worker_tokenizer,
+    )
+    return chapter_id, chunks
+
+
+def chunk_chapters(chapters, embedding_model, max_chunk_size, overlap, workers=CHUNK_WORKERS):
+    """
+    Yield (chapter_id, chunk offsets) for (chapter_id, chapter_content) pairs,
+    in completion order. With workers > 1 the chapters are spread over worker
+    processes that each load their own tokenizer.
+    """
+    tasks = (
+        (chapter_id, chapter_content, max_chunk_size, overlap)
+        for chapter_id, chapter_content in chapters
+    )
+    if workers <= 1:
+        _init_worker(embedding_model)
+        yield from map(_chunk_chapter, tasks)
+        return
+
+    # each process has its own tokenizer, so the Rust thread pool is not needed
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    with Pool(workers, initializer=_init_worker, initargs=(embedding_model,)) as pool:
+        yield from pool.imap_unordered(_chunk_chapter, tasks, chunksize=4)
+
+
+def insert_chunks(cursor, rows):
+    """
+    Insert (chapter_id, novel_id, chunk_number, start_char, end_char) rows
+    with COPY and one INSERT ... SELECT. Not committed. The chunk text is not
+    stored, see utils.CHUNK_TEXT_SQL.
+    """
+    copy_insert(
+        cursor,
+        "chunks",
+        ["chapter_id", "novel_id", "chunk_number", "start_char", "end_char"],
+        rows,
     )
 
-    chunky = []
 
-    chapters = cursor.fetchall()
-    for chapter_id, chapter_content in chapters:
-        logger.info(f"Chunking chapter ID {chapter_id}...")
-        chunks = chunk_text(
-            chapter_content,
-            max_chunk_size=max_chunk_size,
-            overlap=overlap,
-            tokenizer=tokenizer,
+# ----------------------------------------
+# MIGRATION TO OFFSET CHUNKS
+# ----------------------------------------
+
+
+def locate_chunks(chapter_content, chunk_contents):
+    """
+    Find each stored chunk text in its chapter and return its
+    (start_char, end_char) span, or None where it cannot be found.
+
+    Old chunks joined their paragraphs with spaces, so the match is done on
+    whitespace-normalised text and mapped back to the original positions.
+    Chunks are searched in order, each from the previous match onwards.
+    """
+    words = list(re.finditer(r"\S+", chapter_content))
+    normalized = " ".join(word.group() for word in words)
+    # position of every word in the normalised text
+    word_starts = np.cumsum([0] + [len(word.group()) + 1 for word in words[:-1]])
+
+    spans = []
+    search_from = 0
+    for chunk_content in chunk_contents:
+        chunk_normalized = " ".join((chunk_content or "").split())
+        position = normalized.find(chunk_normalized, search_from) if chunk_normalized else -1
+        first = np.searchsorted(word_starts, position) if position >= 0 else None
+        last = (
+            np.searchsorted(word_starts, position + len(chunk_normalized), "right") - 1
+            if position >= 0
+            else None
         )
-        logger.info(f"Chapter ID {chapter_id} has {len(chunks)} chunks.")
-        for i, chunk in enumerate(chunks):
-            # Insert into chunks table
+        if (
+            first is None
+            or first >= len(words)
+            or word_starts[first] != position
+            or word_starts[last] + len(words[last].group())
+            != position + len(chunk_normalized)
+        ):
+            spans.append(None)
+            continue
+        spans.append((words[first].start(), words[last].end()))
+        search_from = position
+    return spans
+
+
+def migrate_chunks_to_offsets(novel_title, vacuum=False):
+    """
+    Convert a novel's text chunks to offset chunks in place: chunk ids,
+    vectors and BM25 documents stay valid. Chunks whose text cannot be found
+    in their chapter keep their text and are reported.
+
+    vacuum=True runs VACUUM FULL on chunks afterwards to give the space back.
+    """
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            novel_id = get_novel_id(novel_title, cursor)
             cursor.execute(
-                "INSERT INTO chunks (chapter_id, novel_id, chunk_number, chunk_content) VALUES (%s, %s, %s, %s)",
-                (chapter_id, novel_id, i + 1, chunk),
+                """
+                SELECT chunks.chapter_id, chapters.chapter_content,
+                       array_agg(chunks.id ORDER BY chunks.chunk_number),
+                       array_agg(chunks.chunk_content ORDER BY chunks.chunk_number)
+                FROM chunks JOIN chapters ON chunks.chapter_id = chapters.id
+                WHERE chunks.novel_id = %s AND chunks.chunk_content IS NOT NULL
+                GROUP BY chunks.chapter_id, chapters.chapter_content
+                """,
+                (novel_id,),
             )
+            chapters = cursor.fetchall()
+
+            migrated, kept = 0, []
+            rows = []
+            for chapter_id, chapter_content, chunk_ids, chunk_contents in tqdm(
+                chapters, desc="Migrating chunks"
+            ):
+                spans = locate_chunks(chapter_content or "", chunk_contents)
+                for chunk_id, span in zip(chunk_ids, spans):
+                    if span is None:
+                        kept.append(chunk_id)
+                    else:
+                        rows.append((chunk_id, *span))
+                if len(rows) >= CHUNK_WRITE_BATCH_SIZE:
+                    migrated += update_chunk_offsets(cursor, conn, rows)
+                    rows = []
+            migrated += update_chunk_offsets(cursor, conn, rows)
 
-            conn.commit()
-        logger.info(f"Inserted {len(chunks)} chunks for chapter ID {chapter_id}")
-        if len(chunks) > 5:
-            chunky.append((chapter_id, len(chunks)))
+    logger.info(
+        f"Migrated {migrated} chunks of '{novel_title}' to offsets, "
+        f"{len(kept)} kept as text"
+    )
+    if kept:
+        logger.warning(f"Chunks kept as text: {kept[:20]}")
 
-    cursor.close()
-    conn.close()
-    logger.info("Chunking completed")
-    logger.info(f"Here are the chunky chapters:")
-    for chapter_id, num_chunks in chunky:
-        logger.info(f"Chapter ID {chapter_id} has {num_chunks} chunks.")
-    return
+    if vacuum:
+        with db_connection() as conn:
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("VACUUM FULL chunks")
+            finally:
+                conn.autocommit = False
+    return migrated, kept
+
+
+def update_chunk_offsets(cursor, conn, rows):
+    """
+    Set the offsets of (chunk_id, start_char, end_char) rows and drop their
+    stored text, one bulk update and commit per batch.
+    """
+    copy_update(
+        cursor,
+        "chunks",
+        "id",
+        ["start_char", "end_char", "chunk_content"],
+        [(*row, None) for row in rows],
+    )
+    conn.commit()
+    return len(rows)
 
 
 if __name__ == "__main__":
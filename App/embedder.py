@@ -0,0 +1,185 @@
+import os
+from itertools import islice
+import numpy as np
+from resources import get_model, resolve_device
+from embedding_cache import text_key
+from logger_config import setup_logger
+
+logger = setup_logger("embedder")
+
+# cuda when available, cpu otherwise; set to force one
+EMBED_DEVICE = os.getenv("EMBED_DEVICE") or None
+# Documents sorted by length together, and fetched per round trip
+EMBED_WINDOW = int(os.getenv("EMBED_WINDOW", "4096"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "256"))
+# Padded tokens per batch; derived from free memory when unset
+EMBED_TOKEN_BUDGET = int(os.getenv("EMBED_TOKEN_BUDGET", "0"))
+# Budget used when free memory cannot be read (e.g. no sysconf on macOS/Windows)
+DEFAULT_TOKEN_BUDGET = 16_384
+
+# rough characters per token, only used to order and group documents
+CHARS_PER_TOKEN = 4
+
+
+def get_embedding_model(model_name, device=EMBED_DEVICE):
+    return get_model(model_name, device=resolve_device(device))
+
+
+def available_memory(device):
+    """
+    Free bytes on the device the model runs on, or None if unknown.
+    """
+    if device.startswith("cuda"):
+        import torch
+
+        free, _ = torch.cuda.mem_get_info(torch.device(device))
+        return free
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, AttributeError, OSError):
+        return None
+
+
+def token_budget(model):
+    """
+    Padded tokens per batch that fit comfortably in free memory.
+
+    A token costs about hidden size x 4 (MLP expansion) x 4 bytes in each
+    layer's activations; attention of full-length documents costs as much
+    again, hence the factor 2. A fifth of the free memory is used.
+    """
+    if EMBED_TOKEN_BUDGET:
+        return EMBED_TOKEN_BUDGET
+    free = available_memory(str(model.device))
+    if free is None:
+        return DEFAULT_TOKEN_BUDGET
+    hidden = model.get_sentence_embedding_dimension() or 1024
+    bytes_per_token = hidden * 4 * 4 * 2
+    budget = int(free * 0.2 / bytes_per_token)
+    return max(1024, min(budget, 262_144))
+
+
+def estimated_tokens(text, max_length):
+    return min(len(text) // CHARS_PER_TOKEN + 2, max_length)
+
+
+def length_batches(texts, budget, max_length):
+    """
+    Group positions of texts into batches, longest first, so that every
+    batch's padded size (count x longest) stays within budget tokens.
+    """
+    order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+    batch = []
+    for position in order:
+        # the first text of a batch is its longest one
+        longest = estimated_tokens(texts[batch[0] if batch else position], max_length)
+        if batch and (
+            (len(batch) + 1) * longest > budget or len(batch) >= EMBED_MAX_BATCH
+        ):
+            yield batch
+            batch = []
+        batch.append(position)
+    if batch:
+        yield batch
+
+
+def is_out_of_memory(error):
+    return "out of memory" in str(error).lower()
+
+
+def encode_batch(model, texts):
+    """
+    Normalized embeddings of texts in one forward pass, split in halves
+    (recursively) when the device runs out of memory.
+    """
+    try:
+        return model.encode(
+            texts,
+            batch_size=len(texts),
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+    except RuntimeError as e:
+        if not is_out_of_memory(e) or len(texts) == 1:
+            raise
+        if str(model.device).startswith("cuda"):
+            import torch
+
+            torch.cuda.empty_cache()
+        logger.warning(f"Out of memory on a batch of {len(texts)}, splitting it")
+        middle = len(texts) // 2
+        return np.concatenate(
+            [encode_batch(model, texts[:middle]), encode_batch(model, texts[middle:])]
+        )
+
+
+def encode_documents(model, texts, budget=None):
+    """
+    Embed texts in length-sorted, memory-sized batches and return the
+    normalized float32 vectors in the original order. Stores that keep
+    reduced precision quantize them themselves (see vector_index.quantize).
+    """
+    budget = budget or token_budget(model)
+    max_length = model.max_seq_length or 512
+    embeddings = None
+    for batch in length_batches(texts, budget, max_length):
+        vectors = encode_batch(model, [texts[i] for i in batch])
+        if embeddings is None:
+            embeddings = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+        embeddings[batch] = vectors
+    if embeddings is None:
+        return np.zeros((0, model.get_sentence_embedding_dimension() or 0), dtype=np.float32)
+    return embeddings
+
+
+def encode_cached(model, texts, cache, budget=None):
+    """
+    Like encode_documents, but take the vectors of texts already in cache
+    (an EmbeddingCache of this model) and only encode the others, once per
+    distinct text, adding them to the cache.
+    """
+    keys = [text_key(text) for text in texts]
+    hit_positions, hit_vectors = cache.lookup(keys)
+
+    hits = set(hit_positions)
+    missing = {}
+    for position, key in enumerate(keys):
+        if position not in hits:
+            missing.setdefault(key, []).append(position)
+    fresh = None
+    if missing:
+        fresh = encode_documents(
+            model, [texts[positions[0]] for positions in missing.values()], budget
+        )
+        cache.add(list(missing), fresh)
+
+    dimension = (fresh if fresh is not None else hit_vectors).shape[1] if texts else 0
+    embeddings = np.empty((len(texts), dimension), dtype=np.float32)
+    if hit_positions:
+        embeddings[hit_positions] = hit_vectors
+    for vector, positions in zip(fresh if fresh is not None else (), missing.values()):
+        embeddings[positions] = vector
+    return embeddings
+
+
+def embed_stream(
+    model, rows, text_index=-1, window=EMBED_WINDOW, cache=None
+):
+    """
+    Embed an iterable of rows (e.g. a server-side cursor) window by window.
+    Yields (rows, embeddings) per window; the text is row[text_index].
+    With an EmbeddingCache, only texts it has never seen are encoded.
+    """
+    budget = token_budget(model)
+    logger.info(f"Embedding on {model.device} with a budget of {budget} tokens per batch")
+    rows = iter(rows)
+    while True:
+        batch_rows = list(islice(rows, window))
+        if not batch_rows:
+            return
+        texts = [row[text_index] or "" for row in batch_rows]
+        if cache is None:
+            yield batch_rows, encode_documents(model, texts, budget)
+        else:
+            yield batch_rows, encode_cached(model, texts, cache, budget)
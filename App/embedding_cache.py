@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from contextlib import contextmanager
+import numpy as np
+from logger_config import setup_logger
+
+logger = setup_logger("embedding_cache")
+
+CACHE_ROOT = os.getenv("EMBEDDING_CACHE_ROOT", "./embedding_cache")
+
+# ----------------------------------------
+# ON-DISK LAYOUT
+# ----------------------------------------
+#
+# embedding_cache/<model slug>/
+#     meta.json     -> model name and embedding dimension
+#     vectors.f16   -> normalized embeddings, one float16 row per key
+#     keys.txt      -> sha256 of the normalized text of every row, in row order
+#     lock          -> locked by writers (flock, or msvcrt on Windows)
+#
+# Both data files are append-only. A writer appends the vectors first and
+# the keys second, so a key always points at a complete row; a row without a
+# key (a writer killed in between) is ignored and overwritten by the next
+# append. Readers memory-map vectors.f16, so only the rows looked up are
+# paged in.
+
+
+def normalize_text(text):
+    """
+    Texts that only differ in unicode form or whitespace share an entry.
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def text_key(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def cache_path(model_name):
+    return os.path.join(CACHE_ROOT, re.sub(r"[^A-Za-z0-9._-]+", "_", model_name))
+
+
+class EmbeddingCache:
+    """
+    Content-addressed store of the embeddings of one model, keyed by the hash
+    of the normalized text.
+    """
+
+    def __init__(self, model_name, path=None):
+        self.model_name = model_name
+        self.path = path or cache_path(model_name)
+        self.dimension = None
+        self._rows = {}
+        self._row_count = 0
+        self._keys_read = 0
+        self._vectors = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        meta_path = os.path.join(self.path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta["model_name"] != model_name:
+                raise ValueError(
+                    f"{self.path} holds embeddings of {meta['model_name']}, not {model_name}"
+                )
+            self.dimension = meta["dimension"]
+        self._refresh()
+        logger.info(f"Embedding cache for {model_name}: {len(self._rows)} vectors")
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _writer_lock(self):
+        """
+        Exclusive lock between writer processes: flock on POSIX, a locked
+        first byte of the lock file on Windows.
+        """
+        with open(self._file("lock"), "a+") as lock:
+            try:
+                import fcntl
+            except ImportError:
+                import msvcrt
+
+                lock.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK gives up after 10 seconds, keep waiting
+                        continue
+                try:
+                    yield
+                finally:
+                    lock.seek(0)
+                    msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+                return
+
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """
+        Read the keys appended since the last refresh (by this process or
+        another one) and re-map the vectors.
+        """
+        if self.dimension is None or not os.path.exists(self._file("keys.txt")):
+            return
+        with open(self._file("keys.txt"), "rb") as f:
+            f.seek(self._keys_read)
+            appended = f.read()
+        # only complete lines; a partial key is read again next time
+        appended = appended[: appended.rfind(b"\n") + 1]
+        if not appended:
+            return
+        self._keys_read += len(appended)
+        for key in appended.decode("ascii").splitlines():
+            self._rows.setdefault(key, self._row_count)
+            self._row_count += 1
+        self._vectors = np.memmap(
+            self._file("vectors.f16"),
+            dtype=np.float16,
+            mode="r",
+            shape=(self._row_count, self.dimension),
+        )
+
+    def lookup(self, keys):
+        """
+        Return (positions, vectors): the positions in keys that are cached,
+        and their vectors as float32.
+        """
+        with self._lock:
+            positions = [i for i, key in enumerate(keys) if key in self._rows]
+            vectors = (
+                np.asarray(
+                    self._vectors[[self._rows[keys[i]] for i in positions]],
+                    dtype=np.float32,
+                )
+                if positions
+                else None
+            )
+            self.hits += len(positions)
+            self.misses += len(keys) - len(positions)
+        return positions, vectors
+
+    def add(self, keys, vectors):
+        """
+        Append the vectors of keys that are not cached yet.
+        """
+        vectors = np.asarray(vectors, dtype=np.float16)
+        with self._lock, self._writer_lock():
+            if self.dimension is None:
+                self.dimension = vectors.shape[1]
+                with open(self._file("meta.json"), "w") as f:
+                    json.dump(
+                        {"model_name": self.model_name, "dimension": self.dimension}, f
+                    )
+            elif vectors.shape[1] != self.dimension:
+                raise ValueError(
+                    f"Embedding dimension {vectors.shape[1]} does not match the cache's {self.dimension}"
+                )
+            # pick up rows other processes appended, so keys are not duplicated
+            self._refresh()
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in self._rows and key not in new:
+                    new[key] = vector
+            if not new:
+                return 0
+
+            row_bytes = self.dimension * np.dtype(np.float16).itemsize
+            with open(self._file("vectors.f16"), "ab") as f:
+                # drop a row left without a key by an interrupted writer
+                f.truncate(self._row_count * row_bytes)
+                f.write(np.stack(list(new.values())).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self._file("keys.txt"), "ab") as f:
+                # and a partial key, which would glue onto the next one
+                f.truncate(self._keys_read)
+                f.write("".join(key + "\n" for key in new).encode("ascii"))
+            self._refresh()
+        return len(new)
+
+    def log_stats(self, prefix=""):
+        total = self.hits + self.misses
+        logger.info(
+            f"{prefix}Embedding cache: {self.hits} hits, {self.misses} misses "
+            f"({100 * self.hits / total if total else 0:.1f}% hit rate), "
+            f"{len(self._rows)} vectors stored"
+        )
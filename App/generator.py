@@ -1,12 +1,43 @@
 from utils import *
+import os
+import threading
 import ollama
-from retriever import retrieve_context, rerank_chunks
+from time import perf_counter
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
+from retriever import (
+    retrieve_ranked_chunks,
+    rerank_chunks,
+    encode_query,
+    max_chapter_of_chunks,
+)
+from answer_cache import answer_cache
+from think_stripper import ThinkStripper
 from logger_config import setup_logger
 
 logger = setup_logger("generator")
 
+# Set when the model's chat template opens the <think> block in the prompt,
+# so replies only carry the closing tag (see ThinkStripper)
+THINK_OPENED_BY_TEMPLATE = os.getenv("THINK_OPENED_BY_TEMPLATE", "0") == "1"
 
-def generate_response(query: str, novel_name: str, model, spoiler_threshold=None):
+# Runs retrieve_ranked_chunks while the request thread encodes the query;
+# separate from the retrieval pool its branches run on, so they never wait
+# on each other's workers
+_request_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("REQUEST_WORKERS", "8")),
+    thread_name_prefix="request",
+)
+
+
+def generate_response_stream(
+    query: str, novel_name: str, model, spoiler_threshold=None
+):
+    """
+    Yield the visible answer as it is generated, piece by piece, with the
+    reasoning trace removed on the fly.
+    """
+    start = perf_counter()
 
     system_prompt = """You are a RAG system designed to answer questions about novels using only the retrieved excerpts from the book. Your responses must be grounded in the supplied content, without guessing or adding external information.
 
@@ -21,15 +52,53 @@ Answering Guidelines:
 - No Speculation: Avoid guessing or interpreting events or character motivations beyond what’s supported in the text."""
 
 
+    # Retrieval starts right away, so BM25 runs while the query is encoded
+    # here for the answer cache; the dense branch waits on the same encoding
+    # (and its wait counts against CHROMA_TIMEOUT). The vector is only handed
+    # over after the cache lookup: on a hit it is withdrawn and the retrieval
+    # cancelled, so the dense search and the chunk fetch never run.
+    query_vector_future = Future()
+    cancelled = threading.Event()
     logger.info(f"Retrieving chunks for {query} from {novel_name}...")
-    retrieved_chunks = retrieve_context(
-        query, novel_name, model, spoiler_threshold, k=10
+    retrieval = _request_pool.submit(
+        retrieve_ranked_chunks,
+        query,
+        novel_name,
+        model,
+        spoiler_threshold,
+        k=10,
+        query_vector=query_vector_future,
+        cancelled=cancelled,
     )
+    encode_start = perf_counter()
+    try:
+        query_vector = encode_query(model, query)
+    except Exception as e:
+        query_vector_future.set_exception(e)
+        raise
+    metrics.observe("generation.query_encode", perf_counter() - encode_start)
+
+    try:
+        cached_answer = answer_cache.lookup(novel_name, spoiler_threshold, query_vector)
+    except Exception as e:
+        query_vector_future.set_exception(e)
+        raise
+    if cached_answer is not None:
+        cancelled.set()
+        query_vector_future.cancel()
+        retrieval.cancel()
+        logger.info(f"Returning cached answer for {query} from {novel_name}")
+        metrics.observe("generation.time_to_first_token", perf_counter() - start)
+        yield cached_answer
+        return
+    query_vector_future.set_result(query_vector)
+
+    retrieved_chunks = retrieval.result()
 
     logger.info(f"Reranking chunks for {query} from {novel_name}...")
     reranked_chunks = rerank_chunks(query, retrieved_chunks)
 
-    context = "\n\n".join(reranked_chunks)
+    context = "\n\n".join(content for _, _, content in reranked_chunks)
 
     rag_prompt = f"""Context:
 \"\"\"
@@ -43,17 +112,52 @@ Answer:"""
 
     # Generate the response using the Ollama model
     logger.info(f"Sending query to the model for {query} from {novel_name}...")
-    response = ollama.chat(
+    stream = ollama.chat(
         model="deepseek-r1:7b",
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": rag_prompt},
         ],
+        stream=True,
     )
+
+    stripper = ThinkStripper(thinking=THINK_OPENED_BY_TEMPLATE)
+    raw_response = []
+    answer = []
+    first_token_time = None
+    for part in stream:
+        content = part["message"]["content"]
+        raw_response.append(content)
+        visible = stripper.feed(content)
+        if visible:
+            if first_token_time is None:
+                first_token_time = perf_counter() - start
+                metrics.observe("generation.time_to_first_token", first_token_time)
+                logger.info(f"Time to first visible token: {first_token_time:.2f}s")
+            answer.append(visible)
+            yield visible
+    rest = stripper.flush()
+    if rest:
+        answer.append(rest)
+        yield rest
+
+    metrics.observe("generation.total_time", perf_counter() - start)
     logger.info(f"Received response from the model for {query} from {novel_name}...")
-    logger.info(f"Response: {response['message']['content']}")
-    if "</think>" in response["message"]["content"]:
-        # If the response contains "<\\think>", split and return the second part
-        return response["message"]["content"].split("</think>")[-1].strip()
-    else:
-        return response["message"]["content"].strip()
+    logger.info(f"Response: {''.join(raw_response)}")
+    answer = "".join(answer).strip()
+
+    # only answers grounded in retrieved chapters can be checked against spoilers
+    max_chapter = max_chapter_of_chunks([chunk_id for chunk_id, _, _ in reranked_chunks])
+    if max_chapter is not None:
+        answer_cache.store(
+            novel_name, spoiler_threshold, query_vector, answer, max_chapter
+        )
+
+
+def generate_response(query: str, novel_name: str, model, spoiler_threshold=None):
+    """
+    Return the complete answer at once.
+    """
+    return "".join(
+        generate_response_stream(query, novel_name, model, spoiler_threshold)
+    ).strip()
@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import numpy as np
+
+# ----------------------------------------
+# VERSIONED ON-DISK INDEXES
+# ----------------------------------------
+#
+# Shared by bm25_index and vector_index:
+#
+# <index path>/
+#     CURRENT      -> name of the live version directory
+#     v<n>/...     -> JSON files and .npy arrays of one version
+#
+# An update writes a complete new version directory and then atomically
+# replaces CURRENT, so a reader never sees a half-written index. Readers
+# reopen an index only when CURRENT names a new version.
+
+
+def read_current_version(path):
+    try:
+        with open(os.path.join(path, "CURRENT")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_new_version(path, json_files, arrays):
+    """
+    Write json_files ({name: object} saved as <name>.json) and arrays
+    ({name: array} saved as <name>.npy) as the next version of the index at
+    path, swap it in and remove the previous one. Returns the new version.
+    """
+    previous = read_current_version(path)
+    version = f"v{int(previous.lstrip('v')) + 1}" if previous else "v1"
+
+    version_dir = os.path.join(path, version)
+    os.makedirs(version_dir, exist_ok=True)
+    for name, value in json_files.items():
+        with open(os.path.join(version_dir, f"{name}.json"), "w") as f:
+            json.dump(value, f)
+    for name, array in arrays.items():
+        np.save(os.path.join(version_dir, f"{name}.npy"), array)
+
+    tmp_current = os.path.join(path, "CURRENT.tmp")
+    with open(tmp_current, "w") as f:
+        f.write(version)
+    os.replace(tmp_current, os.path.join(path, "CURRENT"))
+
+    # Readers that still hold the old version keep their mmaps after unlink
+    if previous and previous != version:
+        shutil.rmtree(os.path.join(path, previous), ignore_errors=True)
+    return version
+
+
+class LiveIndexes:
+    """
+    Per-process cache of the live version of each collection's index.
+
+    load(path) opens the live version (an object with a .version), and
+    index_path(collection_name) locates it.
+    """
+
+    def __init__(self, load, index_path):
+        self.load = load
+        self.index_path = index_path
+        self._loaded = {}
+
+    def get(self, collection_name):
+        """
+        Return the live index for a collection, reopening it only when an
+        update has swapped in a new version.
+        """
+        path = self.index_path(collection_name)
+        version = read_current_version(path)
+        if version is None:
+            return None
+        cached = self._loaded.get(collection_name)
+        if cached is None or cached.version != version:
+            cached = self.load(path)
+            self._loaded[collection_name] = cached
+        return cached
@@ -1,145 +1,359 @@
-import chromadb
-import numpy as np
-from tqdm import tqdm
-from sentence_transformers import SentenceTransformer
 from time import time
-from utils import preprocess, get_novel_id, get_db_connection
+import numpy as np
+from utils import (
+    preprocess_many,
+    get_novel_id,
+    collection_name_from_title,
+    CHUNK_TEXT_SQL,
+    CHUNK_IS_CURRENT_SQL,
+    PREPROCESS_MODE,
+)
+from resources import (
+    db_connection,
+    get_collection,
+    has_chapter_numbers,
+    CHAPTER_NUMBER_METADATA,
+)
+from embedder import EMBED_WINDOW, embed_stream, get_embedding_model
+from embedding_cache import EmbeddingCache
+from vector_index import (
+    VectorIndex,
+    VECTOR_PRECISION,
+    index_path as vector_index_path,
+    write_index as write_vector_index,
+)
+from bulk import batches, copy_update
+from bm25_index import BM25Index, index_path, update_index
 from logger_config import setup_logger
 
 logger = setup_logger("indexer")
 
 
-def collection_name_from_title(novel_title):
-    # Remove spaces and special characters from the novel title
-    collection_name = "".join(e.lower() for e in novel_title if e.isalnum())
-    return collection_name
-
-
 def indexing_novel_chunks_chroma(
-    novel_title, embedding_model="mixedbread-ai/mxbai-embed-large-v1"
+    novel_title, embedding_model="mixedbread-ai/mxbai-embed-large-v1", use_cache=True
 ):
+    """
+    Bring the Chroma collection of a novel up to date: drop the vectors of
+    chunks queued in stale_chunks, and embed the chunks not yet embedded with
+    embedding_model (tracked in chunks.embedding_model).
 
-    # mixedbread-ai/mxbai-embed-large-v1 is hardcoded could be passed as an argument from .env file
-    model = SentenceTransformer(embedding_model, device="cuda")
-
-    # create a new chroma collection
-    collection_name = collection_name_from_title(novel_title)
-
-    chroma_client = chromadb.PersistentClient()
+    With use_cache, chunk texts embedded before (by any novel, chunking or
+    collection) are read from the on-disk EmbeddingCache instead of encoded.
+    """
 
-    collection = chroma_client.get_or_create_collection(name=collection_name)
-
-    ids_in_chroma = collection.get()["ids"]
-    logger.info(f"Number of IDs already in Chroma: {len(ids_in_chroma)}")
-
-    # connect to the database and fetch the chunks
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    novel_id = get_novel_id(novel_title, cursor)
-    logger.info(f"Novel ID for {novel_title}: {novel_id}")
-
-    # Fetch the chunks from the database
-    cursor.execute(
-        "SELECT id, chapter_id, chunk_content FROM chunks WHERE novel_id = %s",
-        (novel_id,),
-    )
-
-    chunks = cursor.fetchall()
-    logger.info(f"Number of chunks for novel {novel_title}: {len(chunks)}")
-
-    chunks = [chunk for chunk in chunks if str(chunk[0]) not in ids_in_chroma]
-
-    if len(chunks) == 0:
+    # mixedbread-ai/mxbai-embed-large-v1 is hardcoded could be passed as an argument from .env file
+    model = get_embedding_model(embedding_model)
+
+    collection = get_collection(novel_title)
+    cache = EmbeddingCache(embedding_model) if use_cache else None
+
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            novel_id = get_novel_id(novel_title, cursor)
+            logger.info(f"Novel ID for {novel_title}: {novel_id}")
+
+            remove_stale_vectors(cursor, conn, collection, novel_id)
+            backfill_chapter_numbers(cursor, collection, novel_id)
+            adopt_embedded_chunks(cursor, conn, collection, novel_id, embedding_model)
+
+        # stream the chunks that still need a vector; withhold keeps the
+        # server-side cursor open across the per-window commits
+        added = 0
+        start = time()
+        with conn.cursor(name="chroma_chunks", withhold=True) as stream, conn.cursor() as cursor:
+            stream.itersize = EMBED_WINDOW
+            stream.execute(
+                f"SELECT chunks.id, chunks.chapter_id, chapters.chapter_number, {CHUNK_TEXT_SQL} FROM chunks JOIN chapters ON chunks.chapter_id = chapters.id WHERE chunks.novel_id = %s AND chunks.embedding_model IS DISTINCT FROM %s AND {CHUNK_IS_CURRENT_SQL}",
+                (novel_id, embedding_model),
+            )
+            for rows, embeddings in embed_stream(model, stream, cache=cache):
+                ids = [row[0] for row in rows]
+
+                # upsert: a chunk re-embedded with another model keeps its id
+                collection.upsert(
+                    embeddings=embeddings.tolist(),
+                    ids=[str(id) for id in ids],
+                    metadatas=[
+                        {"chapter_id": row[1], "chapter_number": row[2]} for row in rows
+                    ],
+                )
+                cursor.execute(
+                    "UPDATE chunks SET embedding_model = %s WHERE id = ANY(%s)",
+                    (embedding_model, ids),
+                )
+                conn.commit()
+                added += len(rows)
+                logger.info(
+                    f"Embedded {added} chunks ({added / (time() - start):.1f} docs/s)"
+                )
+                if cache is not None:
+                    cache.log_stats()
+
+    if added == 0:
         logger.info("No new chunks to add to the collection.")
         return
 
-    logger.info(f"Number of chunks to be added to Chroma: {len(chunks)}")
-
-    ids, chapter_ids, documents = map(list, zip(*chunks))
-    ids = [str(id) for id in ids]
-
-    # create normalized embeddings
-    chroma_batch_size = 1024
-
-    ids_batches = [
-        ids[i : i + chroma_batch_size] for i in range(0, len(ids), chroma_batch_size)
-    ]
-    chapter_ids_batches = [
-        chapter_ids[i : i + chroma_batch_size]
-        for i in range(0, len(chapter_ids), chroma_batch_size)
-    ]
-    documents_batches = [
-        documents[i : i + chroma_batch_size]
-        for i in range(0, len(documents), chroma_batch_size)
-    ]
-
-    for ids_batch, chapter_ids_batch, documents_batch in tqdm(
-        zip(ids_batches, chapter_ids_batches, documents_batches),
-        total=len(ids_batches),
-        desc="Encoding chunks",
-    ):
-        embeddings = model.encode(documents_batch, convert_to_numpy=True, batch_size=32)
-        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
-
-        collection.add(
-            embeddings=embeddings.tolist(),
-            ids=ids_batch,
-            metadatas=[{"chapter_id": chapter_id} for chapter_id in chapter_ids_batch],
-        )
-
     logger.info("Done adding chunks to the collection.")
 
-    cursor.close()
-    conn.close()
-
     return
 
 
-def indexing_novel_chunks_bm25(novel_title):
-
-    # connect to the database and fetch the chunks
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    novel_id = get_novel_id(novel_title, cursor)
-    logger.info(f"Novel ID for {novel_title}: {novel_id}")
-
-    # Fetch the chunks from the database
+def remove_stale_vectors(cursor, conn, collection, novel_id):
+    """
+    Delete the vectors of chunks deleted by re-chunking, then clear them
+    from stale_chunks.
+    """
     cursor.execute(
-        "SELECT id, chunk_content FROM chunks WHERE novel_id = %s", (novel_id,)
+        "SELECT chunk_id FROM stale_chunks WHERE novel_id = %s", (novel_id,)
     )
+    stale_ids = [row[0] for row in cursor.fetchall()]
+    if not stale_ids:
+        return
+    logger.info(f"Removing {len(stale_ids)} stale vectors from Chroma")
+    collection.delete(ids=[str(id) for id in stale_ids])
+    cursor.execute("DELETE FROM stale_chunks WHERE chunk_id = ANY(%s)", (stale_ids,))
+    conn.commit()
 
-    chunks = cursor.fetchall()
-    logger.info(f"Number of chunks for novel {novel_title}: {len(chunks)}")
 
-    if len(chunks) == 0:
-        logger.warning(f"No chunks found for novel {novel_title}.")
+def backfill_chapter_numbers(cursor, collection, novel_id):
+    """
+    Collections filled before chapter_number was stored next to chapter_id:
+    add it to the metadata of every vector once, then flag the collection so
+    the retriever filters spoilers on chapter numbers.
+    """
+    if has_chapter_numbers(collection):
         return
+    ids_in_chroma = [int(id) for id in collection.get(include=[])["ids"]]
+    if ids_in_chroma:
+        cursor.execute(
+            "SELECT chunks.id, chunks.chapter_id, chapters.chapter_number FROM chunks JOIN chapters ON chunks.chapter_id = chapters.id WHERE chunks.novel_id = %s AND chunks.id = ANY(%s)",
+            (novel_id, ids_in_chroma),
+        )
+        rows = cursor.fetchall()
+        logger.info(f"Adding chapter numbers to the metadata of {len(rows)} vectors")
+        # Chroma caps the size of a single update
+        for batch in batches(rows, 5_000):
+            collection.update(
+                ids=[str(row[0]) for row in batch],
+                metadatas=[
+                    {"chapter_id": row[1], "chapter_number": row[2]} for row in batch
+                ],
+            )
+    # hnsw:* settings cannot be passed to modify, they stay as they are
+    metadata = {
+        key: value
+        for key, value in (collection.metadata or {}).items()
+        if not key.startswith("hnsw:")
+    }
+    collection.modify(metadata={**metadata, CHAPTER_NUMBER_METADATA: True})
+
+
+def adopt_embedded_chunks(cursor, conn, collection, novel_id, embedding_model):
+    """
+    Collections filled before chunks.embedding_model was tracked: mark the
+    chunks already in Chroma once, so they are not embedded again. This is
+    the only time every ID of the collection is downloaded.
+    """
+    cursor.execute(
+        "SELECT EXISTS (SELECT 1 FROM chunks WHERE novel_id = %s AND embedding_model IS NOT NULL)",
+        (novel_id,),
+    )
+    if cursor.fetchone()[0] or collection.count() == 0:
+        return
+    ids_in_chroma = [int(id) for id in collection.get(include=[])["ids"]]
+    logger.info(f"Marking {len(ids_in_chroma)} chunks already in Chroma as embedded")
+    cursor.execute(
+        "UPDATE chunks SET embedding_model = %s WHERE novel_id = %s AND id = ANY(%s)",
+        (embedding_model, novel_id, ids_in_chroma),
+    )
+    conn.commit()
 
-    ids, documents = map(list, zip(*chunks))
 
-    logger.info("Tokenizing documents...")
-    tokenized_docs = [preprocess(doc) for doc in documents]
-    logger.info("Done tokenizing documents.")
+def indexing_novel_chunks_vectors(
+    novel_title,
+    embedding_model="mixedbread-ai/mxbai-embed-large-v1",
+    precision=VECTOR_PRECISION,
+    use_cache=True,
+):
+    """
+    Bring the local memory-mapped vector index of a novel (see
+    vector_index.py) up to date. Rows of chunks that still exist are carried
+    over from the live version, only new chunks are embedded (through the
+    EmbeddingCache with use_cache), and a new version sorted by chapter is
+    written.
+    """
+    path = vector_index_path(collection_name_from_title(novel_title))
+    index = VectorIndex.load(path)
+    if index is not None and (
+        index.model_name != embedding_model or index.precision != precision
+    ):
+        logger.info(
+            f"Vector index holds {index.model_name} ({index.precision}), rebuilding with {embedding_model} ({precision})"
+        )
+        index = None
+
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            novel_id = get_novel_id(novel_title, cursor)
+            # the same filter as the embedding query below: a chunk with
+            # stale offsets would count as new on every run without ever
+            # being embedded
+            cursor.execute(
+                f"SELECT chunks.id, chapters.chapter_number FROM chunks JOIN chapters ON chunks.chapter_id = chapters.id WHERE chunks.novel_id = %s AND {CHUNK_IS_CURRENT_SQL}",
+                (novel_id,),
+            )
+            chapters_by_id = dict(cursor.fetchall())
+
+        if not chapters_by_id:
+            logger.warning(f"No chunks found for novel {novel_title}.")
+            return
+
+        kept_ids, kept_rows = [], []
+        if index is not None:
+            for row, chunk_id in enumerate(index.doc_ids.tolist()):
+                if chunk_id in chapters_by_id:
+                    kept_ids.append(chunk_id)
+                    kept_rows.append(row)
+        new_ids = sorted(set(chapters_by_id) - set(kept_ids))
+        removed = (index.num_docs if index is not None else 0) - len(kept_ids)
+        logger.info(
+            f"Vector index: {len(kept_ids)} chunks kept, {len(new_ids)} to embed, {removed} removed"
+        )
+        if not new_ids and not removed:
+            logger.info("Vector index is up to date.")
+            return
+
+        ids = list(kept_ids)
+        embeddings = [index.embeddings(kept_rows)] if kept_rows else []
+        if new_ids:
+            model = get_embedding_model(embedding_model)
+            cache = EmbeddingCache(embedding_model) if use_cache else None
+            start = time()
+            with conn.cursor(name="vector_chunks") as stream:
+                stream.itersize = EMBED_WINDOW
+                stream.execute(
+                    f"SELECT chunks.id, {CHUNK_TEXT_SQL} FROM chunks JOIN chapters ON chunks.chapter_id = chapters.id WHERE chunks.id = ANY(%s) AND {CHUNK_IS_CURRENT_SQL}",
+                    (new_ids,),
+                )
+                for rows, window_embeddings in embed_stream(
+                    model, stream, cache=cache
+                ):
+                    ids.extend(row[0] for row in rows)
+                    embeddings.append(window_embeddings)
+                    logger.info(
+                        f"Embedded {len(ids) - len(kept_ids)} chunks ({(len(ids) - len(kept_ids)) / (time() - start):.1f} docs/s)"
+                    )
+            if cache is not None:
+                cache.log_stats()
 
-    # store the tokenized documents in the database
-    # timing this
     time_start = time()
-    for doc_id, tokens in zip(ids, tokenized_docs):
-        cursor.execute(
-            "UPDATE chunks SET preprocessed_chunk_content = %s WHERE id = %s",
-            (tokens, doc_id),
-        )
-    time_end = time()
+    version = write_vector_index(
+        path,
+        ids,
+        [chapters_by_id[chunk_id] for chunk_id in ids],
+        np.concatenate(embeddings),
+        embedding_model,
+        precision,
+    )
     logger.info(
-        f"Time taken to store tokenized documents: {time_end - time_start} seconds"
+        f"Wrote vector index {version} ({len(ids)} chunks) in {time() - time_start:.1f} seconds"
     )
-    conn.commit()
-    logger.info("Done storing tokenized documents.")
 
-    cursor.close()
-    conn.close()
 
-    return
+def indexing_novel_chunks_bm25(novel_title, preprocess_mode=PREPROCESS_MODE):
+
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            novel_id = get_novel_id(novel_title, cursor)
+            logger.info(f"Novel ID for {novel_title}: {novel_id}")
+
+            # diff the chunk IDs against the on-disk index, so only the text
+            # of new chunks is fetched and processed
+            cursor.execute("SELECT id FROM chunks WHERE novel_id = %s", (novel_id,))
+            db_ids = set(row[0] for row in cursor.fetchall())
+            logger.info(f"Number of chunks for novel {novel_title}: {len(db_ids)}")
+
+            if len(db_ids) == 0:
+                logger.warning(f"No chunks found for novel {novel_title}.")
+                return
+
+            path = index_path(collection_name_from_title(novel_title))
+            index = BM25Index.load(path)
+            # tokens from another preprocess mode cannot be mixed in one index
+            rebuild = index is not None and index.preprocess_mode != preprocess_mode
+            if rebuild:
+                logger.info(
+                    f"BM25 index was built in {index.preprocess_mode} mode, rebuilding in {preprocess_mode} mode"
+                )
+            indexed_ids = set(int(i) for i in index.doc_ids) if index and not rebuild else set()
+            removed_ids = indexed_ids - db_ids
+
+            cursor.execute(
+                f"SELECT chunks.id, chapters.chapter_number, {CHUNK_TEXT_SQL}, chunks.preprocessed_chunk_content, chunks.preprocess_mode FROM chunks JOIN chapters ON chunks.chapter_id = chapters.id WHERE chunks.id = ANY(%s) AND {CHUNK_IS_CURRENT_SQL}",
+                (sorted(db_ids - indexed_ids),),
+            )
+            new_chunks = cursor.fetchall()
+            logger.info(
+                f"Chunks to add to the BM25 index: {len(new_chunks)}, stale chunks to remove: {len(removed_ids)}"
+            )
+
+            if not new_chunks and not removed_ids:
+                logger.info("BM25 index is up to date.")
+                return
+
+            # stored tokens are only reused when they are known to come from
+            # this mode; tokens stored before the mode was recorded may be
+            # lemmas of another one
+            to_tokenize = [
+                chunk
+                for chunk in new_chunks
+                if rebuild or chunk[3] is None or chunk[4] != preprocess_mode
+            ]
+
+            logger.info(f"Tokenizing {len(to_tokenize)} documents ({preprocess_mode} mode)...")
+            time_start = time()
+            tokens_list = preprocess_many(
+                [doc for _, _, doc, _, _ in to_tokenize], mode=preprocess_mode
+            )
+            tokenized = {chunk[0]: tokens for chunk, tokens in zip(to_tokenize, tokens_list)}
+            logger.info(
+                f"Done tokenizing documents in {time() - time_start:.1f} seconds."
+            )
+
+            # store the tokenized documents in the database, one COPY and
+            # set-based UPDATE per batch
+            time_start = time()
+            token_rows = [
+                (doc_id, tokens, preprocess_mode) for doc_id, tokens in tokenized.items()
+            ]
+            for batch in batches(token_rows):
+                copy_update(
+                    cursor,
+                    "chunks",
+                    "id",
+                    ["preprocessed_chunk_content", "preprocess_mode"],
+                    batch,
+                )
+                conn.commit()
+            time_end = time()
+            logger.info(
+                f"Time taken to store tokenized documents: {time_end - time_start} seconds "
+                f"({len(token_rows) / (time_end - time_start) if time_end > time_start else 0:.0f} rows/s)"
+            )
+        conn.commit()
+        logger.info("Done storing tokenized documents.")
+
+    time_start = time()
+    update_index(
+        path,
+        [
+            (doc_id, chapter_number, tokenized.get(doc_id, tokens))
+            for doc_id, chapter_number, _, tokens, _ in new_chunks
+        ],
+        removed_ids=removed_ids,
+        preprocess_mode=preprocess_mode,
+        rebuild=rebuild,
+    )
+    logger.info(f"Time taken to update the BM25 index: {time() - time_start} seconds")
 
+    return
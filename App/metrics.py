@@ -0,0 +1,95 @@
+import threading
+from collections import defaultdict, deque
+import numpy as np
+from logger_config import setup_logger
+
+logger = setup_logger("metrics")
+
+# ----------------------------------------
+# IN-PROCESS METRICS
+# ----------------------------------------
+#
+# Counters and latency observations shared by every module of the process.
+# Observations keep count/sum/max plus the most recent samples, which is
+# enough for p50/p95 without unbounded memory.
+
+SAMPLES_KEPT = 1000
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_observations = {}
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name, value):
+    with _lock:
+        observation = _observations.get(name)
+        if observation is None:
+            observation = _observations[name] = {
+                "count": 0,
+                "sum": 0.0,
+                "max": float("-inf"),
+                "samples": deque(maxlen=SAMPLES_KEPT),
+            }
+        observation["count"] += 1
+        observation["sum"] += value
+        observation["max"] = max(observation["max"], value)
+        observation["samples"].append(value)
+
+
+def get_counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def ratio(numerator, denominator_names):
+    """
+    numerator / sum(denominator_names), or None when nothing was counted.
+    """
+    with _lock:
+        total = sum(_counters.get(name, 0) for name in denominator_names)
+        return _counters.get(numerator, 0) / total if total else None
+
+
+def _summarize(observation):
+    samples = np.fromiter(observation["samples"], dtype=float)
+    return {
+        "count": observation["count"],
+        "mean": observation["sum"] / observation["count"],
+        "p50": float(np.percentile(samples, 50)),
+        "p95": float(np.percentile(samples, 95)),
+        "max": observation["max"],
+    }
+
+
+def summary(name):
+    """
+    count/mean/p50/p95/max of one observation, or None if never observed.
+    """
+    with _lock:
+        observation = _observations.get(name)
+        return _summarize(observation) if observation is not None else None
+
+
+def snapshot():
+    """
+    Return a plain dict of every counter and observation summary.
+    """
+    with _lock:
+        result = dict(_counters)
+        for name, observation in _observations.items():
+            result[name] = _summarize(observation)
+    return result
+
+
+def log_snapshot(prefix=""):
+    """
+    Log every metric whose name starts with prefix.
+    """
+    for name, value in sorted(snapshot().items()):
+        if name.startswith(prefix):
+            logger.info("%s: %s", name, value)
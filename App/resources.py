@@ -0,0 +1,195 @@
+import os
+import threading
+from contextlib import contextmanager
+from psycopg2.pool import ThreadedConnectionPool
+from logger_config import setup_logger
+from utils import db_params, collection_name_from_title
+
+logger = setup_logger("resources")
+
+# ----------------------------------------
+# PROCESS-WIDE RESOURCES
+# ----------------------------------------
+#
+# Everything here is created once per process and shared by every module:
+# the scraper only ever touches the connection pool, so chromadb and
+# sentence_transformers are imported lazily by the getters that need them.
+
+_lock = threading.Lock()
+_pool = None
+_chroma_client = None
+_collections = {}
+_models = {}
+_model_locks = {}
+
+
+# ----------------------------------------
+# DATABASE
+# ----------------------------------------
+
+
+def get_db_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            minconn = int(os.getenv("PG_POOL_MIN", "1"))
+            maxconn = int(os.getenv("PG_POOL_MAX", "10"))
+            logger.info(f"Creating database connection pool ({minconn}-{maxconn})")
+            _pool = ThreadedConnectionPool(minconn, maxconn, **db_params())
+    return _pool
+
+
+@contextmanager
+def db_connection():
+    """
+    Borrow a pooled connection. The transaction is committed when the block
+    exits normally and rolled back if it raises, like `with conn:`.
+    """
+    pool = get_db_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+
+
+# ----------------------------------------
+# CHROMA
+# ----------------------------------------
+
+
+def get_chroma_client():
+    global _chroma_client
+    import chromadb
+
+    with _lock:
+        if _chroma_client is None:
+            logger.info("Starting Chroma client")
+            _chroma_client = chromadb.PersistentClient()
+    return _chroma_client
+
+
+# Collection metadata flag: every vector carries a chapter_number metadata
+# field (see indexer.backfill_chapter_numbers)
+CHAPTER_NUMBER_METADATA = "chapter_number_metadata"
+
+
+def has_chapter_numbers(collection):
+    return bool((collection.metadata or {}).get(CHAPTER_NUMBER_METADATA))
+
+
+def get_collection(novel_title):
+    """
+    Return the Chroma collection of a novel, keyed by collection_name_from_title.
+    """
+    name = collection_name_from_title(novel_title)
+    collection = _collections.get(name)
+    if collection is None:
+        client = get_chroma_client()
+        with _lock:
+            collection = _collections.get(name)
+            if collection is None:
+                collection = client.get_or_create_collection(name=name)
+                _collections[name] = collection
+    return collection
+
+
+def forget_collection(novel_title):
+    """
+    Drop a cached collection handle, e.g. after the collection was deleted.
+    """
+    with _lock:
+        _collections.pop(collection_name_from_title(novel_title), None)
+
+
+# ----------------------------------------
+# MODELS
+# ----------------------------------------
+
+
+def _load_once(key, loader):
+    """
+    Return the cached model for key, calling loader() on first use.
+    """
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    with _lock:
+        model_lock = _model_locks.setdefault(key, threading.Lock())
+    # loading takes seconds, so only callers of the same model wait on it
+    with model_lock:
+        model = _models.get(key)
+        if model is None:
+            model = loader()
+            _models[key] = model
+    return model
+
+
+def resolve_device(device=None):
+    """
+    device=None resolves to cuda when available, as SentenceTransformer does.
+    """
+    import torch
+
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return device
+
+
+def get_model(model_name, device=None, backend="torch", onnx_file=None):
+    """
+    Return a shared SentenceTransformer, keyed by model name, device and
+    backend.
+
+    backend="onnx" runs the model through onnxruntime, and onnx_file picks a
+    specific export inside the model repo (e.g. a quantized one), as for
+    get_cross_encoder.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    device = resolve_device(device)
+
+    def load():
+        logger.info(f"Loading SentenceTransformer {model_name} on {device} ({backend})")
+        model_kwargs = {"file_name": onnx_file} if backend == "onnx" and onnx_file else None
+        return SentenceTransformer(
+            model_name, device=device, backend=backend, model_kwargs=model_kwargs
+        )
+
+    return _load_once(
+        ("sentence_transformer", model_name, device, backend, onnx_file), load
+    )
+
+
+def get_cross_encoder(model_name, device=None, backend="torch", onnx_file=None, max_length=512):
+    """
+    Return a shared CrossEncoder, keyed by model name, device and backend.
+
+    backend="onnx" runs the model through onnxruntime, and onnx_file picks a
+    specific export inside the model repo (e.g. a quantized one) for CPU-only
+    hosts.
+    """
+    from sentence_transformers import CrossEncoder
+
+    device = resolve_device(device)
+
+    def load():
+        logger.info(f"Loading CrossEncoder {model_name} on {device} ({backend})")
+        model_kwargs = {"file_name": onnx_file} if backend == "onnx" and onnx_file else None
+        return CrossEncoder(
+            model_name,
+            device=device,
+            max_length=max_length,
+            backend=backend,
+            model_kwargs=model_kwargs,
+        )
+
+    return _load_once(
+        ("cross_encoder", model_name, device, backend, onnx_file, max_length), load
+    )
@@ -1,174 +1,633 @@
-import chromadb
+import os
+import hashlib
+import threading
 import numpy as np
-from utils import get_db_connection, preprocess, get_novel_id
-from rank_bm25 import BM25Okapi
+from collections import OrderedDict
+from concurrent.futures import (
+    CancelledError,
+    Future,
+    ThreadPoolExecutor,
+    TimeoutError as FuturesTimeout,
+)
+from time import perf_counter
+from utils import (
+    preprocess,
+    collection_name_from_title,
+    timed,
+    CHUNK_TEXT_SQL,
+    CHUNK_IS_CURRENT_SQL,
+)
+from resources import (
+    db_connection,
+    get_collection,
+    forget_collection,
+    get_cross_encoder,
+    get_model,
+    has_chapter_numbers,
+)
+from bm25_index import get_index as get_bm25_index
+from vector_index import get_index as get_vector_index, VECTOR_BACKEND
+import metrics
 from logger_config import setup_logger
 
 logger = setup_logger("retriever")
 
-
-# ----------------------------------------
-# RETRIEVAL - CHROMADB
-# ----------------------------------------
+# Seconds each retrieval branch may take before the answer goes ahead without it
+BM25_TIMEOUT = float(os.getenv("BM25_TIMEOUT", "3"))
+CHROMA_TIMEOUT = float(os.getenv("CHROMA_TIMEOUT", "5"))
+
+# Reciprocal rank fusion constant, 60 is the value from the original RRF paper
+RRF_K = 60
+
+# Cross-encoder reranking, RERANKER_MODEL="" turns it off
+RERANKER_MODEL = os.getenv("RERANKER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_DEVICE = os.getenv("RERANK_DEVICE") or None
+# "onnx" + a quantized export is the fast path on CPU-only hosts,
+# it needs the sentence-transformers[onnx] extra
+RERANK_BACKEND = os.getenv("RERANK_BACKEND", "torch")
+RERANK_ONNX_FILE = os.getenv("RERANK_ONNX_FILE", "onnx/model_qint8_avx512.onnx")
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", "512"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "5"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "10000"))
+
+# Query embedding model of the app; QUERY_BACKEND="onnx" + a quantized export
+# starts and encodes faster on CPU-only hosts (sentence-transformers[onnx] extra)
+QUERY_MODEL = os.getenv("QUERY_MODEL", "mixedbread-ai/mxbai-embed-large-v1")
+QUERY_DEVICE = os.getenv("QUERY_DEVICE") or None
+QUERY_BACKEND = os.getenv("QUERY_BACKEND", "torch")
+QUERY_ONNX_FILE = os.getenv("QUERY_ONNX_FILE", "onnx/model_quantized.onnx")
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+QUERY_PROMPT = "Represent this sentence for searching relevant passages: "
+
+_query_cache = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+_rerank_cache = OrderedDict()
+_rerank_cache_lock = threading.Lock()
+
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "8"))
+_retrieval_pool = ThreadPoolExecutor(
+    max_workers=RETRIEVAL_WORKERS,
+    thread_name_prefix="retrieval",
+)
+# Timed-out branches still holding a retrieval worker
+_abandoned_branches = 0
+_abandoned_lock = threading.Lock()
 
 
 def get_chunk_from_id(chunk_id_list):
     """
-    Fetch the chunk content from the database using the chunk ID.
+    Fetch the chunk content from the database using the chunk ID. Chunks of
+    chapters rewritten since they were chunked are skipped.
     """
     if not chunk_id_list:
         logger.warning("No chunk IDs provided.")
         return []
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     ids_tuple = tuple([int(id) for id in chunk_id_list])
 
-    cursor.execute("SELECT chunk_content FROM chunks WHERE id in %s", (ids_tuple,))
-
-    results = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    if len(results) == len(chunk_id_list):
-        chunks_content = [row[0] for row in results]
-        return chunks_content
-    else:
-        logger.warning("Some or all chunk IDs not found in the database.")
-        return []
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {CHUNK_TEXT_SQL} FROM chunks JOIN chapters ON chunks.chapter_id = chapters.id WHERE chunks.id in %s AND {CHUNK_IS_CURRENT_SQL}",
+                (ids_tuple,),
+            )
+            results = cursor.fetchall()
+
+    if len(results) < len(chunk_id_list):
+        logger.warning(
+            "%s of %s chunk IDs not found in the database or stale.",
+            len(chunk_id_list) - len(results),
+            len(chunk_id_list),
+        )
+    return [row[0] for row in results]
 
 
-def collection_name_from_title(novel_title):
+def fetch_chunks(chunk_ids):
     """
-    Generate a collection name based on the novel title.
+    Fetch the content of the given chunks in one query, keeping the order of
+    chunk_ids. Returns (chunk_id, content) pairs and skips missing chunks
+    and chunks of chapters rewritten since they were chunked.
     """
-    # Remove spaces and special characters from the novel title
-    collection_name = "".join(e.lower() for e in novel_title if e.isalnum())
-    return collection_name
+    if not chunk_ids:
+        return []
+
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"SELECT chunks.id, {CHUNK_TEXT_SQL} FROM chunks JOIN chapters ON chunks.chapter_id = chapters.id WHERE chunks.id = ANY(%s) AND {CHUNK_IS_CURRENT_SQL}",
+                ([int(id) for id in chunk_ids],),
+            )
+            contents = dict(cursor.fetchall())
+
+    if len(contents) < len(chunk_ids):
+        logger.warning(
+            "%s of %s chunk IDs not found in the database or stale.",
+            len(chunk_ids) - len(contents),
+            len(chunk_ids),
+        )
+    return [(int(id), contents[int(id)]) for id in chunk_ids if int(id) in contents]
+
+
+# ----------------------------------------
+# RETRIEVAL - CHROMADB
+# ----------------------------------------
 
 
-def retrieve_context_chroma(query, novel_name, model, spoiler_threshold=None, k=5):
+def load_query_model(
+    model_name=QUERY_MODEL, device=QUERY_DEVICE, backend=QUERY_BACKEND, onnx_file=QUERY_ONNX_FILE
+):
     """
-    Retrieve the top k most similar chunks from the index based on the query.
+    Load the shared query embedding model. If the ONNX export cannot be
+    loaded (e.g. onnxruntime is missing), fall back to the torch model.
     """
+    start = perf_counter()
+    try:
+        model = get_model(model_name, device=device, backend=backend, onnx_file=onnx_file)
+    except Exception as e:
+        if backend == "torch":
+            raise
+        logger.error("Could not load %s with %s, using torch: %s", model_name, backend, e)
+        model = get_model(model_name, device=device)
+    metrics.observe("query_model.load_seconds", perf_counter() - start)
+    return model
+
+
+def warm_up(model):
+    """
+    Run the first, slow inference of the query model and the reranker at
+    startup instead of on the first question.
+    """
+    start = perf_counter()
+    model.encode(QUERY_PROMPT + "Who is the main character?")
+    if RERANKER_MODEL:
+        try:
+            get_cross_encoder(
+                RERANKER_MODEL,
+                device=RERANK_DEVICE,
+                backend=RERANK_BACKEND,
+                onnx_file=RERANK_ONNX_FILE,
+                max_length=RERANK_MAX_LENGTH,
+            ).predict([("Who is the main character?", "The story begins.")])
+        except Exception as e:
+            logger.error("Could not warm up reranker %s: %s", RERANKER_MODEL, e)
+    elapsed = perf_counter() - start
+    metrics.observe("query_model.warmup_seconds", elapsed)
+    logger.info("Warm-up done in %.2fs", elapsed)
+
+
+def encode_query(model, query):
+    """
+    Encode a question into the normalized query embedding used for search.
 
-    query_prompt = "Represent this sentence for searching relevant passages: "
-
-    # Encode the query
-    query_vector = model.encode(query_prompt + query)
+    Embeddings are cached per model and normalized question (LRU), so
+    repeated questions and retries skip the model. The returned vector is
+    read-only since it is shared.
+    """
+    key = (id(model), " ".join(query.split()))
+    with _query_cache_lock:
+        query_vector = _query_cache.get(key)
+        if query_vector is not None:
+            _query_cache.move_to_end(key)
+    if query_vector is not None:
+        metrics.increment("query_cache.hits")
+        _log_query_encode(None)
+        return query_vector
+    metrics.increment("query_cache.misses")
+
+    start = perf_counter()
+    query_vector = model.encode(QUERY_PROMPT + query)
+    elapsed = perf_counter() - start
+    metrics.observe("query_encode.seconds", elapsed)
+    _log_query_encode(elapsed)
 
     # Normalize the query vector
     query_vector = query_vector / np.linalg.norm(query_vector)
+    query_vector.setflags(write=False)
+
+    with _query_cache_lock:
+        _query_cache[key] = query_vector
+        while len(_query_cache) > QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+    return query_vector
+
 
-    collection = chromadb.PersistentClient().get_or_create_collection(
-        name=collection_name_from_title(novel_name)
+def _log_query_encode(elapsed):
+    """
+    Log this request's encode latency (None on a cache hit) with the
+    running percentiles and the query cache hit rate.
+    """
+    summary = metrics.summary("query_encode.seconds")
+    hit_rate = metrics.ratio(
+        "query_cache.hits", ["query_cache.hits", "query_cache.misses"]
+    )
+    logger.info(
+        "Query encode: %s, p50=%s p95=%s over %s encodes, query cache hit rate %.1f%%",
+        "cached" if elapsed is None else f"{elapsed:.3f}s",
+        f"{summary['p50']:.3f}s" if summary else "-",
+        f"{summary['p95']:.3f}s" if summary else "-",
+        summary["count"] if summary else 0,
+        100 * hit_rate,
     )
 
-    # Search for the top k nearest neighbors
-    if spoiler_threshold:
-        results = collection.query(
-            query_embeddings=[query_vector.tolist()],
-            n_results=k,
-            where={"chapter_id": {"$lte": spoiler_threshold}},
-        )
-    else:
-        results = collection.query(
-            query_embeddings=[query_vector.tolist()], n_results=k
-        )
 
-    # logger.debug("Query vector: %s", query_vector.tolist())
+def resolve_query_vector(model, query, query_vector=None):
+    """
+    query_vector is None (encode the query here), a vector, or a Future of
+    one that the caller started to overlap encoding with other work.
+    """
+    if query_vector is None:
+        return encode_query(model, query)
+    if isinstance(query_vector, Future):
+        return query_vector.result()
+    return query_vector
+
+
+def search_chroma(
+    query,
+    novel_name,
+    model,
+    spoiler_threshold=None,
+    k=5,
+    timings=None,
+    query_vector=None,
+):
+    """
+    Return the top k (chunk_id, cosine similarity) pairs from ChromaDB.
+    query_vector (or a Future of it) can be passed in when the caller
+    already encodes the query.
+    """
+    with timed(timings, "chroma_encode"):
+        query_vector = resolve_query_vector(model, query, query_vector)
+
+    collection = get_collection(novel_name)
+    chapter_field = "chapter_number"
+    if spoiler_threshold and not has_chapter_numbers(collection):
+        # the handle may predate the indexer's backfill, reopen it once
+        forget_collection(novel_name)
+        collection = get_collection(novel_name)
+        if not has_chapter_numbers(collection):
+            logger.warning(
+                "Collection of %s has no chapter numbers yet, filtering on chapter_id; re-run the indexer",
+                novel_name,
+            )
+            chapter_field = "chapter_id"
+
+    # Search for the top k nearest neighbors
+    with timed(timings, "chroma_search"):
+        if spoiler_threshold:
+            results = collection.query(
+                query_embeddings=[query_vector.tolist()],
+                n_results=k,
+                where={chapter_field: {"$lte": spoiler_threshold}},
+                include=["distances"],
+            )
+        else:
+            results = collection.query(
+                query_embeddings=[query_vector.tolist()],
+                n_results=k,
+                include=["distances"],
+            )
 
     logger.debug("Results: %s", results)
 
     ids = results["ids"][0]
     logger.debug("Chunk IDs: %s", ids)
 
-    chunks = get_chunk_from_id(ids)
+    # embeddings are normalized, so squared L2 distance d = 2 - 2 * cosine
+    return [
+        (int(id), 1 - distance / 2)
+        for id, distance in zip(ids, results["distances"][0])
+    ]
+
+
+def search_local_vectors(
+    query,
+    novel_name,
+    model,
+    spoiler_threshold=None,
+    k=5,
+    timings=None,
+    query_vector=None,
+):
+    """
+    Return the top k (chunk_id, cosine similarity) pairs from the local
+    vector index, falling back to ChromaDB if the novel has none yet.
 
-    return chunks
+    spoiler_threshold is compared with chapter numbers, as in the BM25
+    index and the Chroma filter.
+    """
+    index = get_vector_index(collection_name_from_title(novel_name))
+    if index is None:
+        logger.warning("No local vector index for %s, using ChromaDB", novel_name)
+        return search_chroma(
+            query, novel_name, model, spoiler_threshold, k, timings, query_vector
+        )
 
+    with timed(timings, "vector_encode"):
+        query_vector = resolve_query_vector(model, query, query_vector)
 
-# ----------------------------------------
-# RETRIEVAL - BM25
-# ----------------------------------------
+    with timed(timings, "vector_search"):
+        return index.search(query_vector, k, spoiler_threshold)
+
+
+def search_vectors(
+    query,
+    novel_name,
+    model,
+    spoiler_threshold=None,
+    k=5,
+    timings=None,
+    query_vector=None,
+    backend=None,
+):
+    """
+    Dense retrieval through the configured backend (VECTOR_BACKEND).
+    """
+    search = (
+        search_local_vectors if (backend or VECTOR_BACKEND) == "local" else search_chroma
+    )
+    return search(query, novel_name, model, spoiler_threshold, k, timings, query_vector)
 
 
-def retrieve_context_bm25(query, novel_name, spoiler_threshold=None, k=5):
+def retrieve_context_chroma(
+    query, novel_name, model, spoiler_threshold=None, k=5, timings=None
+):
     """
     Retrieve the top k most similar chunks from the index based on the query.
     """
-    # connect to the database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Get the novel ID
-    novel_id = get_novel_id(novel_name, cursor)
-    logger.info("Novel ID for %s: %s", novel_name, novel_id)
-
-    logger.info("Retrieving chunks for %s ...", novel_name)
-    if spoiler_threshold:
-        cursor.execute(
-            "SELECT chunks.id, chunks.preprocessed_chunk_content FROM chunks JOIN chapters ON chunks.chapter_id = chapters.id WHERE chapters.novel_id = %s AND chapters.chapter_number <= %s;",
-            (
-                novel_id,
-                spoiler_threshold,
-            ),
-        )
-    else:
-        cursor.execute(
-            "SELECT id, preprocessed_chunk_content FROM chunks WHERE novel_id = %s",
-            (novel_id,),
-        )
+    hits = search_vectors(query, novel_name, model, spoiler_threshold, k, timings)
 
-    chunks = cursor.fetchall()
+    with timed(timings, "chroma_fetch"):
+        chunks = get_chunk_from_id([id for id, _ in hits])
 
-    ids, tokenized_docs = map(list, zip(*chunks))
-    logger.info("Number of chunks for novel %s: %s", novel_name, len(tokenized_docs))
+    return chunks
 
-    if len(tokenized_docs) == 0:
-        logger.warning("No chunks found for novel %s.", novel_name)
-        return
 
-    logger.info("Creating BM25 index...")
-    bm25 = BM25Okapi(tokenized_docs)
-    logger.info("Done creating BM25 index.")
+# ----------------------------------------
+# RETRIEVAL - BM25
+# ----------------------------------------
+
+
+def search_bm25(query, novel_name, spoiler_threshold=None, k=5, timings=None):
+    """
+    Return the top k (chunk_id, BM25 score) pairs from the BM25 index.
+    """
+    index = get_bm25_index(collection_name_from_title(novel_name))
+    if index is None or index.num_docs == 0:
+        logger.warning("No BM25 index found for novel %s.", novel_name)
+        return []
+
+    logger.info("Number of chunks for novel %s: %s", novel_name, index.num_docs)
 
     # Tokenize the query
-    query_tokens = preprocess(query)
+    with timed(timings, "bm25_preprocess"):
+        query_tokens = preprocess(query, mode=index.preprocess_mode)
 
     # Search for the top k nearest neighbors
     logger.info("Searching for the top %s nearest neighbors...", k)
-    scores = bm25.get_scores(query_tokens)
-    top_n_indices = np.argsort(scores)[::-1][:k]
+    with timed(timings, "bm25_search"):
+        return index.top_k(
+            query_tokens, k=k, spoiler_threshold=spoiler_threshold, with_scores=True
+        )
 
-    top_ids = [ids[i] for i in top_n_indices]
 
-    chunks = get_chunk_from_id(top_ids)
+def retrieve_context_bm25(query, novel_name, spoiler_threshold=None, k=5, timings=None):
+    """
+    Retrieve the top k most similar chunks from the index based on the query.
+    """
+    hits = search_bm25(query, novel_name, spoiler_threshold, k, timings)
+
+    with timed(timings, "bm25_fetch"):
+        chunks = get_chunk_from_id([id for id, _ in hits])
 
     return chunks
 
 
-def retrieve_context(query, novel_name, model, spoiler_threshold=None, k=10):
+# ----------------------------------------
+# HYBRID RETRIEVAL
+# ----------------------------------------
+
+
+def fuse_results(ranked_lists, method="rrf", weights=None, top_n=None):
     """
-    Retrieve the top k most similar chunks from the index based on the query.
+    Merge several best-first lists of (chunk_id, score) into one ranking.
+
+    method="rrf" sums weight / (RRF_K + rank) over the lists a chunk appears
+    in and ignores the raw scores. method="weighted" min-max normalizes the
+    scores of every list to [0, 1] and sums them with the given weights.
+    Returns (chunk_id, fused score) pairs, best first, one per chunk ID.
+    """
+    weights = weights or [1.0] * len(ranked_lists)
+    fused = {}
+    for hits, weight in zip(ranked_lists, weights):
+        if not hits:
+            continue
+        if method == "rrf":
+            for rank, (chunk_id, _) in enumerate(hits, start=1):
+                fused[chunk_id] = fused.get(chunk_id, 0.0) + weight / (RRF_K + rank)
+        elif method == "weighted":
+            scores = [score for _, score in hits]
+            low, high = min(scores), max(scores)
+            for chunk_id, score in hits:
+                normalized = (score - low) / (high - low) if high > low else 1.0
+                fused[chunk_id] = fused.get(chunk_id, 0.0) + weight * normalized
+        else:
+            raise ValueError(f"Unknown fusion method: {method}")
+
+    ranking = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+    return ranking[:top_n] if top_n else ranking
+
+
+def retrieve_ranked_chunks(
+    query,
+    novel_name,
+    model,
+    spoiler_threshold=None,
+    k=10,
+    top_n=None,
+    fusion="rrf",
+    weights=None,
+    concurrent=True,
+    query_vector=None,
+    cancelled=None,
+):
+    """
+    Run BM25 and ChromaDB retrieval, fuse their rankings by chunk ID and
+    fetch the content of the final top_n chunks (default k) in one query.
+
+    Returns (chunk_id, fused score, content) tuples, best first.
+
+    With concurrent=True the BM25 and ChromaDB branches run side by side on
+    the retrieval pool, each with its own timeout. A branch that fails or
+    times out contributes no chunks instead of failing the whole answer.
+
+    cancelled is an optional threading.Event: once it is set, branches that
+    have not started yet are skipped and no chunks are fetched.
     """
+    timings = {}
+    start = perf_counter()
+
+    branches = {
+        "bm25": (
+            search_bm25,
+            (query, novel_name),
+            dict(spoiler_threshold=spoiler_threshold, k=k),
+            BM25_TIMEOUT,
+        ),
+        "chroma": (
+            search_vectors,
+            (query, novel_name, model),
+            dict(spoiler_threshold=spoiler_threshold, k=k, query_vector=query_vector),
+            CHROMA_TIMEOUT,
+        ),
+    }
+
+    results = {}
+    if concurrent:
+        futures = {
+            name: _retrieval_pool.submit(
+                run_branch, name, func, args, kwargs, cancelled, start + timeout
+            )
+            for name, (func, args, kwargs, timeout) in branches.items()
+        }
+        for name, future in futures.items():
+            # every branch gets its full budget measured from the start
+            remaining = branches[name][3] - (perf_counter() - start)
+            try:
+                results[name], stage_timings = future.result(
+                    timeout=max(remaining, 0)
+                )
+                timings.update(stage_timings)
+            except FuturesTimeout:
+                running = abandon_branch(future)
+                logger.warning(
+                    "%s retrieval timed out after %.2fs, continuing without it "
+                    "(%s of %s retrieval workers held by abandoned branches)",
+                    name,
+                    branches[name][3],
+                    running,
+                    RETRIEVAL_WORKERS,
+                )
+                results[name] = []
+    else:
+        for name, (func, args, kwargs, _) in branches.items():
+            results[name], stage_timings = run_branch(
+                name, func, args, kwargs, cancelled
+            )
+            timings.update(stage_timings)
+
+    if cancelled is not None and cancelled.is_set():
+        logger.info("Retrieval cancelled, skipping fusion and fetch")
+        return []
 
-    # Use BM25 for retrieval
-    chunks_bm25 = retrieve_context_bm25(
-        query, novel_name, spoiler_threshold=spoiler_threshold, k=k
+    with timed(timings, "fusion"):
+        ranking = fuse_results(
+            [results["bm25"], results["chroma"]],
+            method=fusion,
+            weights=weights,
+            top_n=top_n or k,
+        )
+
+    with timed(timings, "fetch"):
+        contents = dict(fetch_chunks([chunk_id for chunk_id, _ in ranking]))
+    ranked_chunks = [
+        (chunk_id, score, contents[chunk_id])
+        for chunk_id, score in ranking
+        if chunk_id in contents
+    ]
+
+    logger.info(
+        "Fused %s BM25 and %s ChromaDB hits into %s chunks (%s)",
+        len(results["bm25"]),
+        len(results["chroma"]),
+        len(ranked_chunks),
+        fusion,
+    )
+    logger.info(
+        "Retrieval timings (%s): %s, total=%.3fs",
+        "concurrent" if concurrent else "sequential",
+        ", ".join(f"{stage}={duration:.3f}s" for stage, duration in timings.items()),
+        perf_counter() - start,
     )
 
-    # Use ChromaDB for retrieval
-    chunks_chroma = retrieve_context_chroma(
-        query, novel_name, model, spoiler_threshold=spoiler_threshold, k=k
+    return ranked_chunks
+
+
+def retrieve_context(query, novel_name, model, spoiler_threshold=None, k=10, **kwargs):
+    """
+    Retrieve the top k most relevant chunks' content, best first.
+    """
+    ranked_chunks = retrieve_ranked_chunks(
+        query, novel_name, model, spoiler_threshold=spoiler_threshold, k=k, **kwargs
     )
+    return [content for _, _, content in ranked_chunks]
 
-    # Combine the results
-    combined_chunks = list(set(chunks_bm25 + chunks_chroma))
 
-    logger.info("Number of combined chunks: %s", len(combined_chunks))
+def max_chapter_of_chunks(chunk_ids):
+    """
+    Highest chapter number the given chunks come from, or None.
+    """
+    if not chunk_ids:
+        return None
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT MAX(chapters.chapter_number) FROM chunks JOIN chapters ON chunks.chapter_id = chapters.id WHERE chunks.id = ANY(%s)",
+                ([int(id) for id in chunk_ids],),
+            )
+            return cursor.fetchone()[0]
+
+
+def run_branch(name, func, args, kwargs, cancelled=None, deadline=None):
+    """
+    Run one retrieval branch, degrading to no hits if it fails, was
+    cancelled (see retrieve_ranked_chunks) before it started, or only got a
+    worker after its deadline (a perf_counter time).
+    Returns the hits and the branch's per-stage timings.
+    """
+    stage_timings = {}
+    if cancelled is not None and cancelled.is_set():
+        return [], stage_timings
+    if deadline is not None and perf_counter() >= deadline:
+        logger.warning("%s retrieval waited past its deadline for a worker, skipped", name)
+        return [], stage_timings
+    try:
+        with timed(stage_timings, name):
+            hits = func(*args, timings=stage_timings, **kwargs)
+        return hits or [], stage_timings
+    except CancelledError:
+        # the query vector it waited on was withdrawn
+        logger.info("%s retrieval cancelled", name)
+        return [], stage_timings
+    except Exception as e:
+        logger.error("%s retrieval failed: %s", name, e)
+        return [], stage_timings
+
+
+def abandon_branch(future):
+    """
+    Give up on a timed-out branch future: cancel it if it is still queued,
+    otherwise count it as abandoned until its worker is free again.
+    Returns the number of abandoned branches still running.
+    """
+    global _abandoned_branches
+    metrics.increment("retrieval.abandoned_branches")
+    if future.cancel():
+        with _abandoned_lock:
+            return _abandoned_branches
+
+    def release(_):
+        global _abandoned_branches
+        with _abandoned_lock:
+            _abandoned_branches -= 1
 
-    return combined_chunks
+    with _abandoned_lock:
+        _abandoned_branches += 1
+        running = _abandoned_branches
+    future.add_done_callback(release)
+    return running
 
 
 # ----------------------------------------
@@ -176,7 +635,103 @@ def retrieve_context(query, novel_name, model, spoiler_threshold=None, k=10):
 # ----------------------------------------
 
 
-def rerank_chunks(query, chunks):
-    logger.info("Reranking chunks...")
-    return chunks
+def _pair_cache_key(query, chunk_id):
+    query_hash = hashlib.sha1(" ".join(query.lower().split()).encode()).hexdigest()
+    return (RERANKER_MODEL, query_hash, chunk_id)
+
 
+def _truncate_to_budget(tokenizer, content, budget):
+    """
+    Cut the chunk to at most budget tokens, on a token boundary.
+    """
+    encoding = tokenizer(
+        content,
+        add_special_tokens=False,
+        truncation=True,
+        max_length=budget,
+        return_offsets_mapping=True,
+    )
+    offsets = encoding["offset_mapping"]
+    if len(offsets) < budget:
+        return content
+    return content[: offsets[-1][1]]
+
+
+def rerank_chunks(query, chunks, top_n=RERANK_TOP_N):
+    """
+    Rescore (chunk_id, score, content) tuples with a cross-encoder and keep
+    the top_n best, best first, with the cross-encoder score as their score.
+
+    Pair scores are cached by (model, query hash, chunk ID), so retries and
+    repeated questions only score the chunks they have not seen. If the
+    reranker is disabled or cannot be loaded, the fused order is kept.
+    """
+    logger.info("Reranking chunks...")
+    if not chunks:
+        return []
+    if not RERANKER_MODEL:
+        return chunks[:top_n]
+
+    start = perf_counter()
+    try:
+        cross_encoder = get_cross_encoder(
+            RERANKER_MODEL,
+            device=RERANK_DEVICE,
+            backend=RERANK_BACKEND,
+            onnx_file=RERANK_ONNX_FILE,
+            max_length=RERANK_MAX_LENGTH,
+        )
+    except Exception as e:
+        logger.error("Could not load reranker %s: %s", RERANKER_MODEL, e)
+        return chunks[:top_n]
+
+    scores = {}
+    to_score = []
+    with _rerank_cache_lock:
+        for chunk_id, _, content in chunks:
+            key = _pair_cache_key(query, chunk_id)
+            if key in _rerank_cache:
+                _rerank_cache.move_to_end(key)
+                scores[chunk_id] = _rerank_cache[key]
+            else:
+                to_score.append((chunk_id, content))
+
+    if to_score:
+        # leave room for the whole query so truncation only ever cuts the
+        # chunk: [CLS] query [SEP] chunk [SEP]
+        tokenizer = cross_encoder.tokenizer
+        query_length = len(tokenizer.encode(query, add_special_tokens=False))
+        budget = max(RERANK_MAX_LENGTH - query_length - 3, 16)
+        pairs = [
+            (query, _truncate_to_budget(tokenizer, content, budget))
+            for _, content in to_score
+        ]
+        # similar lengths in a batch means less padding
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][1]))
+        predicted = cross_encoder.predict(
+            [pairs[i] for i in order],
+            batch_size=RERANK_BATCH_SIZE,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        with _rerank_cache_lock:
+            for i, score in zip(order, predicted):
+                chunk_id = to_score[i][0]
+                scores[chunk_id] = float(score)
+                _rerank_cache[_pair_cache_key(query, chunk_id)] = float(score)
+            while len(_rerank_cache) > RERANK_CACHE_SIZE:
+                _rerank_cache.popitem(last=False)
+
+    reranked = sorted(
+        ((chunk_id, scores[chunk_id], content) for chunk_id, _, content in chunks),
+        key=lambda chunk: chunk[1],
+        reverse=True,
+    )[:top_n]
+    logger.info(
+        "Reranked %s chunks (%s cached) down to %s in %.3fs",
+        len(chunks),
+        len(chunks) - len(to_score),
+        len(reranked),
+        perf_counter() - start,
+    )
+    return reranked
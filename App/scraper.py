@@ -1,14 +1,59 @@
 import aiohttp
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import asyncio
+import importlib.util
+import os
+import random
 import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from time import monotonic, perf_counter
+from urllib.parse import urlsplit
 from fake_headers import Headers
 from logger_config import setup_logger
-from utils import get_db_connection
+from psycopg2.extras import execute_values
+from resources import db_connection
+from utils import content_hash
 
 logger = setup_logger("scraper")
 header = Headers(browser="chrome", os="win", headers=True)
 
+# Site to scrape; point it at a local stub server to exercise the scraper
+BASE_URL = os.getenv("SCRAPER_BASE_URL", "https://novelfull.com").rstrip("/")
+
+# Stored content containing this is a Cloudflare challenge page, not a chapter
+CLOUDFLARE_MARKER = "security by Cloudflare"
+# Raw pages containing any of these are challenge pages and are never stored
+CHALLENGE_MARKERS = (CLOUDFLARE_MARKER, "cf-chl", "<title>Just a moment...</title>")
+
+# Retries per page, with exponential backoff and full jitter between them
+MAX_RETRIES = int(os.getenv("SCRAPER_MAX_RETRIES", "5"))
+BACKOFF_BASE = float(os.getenv("SCRAPER_BACKOFF_BASE", "1"))
+BACKOFF_MAX = float(os.getenv("SCRAPER_BACKOFF_MAX", "60"))
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+# Requests per second (and burst) allowed against a single host
+RATE_LIMIT = float(os.getenv("SCRAPER_RATE_LIMIT", "10"))
+RATE_BURST = int(os.getenv("SCRAPER_RATE_BURST", "20"))
+# Re-check every known chapter with conditional requests, not only the
+# missing and poisoned ones; unchanged chapters cost a 304 or a hash compare
+RECHECK_ALL = os.getenv("SCRAPER_RECHECK_ALL", "0") == "1"
+
+# A fetched page: html is None when the server answered 304 Not Modified
+Page = namedtuple("Page", "html etag last_modified attempts")
+# Chapters written per INSERT/UPDATE statement and transaction
+WRITE_BATCH_SIZE = 500
+# Scrape pipeline sizing: concurrent downloads, parse workers and the bound
+# on pages/chapters waiting between stages
+FETCH_WORKERS = 20
+PIPELINE_QUEUE_SIZE = 100
+# Chapter pages are parsed in a process pool so the event loop keeps the
+# connections busy; lxml is much faster than html.parser when it is installed
+PARSE_PROCESSES = int(os.getenv("SCRAPER_PARSE_PROCESSES", str(os.cpu_count() or 1)))
+HTML_PARSER = os.getenv(
+    "SCRAPER_HTML_PARSER",
+    "lxml" if importlib.util.find_spec("lxml") else "html.parser",
+)
+
 
 async def refresh_database():
     headers = header.generate()
@@ -19,7 +64,7 @@ async def refresh_database():
     logger.info(f"Keyword provided: {keyword}")
     while True:
         logger.info(f"Searching for keyword: {keyword}")
-        search_url = f"https://novelfull.com/search?keyword={keyword}"
+        search_url = f"{BASE_URL}/search?keyword={keyword}"
         async with aiohttp.ClientSession(headers=headers) as session:
             search_soup = await fetch_html(session, search_url)
         try:
@@ -50,67 +95,44 @@ async def refresh_database():
     logger.info(f"Final novel title: {novel_title}")
     logger.info(f"Fetching chapter URLs for {novel_title}")
 
-    connector = aiohttp.TCPConnector(limit=20)
+    connector = aiohttp.TCPConnector(limit=FETCH_WORKERS)
     async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
         novel_image, chapter_titles, chapter_urls = await get_urls(session, search_soup)
 
     logger.info(f"Retrieved novel title: {novel_title}, with {len(chapter_titles)} chapters")
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    while True:
-        try:
-            urls_to_scrape = []
-            urls_to_update = []
-
-            # for later I can check directly in the database the list of chapter_urls then fetch them all at once
-            # instead of checking one by one using a for loop
-            logger.info("Checking database for existing chapters")
-            for url, title in zip(chapter_urls, chapter_titles):
-                cursor.execute("SELECT * FROM chapters WHERE chapter_url = %s", (url,))
-                result = cursor.fetchone()
-
-                if result:
-                    if "security by Cloudflare" in result[5]:
-                        urls_to_update.append((url, title))
-                    else:
-                        continue
-                else:
-                    urls_to_scrape.append((url, title))
-
-            logger.info(
-                f"URLs to scrape: {len(urls_to_scrape)}, URLs to update: {len(urls_to_update)}"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        headers = header.generate()
+        connector = aiohttp.TCPConnector(limit=FETCH_WORKERS)
+        async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+            await chapter_to_db(
+                session,
+                novel_title,
+                novel_image,
+                chapter_urls,
+                chapter_titles,
+                cursor,
+                conn,
             )
 
-            headers = header.generate()
-            connector = aiohttp.TCPConnector(limit=20)
-            async with aiohttp.ClientSession(
-                headers=headers, connector=connector
-            ) as session:
-                await chapter_to_db(
-                    session,
-                    novel_title,
-                    novel_image,
-                    urls_to_scrape,
-                    urls_to_update,
-                    cursor,
-                    conn,
-                )
-                break
-        except Exception as e:
-            logger.error(f"Error occurred: {e}")
-            continue
+        cursor.close()
 
-    cursor.close()
-    conn.close()
     logger.info("Database refresh completed")
     return novel_title
 
 
 async def chapter_to_db(
-    session, novel_title, novel_image, urls_to_scrape, urls_to_update, cursor, conn
+    session, novel_title, novel_image, chapter_urls, chapter_titles, cursor, conn
 ):
+    """
+    Queue the novel's missing or poisoned chapters in chapter_fetch_state and
+    scrape every chapter still pending there.
+
+    Chapters are marked done in the same transaction that stores them, so a
+    run that dies half way is resumed by simply running the refresh again.
+    """
     logger.info(f"Processing novel: {novel_title}")
     cursor.execute("SELECT * FROM novels WHERE novel_title = %s", (novel_title,))
     result = cursor.fetchone()
@@ -126,65 +148,538 @@ async def chapter_to_db(
         conn.commit()
     logger.info(f"Novel ID: {novel_id}")
 
-    chapter_urls = [url[0] for url in urls_to_scrape]
-    chapter_titles = [url[1] for url in urls_to_scrape]
+    logger.info("Checking database for existing chapters")
+    missing, poisoned = find_chapters_to_fetch(cursor, chapter_urls)
+    queue_chapters(
+        cursor,
+        conn,
+        novel_id,
+        [
+            (url, title)
+            for url, title in zip(chapter_urls, chapter_titles)
+            if RECHECK_ALL or url in missing or url in poisoned
+        ],
+    )
 
-    tasks = [
-        get_page_content(session, f"https://novelfull.com{chapter_url}")
-        for chapter_url in chapter_urls
-    ]
-    chapter_contents = await asyncio.gather(*tasks)
-    chapter_contents = [clean_text(text) for text in chapter_contents]
+    jobs = load_pending_chapters(cursor, novel_id)
+    logger.info(
+        f"URLs to scrape: {sum(not job[2] for job in jobs)}, "
+        f"URLs to update: {sum(job[2] for job in jobs)}"
+    )
+    await scrape_chapters(session, jobs, novel_id, cursor, conn)
+
+
+async def scrape_chapters(session, jobs, novel_id, cursor, conn):
+    """
+    Fetch, parse and store chapters as a streaming pipeline.
+
+    A bounded pool of fetchers downloads pages into a bounded queue, parse
+    workers turn them into chapter text, and a single writer commits them in
+    batches as they arrive. Memory stays flat whatever the novel's length,
+    and a crash only loses the chapters that were in flight; they are still
+    pending in chapter_fetch_state and are picked up by the next run.
+
+    jobs is a list of (chapter_url, chapter_title, is_update, etag,
+    last_modified, content_hash), as returned by load_pending_chapters.
+    """
+    url_queue = asyncio.Queue()
+    for job in jobs:
+        url_queue.put_nowait(job)
+    html_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    row_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+    logger.info(
+        f"Scraping {len(jobs)} chapters with {FETCH_WORKERS} connections and "
+        f"{PARSE_PROCESSES} {HTML_PARSER} parse processes"
+    )
+    start = perf_counter()
+    with ProcessPoolExecutor(max_workers=PARSE_PROCESSES) as pool:
+        fetchers = [
+            asyncio.create_task(fetch_worker(session, url_queue, html_queue))
+            for _ in range(FETCH_WORKERS)
+        ]
+        # one page per process in flight plus one waiting, so no process idles
+        parsers = [
+            asyncio.create_task(parse_worker(pool, html_queue, row_queue))
+            for _ in range(2 * PARSE_PROCESSES)
+        ]
+        writer = asyncio.create_task(
+            write_worker(row_queue, novel_id, cursor, conn, start)
+        )
+        # each stage is told to stop once the stage feeding it has finished
+        closers = [
+            asyncio.create_task(close_queue(fetchers, html_queue, len(parsers))),
+            asyncio.create_task(close_queue(parsers, row_queue, 1)),
+        ]
 
-    for chapter_title, chapter_url, chapter_content in zip(
-        chapter_titles, chapter_urls, chapter_contents
-    ):
-        chapter_number = re.search(r"\d+", chapter_title)
-        chapter_number = int(chapter_number.group())
+        # every stage is watched at once: a writer or parser that dies would
+        # otherwise leave the stages upstream of it blocked on a full queue
+        tasks = fetchers + parsers + closers + [writer]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+        written = writer.result()
+
+    elapsed = perf_counter() - start
+    logger.info(
+        f"Scraped {len(jobs)} chapters in {elapsed:.1f}s "
+        f"({len(jobs) / elapsed if elapsed else 0:.1f} pages/s), "
+        f"{written} changed"
+    )
 
-        cursor.execute(
-            "INSERT INTO chapters (novel_id, chapter_number, chapter_title, chapter_url, chapter_content) VALUES (%s, %s, %s, %s, %s)",
-            (novel_id, chapter_number, chapter_title, chapter_url, chapter_content),
+
+async def fetch_worker(session, url_queue, html_queue):
+    while True:
+        try:
+            job = url_queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        try:
+            page = await fetch_with_retry(session, f"{BASE_URL}{job[0]}", job[3], job[4])
+            await html_queue.put((job, page, None))
+        except FetchError as e:
+            # recorded as failed; the next refresh queues the chapter again
+            logger.error(f"Giving up on {job[0]}: {e}")
+            await html_queue.put((job, Page(None, None, None, e.attempts), str(e)))
+
+
+async def close_queue(workers, queue, count):
+    """
+    Put count end-of-stream markers on queue once every worker has finished.
+    """
+    await asyncio.gather(*workers)
+    for _ in range(count):
+        await queue.put(None)
+
+
+async def parse_worker(pool, html_queue, row_queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await html_queue.get()
+        if item is None:
+            return
+        job, page, error = item
+        content = None
+        if error is None and page.html is not None:
+            content = await loop.run_in_executor(pool, parse_chapter, page.html)
+        await row_queue.put((job, page, content, error))
+
+
+async def write_worker(row_queue, novel_id, cursor, conn, start):
+    inserts, updates, states, validators = [], [], [], []
+    written = not_modified = unchanged = 0
+    # the write running in its thread; a cancel does not stop it
+    writing = None
+
+    async def flush():
+        nonlocal inserts, updates, states, validators, written, writing
+        # hand the batch over first, so a cancel during the write cannot repeat it
+        batch = (inserts, updates, states, validators)
+        inserts, updates, states, validators = [], [], [], []
+        writing = asyncio.ensure_future(
+            asyncio.to_thread(write_batch, cursor, conn, *batch)
         )
-        conn.commit()
+        await asyncio.shield(writing)
+        written += len(batch[0]) + len(batch[1])
+        elapsed = perf_counter() - start
         logger.info(
-            f"Inserted chapter {chapter_title} into database with number {chapter_number}"
+            f"Chapters written so far: {written} "
+            f"({written / elapsed if elapsed else 0:.1f} pages/s)"
         )
 
-    chapter_urls = [url[0] for url in urls_to_update]
-    chapter_titles = [url[1] for url in urls_to_update]
+    try:
+        while True:
+            item = await row_queue.get()
+            if item is None:
+                break
+            job, page, chapter_content, error = item
+            chapter_url, chapter_title, is_update, _, _, stored_hash = job
+            if error is not None:
+                states.append((chapter_url, "failed", page.attempts, error))
+                continue
+            states.append((chapter_url, "done", page.attempts, None))
+            if page.html is None:
+                not_modified += 1
+                continue
+            chapter_hash = content_hash(chapter_content)
+            validators.append((chapter_url, page.etag, page.last_modified, chapter_hash))
+            if is_update and chapter_hash == stored_hash:
+                # same text as stored: nothing to rewrite, re-chunk or re-embed
+                unchanged += 1
+            elif is_update:
+                updates.append((chapter_url, chapter_content, chapter_hash))
+            else:
+                inserts.append(
+                    (
+                        novel_id,
+                        chapter_number_from_title(chapter_title),
+                        chapter_title,
+                        chapter_url,
+                        chapter_content,
+                        chapter_hash,
+                    )
+                )
+            if len(states) >= WRITE_BATCH_SIZE:
+                await flush()
+        await flush()
+        logger.info(
+            f"Not modified: {not_modified}, unchanged content: {unchanged}, "
+            f"written: {written}"
+        )
+        return written
+    except asyncio.CancelledError:
+        # keep what already arrived, only the in-flight chapters are lost;
+        # the cursor is shared, so a write still running in its thread
+        # finishes first, and a failed one leaves nothing safe to commit on
+        if writing is not None:
+            await asyncio.wait([writing])
+            if writing.exception() is not None:
+                raise
+        write_batch(cursor, conn, inserts, updates, states, validators)
+        raise
+
+
+def write_batch(cursor, conn, inserts, updates, states, validators):
+    """
+    Store a batch of chapters together with their fetch states and cache
+    validators, in one transaction so a chapter is never marked done without
+    being stored.
+    """
+    if not states:
+        return
+    insert_chapters(cursor, inserts)
+    update_chapters(cursor, updates)
+    record_fetch_states(cursor, states)
+    store_validators(cursor, validators)
+    conn.commit()
+
+
+def chapter_number_from_title(chapter_title):
+    return int(re.search(r"\d+", chapter_title).group())
+
+
+def find_chapters_to_fetch(cursor, chapter_urls):
+    """
+    Diff the novel's chapter URLs against the database in one query.
+    Returns (missing URLs, URLs whose stored content is a Cloudflare page).
+    """
+    cursor.execute(
+        """
+        SELECT DISTINCT urls.url, chapters.id IS NULL AS missing
+        FROM unnest(%s::text[]) AS urls(url)
+        LEFT JOIN chapters ON chapters.chapter_url = urls.url
+        WHERE chapters.id IS NULL
+           OR chapters.chapter_content LIKE %s
+        """,
+        (list(chapter_urls), f"%{CLOUDFLARE_MARKER}%"),
+    )
+    missing, poisoned = set(), set()
+    for url, is_missing in cursor.fetchall():
+        (missing if is_missing else poisoned).add(url)
+    return missing, poisoned
+
+
+def queue_chapters(cursor, conn, novel_id, chapters):
+    """
+    Mark (chapter_url, chapter_title) pairs as pending in chapter_fetch_state.
+    Chapters already pending keep their attempt count.
+    """
+    execute_values(
+        cursor,
+        """
+        INSERT INTO chapter_fetch_state (chapter_url, novel_id, chapter_title, status)
+        VALUES %s
+        ON CONFLICT (chapter_url) DO UPDATE
+        SET status = 'pending', attempts = 0, last_error = NULL, updated_at = now()
+        WHERE chapter_fetch_state.status <> 'pending'
+        """,
+        [(url, novel_id, title, "pending") for url, title in chapters],
+        page_size=WRITE_BATCH_SIZE,
+    )
+    conn.commit()
+
+
+def load_pending_chapters(cursor, novel_id):
+    """
+    Return the novel's pending chapters as (chapter_url, chapter_title,
+    is_update, etag, last_modified, content_hash) jobs.
+
+    is_update is set when a stored row must be replaced. The cache validators
+    and stored hash are only returned for healthy stored chapters: a missing
+    or poisoned chapter must be downloaded in full whatever the cache says.
+    """
+    cursor.execute(
+        """
+        SELECT DISTINCT ON (state.chapter_url)
+            state.chapter_url,
+            state.chapter_title,
+            chapters.id IS NOT NULL,
+            CASE WHEN healthy THEN cache.etag END,
+            CASE WHEN healthy THEN cache.last_modified END,
+            CASE WHEN healthy THEN chapters.content_hash END
+        FROM chapter_fetch_state AS state
+        LEFT JOIN chapters ON chapters.chapter_url = state.chapter_url
+        LEFT JOIN http_cache AS cache ON cache.url = state.chapter_url
+        CROSS JOIN LATERAL (
+            SELECT chapters.id IS NOT NULL
+               AND chapters.chapter_content NOT LIKE %s AS healthy
+        ) AS checks
+        WHERE state.novel_id = %s AND state.status = 'pending'
+        ORDER BY state.chapter_url
+        """,
+        (f"%{CLOUDFLARE_MARKER}%", novel_id),
+    )
+    return cursor.fetchall()
+
+
+def store_validators(cursor, rows):
+    """
+    Upsert (url, etag, last_modified, content_hash) rows into http_cache.
+    Not committed.
+    """
+    execute_values(
+        cursor,
+        """
+        INSERT INTO http_cache (url, etag, last_modified, content_hash)
+        VALUES %s
+        ON CONFLICT (url) DO UPDATE
+        SET etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified,
+            content_hash = EXCLUDED.content_hash, fetched_at = now()
+        """,
+        rows,
+        page_size=WRITE_BATCH_SIZE,
+    )
 
-    tasks = [
-        get_page_content(session, f"https://novelfull.com{chapter_url}")
-        for chapter_url in chapter_urls
-    ]
-    chapter_contents = await asyncio.gather(*tasks)
-    chapter_contents = [clean_text(text) for text in chapter_contents]
 
-    for chapter_title, chapter_content in zip(chapter_titles, chapter_contents):
-        chapter_number = re.search(r"\d+", chapter_title)
-        chapter_number = int(chapter_number.group())
-        cursor.execute(
-            "UPDATE chapters SET chapter_content = %s WHERE chapter_number = %s;",
-            (chapter_content, chapter_number),
+def record_fetch_states(cursor, states):
+    """
+    Record (chapter_url, status, attempts, last_error) rows. Not committed.
+    """
+    execute_values(
+        cursor,
+        """
+        UPDATE chapter_fetch_state
+        SET status = data.status, attempts = chapter_fetch_state.attempts + data.attempts,
+            last_error = data.last_error, updated_at = now()
+        FROM (VALUES %s) AS data(url, status, attempts, last_error)
+        WHERE chapter_fetch_state.chapter_url = data.url
+        """,
+        states,
+        template="(%s, %s, %s, %s::text)",
+        page_size=WRITE_BATCH_SIZE,
+    )
+
+
+def insert_chapters(cursor, rows):
+    """
+    Insert (novel_id, chapter_number, chapter_title, chapter_url,
+    chapter_content, content_hash) rows, one multi-row INSERT per batch.
+    Not committed.
+    """
+    for start in range(0, len(rows), WRITE_BATCH_SIZE):
+        batch = rows[start : start + WRITE_BATCH_SIZE]
+        execute_values(
+            cursor,
+            "INSERT INTO chapters (novel_id, chapter_number, chapter_title, chapter_url, chapter_content, content_hash) VALUES %s",
+            batch,
+            page_size=WRITE_BATCH_SIZE,
         )
-        conn.commit()
         logger.info(
-            f"Updated chapter {chapter_title} in database with number {chapter_number}"
+            f"Inserted chapters {batch[0][1]} to {batch[-1][1]} ({len(batch)} rows)"
         )
 
-    return
 
+def update_chapters(cursor, rows):
+    """
+    Replace the content of (chapter_url, chapter_content, content_hash) rows,
+    one set-based UPDATE per batch. Not committed.
+    """
+    for start in range(0, len(rows), WRITE_BATCH_SIZE):
+        batch = rows[start : start + WRITE_BATCH_SIZE]
+        execute_values(
+            cursor,
+            "UPDATE chapters SET chapter_content = data.content, content_hash = data.hash FROM (VALUES %s) AS data(url, content, hash) WHERE chapters.chapter_url = data.url",
+            batch,
+            page_size=WRITE_BATCH_SIZE,
+        )
+        logger.info(f"Updated {len(batch)} chapters")
 
-async def fetch_html(session, url):
+
+class FetchError(Exception):
+    """
+    A page could not be fetched within MAX_RETRIES attempts, or failed with
+    a permanent HTTP error (4xx other than 408/429) that is not retried.
+    """
+
+    def __init__(self, message, attempts):
+        super().__init__(message)
+        self.attempts = attempts
+
+
+class RetryableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Async token bucket: acquire() waits until a request may be sent.
+
+    Each caller takes a token immediately and, when the bucket is in debt,
+    sleeps for its share of the debt, so waiters are served in call order.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    async def acquire(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+_buckets = {}
+
+
+def host_bucket(url):
+    host = urlsplit(url).netloc
+    bucket = _buckets.get(host)
+    if bucket is None:
+        bucket = _buckets[host] = TokenBucket(RATE_LIMIT, RATE_BURST)
+    return bucket
+
+
+def is_challenge_page(html):
+    return any(marker in html for marker in CHALLENGE_MARKERS)
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Full-jitter exponential backoff, unless the server said how long to wait.
+    """
+    if retry_after is not None:
+        return min(BACKOFF_MAX, retry_after)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+async def fetch_text(session, url, etag=None, last_modified=None):
+    """
+    Fetch a page, as a conditional request when validators are given.
+    Returns (html, etag, last_modified), html being None on 304.
+    """
     logger.info(f"Fetching HTML for URL: {url}")
-    async with session.get(url) as response:
+    conditional_headers = {}
+    if etag:
+        conditional_headers["If-None-Match"] = etag
+    if last_modified:
+        conditional_headers["If-Modified-Since"] = last_modified
+    await host_bucket(url).acquire()
+    async with session.get(url, headers=conditional_headers) as response:
+        if response.status == 304:
+            return None, etag, last_modified
+        if response.status in RETRY_STATUSES:
+            retry_after = response.headers.get("Retry-After")
+            raise RetryableError(
+                f"HTTP {response.status}",
+                float(retry_after) if retry_after and retry_after.isdigit() else None,
+            )
+        if 400 <= response.status < 500:
+            # a missing chapter stays missing, do not spend the backoff on it
+            raise FetchError(f"HTTP {response.status}", 1)
+        response.raise_for_status()
         html = await response.text()
-        return BeautifulSoup(html, "html.parser")
+        validators = response.headers.get("ETag"), response.headers.get("Last-Modified")
+    if is_challenge_page(html):
+        raise RetryableError("challenge page")
+    return (html, *validators)
+
+
+async def fetch_with_retry(session, url, etag=None, last_modified=None):
+    """
+    Return a Page, retrying transient failures and challenge pages.
+    """
+    for attempt in range(MAX_RETRIES):
+        try:
+            result = await fetch_text(session, url, etag, last_modified)
+            return Page(*result, attempt + 1)
+        except FetchError as e:
+            e.attempts = attempt + 1
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError) as e:
+            if attempt + 1 == MAX_RETRIES:
+                raise FetchError(f"{e} after {MAX_RETRIES} attempts", MAX_RETRIES)
+            delay = backoff_delay(attempt, getattr(e, "retry_after", None))
+            logger.warning(f"Fetching {url} failed ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def fetch_html(session, url):
+    try:
+        html = (await fetch_with_retry(session, url)).html
+    except FetchError as e:
+        logger.error(f"Giving up on {url}: {e}")
+        html = ""
+    return BeautifulSoup(html, HTML_PARSER)
+
+
+async def fetch_cached_html(session, url):
+    """
+    fetch_html through http_cache: the stored body is reused when the server
+    answers the conditional request with 304 Not Modified.
+    """
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT etag, last_modified, body FROM http_cache WHERE url = %s", (url,)
+        )
+        cached = cursor.fetchone()
+    etag, last_modified, body = cached if cached and cached[2] else (None, None, None)
+
+    try:
+        page = await fetch_with_retry(session, url, etag, last_modified)
+    except FetchError as e:
+        logger.error(f"Giving up on {url}: {e}")
+        return BeautifulSoup("", HTML_PARSER)
+
+    if page.html is None:
+        logger.info(f"Not modified: {url}")
+        return BeautifulSoup(body, HTML_PARSER)
+
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO http_cache (url, etag, last_modified, content_hash, body)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (url) DO UPDATE
+            SET etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified,
+                content_hash = EXCLUDED.content_hash, body = EXCLUDED.body,
+                fetched_at = now()
+            """,
+            (url, page.etag, page.last_modified, content_hash(page.html), page.html),
+        )
+    return BeautifulSoup(page.html, HTML_PARSER)
 
 
-async def get_page_content(session, url):
-    soup = await fetch_html(session, url)
+def parse_chapter(html, parser=HTML_PARSER):
+    """
+    Extract the cleaned chapter text from a chapter page.
+
+    Runs in the parse process pool, so it must stay a picklable module-level
+    function. Only <p> elements are built into the tree.
+    """
+    soup = BeautifulSoup(html, parser, parse_only=SoupStrainer("p"))
     text = "\n".join(
         [
             item.text
@@ -194,24 +689,24 @@ async def get_page_content(session, url):
             and "copyright" not in item.text.lower()
         ]
     )
-    return text
+    return clean_text(text)
 
 
 async def get_urls(session, search_soup):
 
     chapter_list_url = (
-        f"https://novelfull.com{search_soup.select_one('.truyen-title a')['href']}"
+        f"{BASE_URL}{search_soup.select_one('.truyen-title a')['href']}"
     )
-    chapter_list_soup = await fetch_html(session, chapter_list_url)
+    chapter_list_soup = await fetch_cached_html(session, chapter_list_url)
 
     last_url = (
-        f'https://novelfull.com{chapter_list_soup.select_one("li.last a")["href"]}'
+        f'{BASE_URL}{chapter_list_soup.select_one("li.last a")["href"]}'
     )
     last_page = int(last_url.split("=")[-1])
     url_part1 = last_url.split("page=")[0] + "page="
 
     tasks = [
-        fetch_html(session, f"{url_part1}{page_num}")
+        fetch_cached_html(session, f"{url_part1}{page_num}")
         for page_num in range(1, last_page + 1)
     ]
     page_soups = await asyncio.gather(*tasks)
@@ -223,7 +718,7 @@ async def get_urls(session, search_soup):
         chapter_titles += [item.text for item in soup.select("#list-chapter .row li a")]
         chapter_urls += [item["href"] for item in soup.select(".list-chapter li a")]
 
-    novel_image = "https://novelfull.com" + soup.select_one(".book img")["src"]
+    novel_image = BASE_URL + soup.select_one(".book img")["src"]
     logger.info(f"Found novel image: {novel_image}")
 
     return novel_image, chapter_titles, chapter_urls
@@ -0,0 +1,77 @@
+class ThinkStripper:
+    """
+    Remove <think>...</think> sections from a token stream as it arrives.
+
+    Text that could still be the start of a tag is held back until the next
+    piece shows whether it is one, so tags split across tokens are handled.
+
+    Whether the reply opens with a reasoning block is decided as soon as its
+    first non-whitespace characters cannot be a tag any more; from then on
+    text is released as it arrives. Chat templates that open the <think>
+    block in the prompt make the model reply with "reasoning...</think>answer";
+    pass thinking=True for those, so the text up to the closing tag is hidden.
+    """
+
+    OPEN = "<think>"
+    CLOSE = "</think>"
+
+    def __init__(self, thinking=False):
+        self.buffer = ""
+        self.thinking = thinking
+        self.decided = thinking
+        self.started = False
+
+    def feed(self, text):
+        """
+        Add streamed text and return the part of it that is safe to show.
+        """
+        self.buffer += text
+        visible = []
+        if not self.decided:
+            head = self.buffer.lstrip()
+            if head.startswith(self.OPEN):
+                self.buffer = head[len(self.OPEN) :]
+                self.thinking = True
+            elif head.startswith(self.CLOSE):
+                # the reasoning was opened by the template and is empty
+                self.buffer = head[len(self.CLOSE) :]
+            elif not head or self.OPEN.startswith(head) or self.CLOSE.startswith(head):
+                return ""
+            self.decided = True
+
+        while True:
+            tag = self.CLOSE if self.thinking else self.OPEN
+            position = self.buffer.find(tag)
+            if position >= 0:
+                if not self.thinking:
+                    visible.append(self.buffer[:position])
+                self.buffer = self.buffer[position + len(tag) :]
+                self.thinking = not self.thinking
+                continue
+            held = self._partial_tag_length(tag)
+            if not self.thinking:
+                visible.append(self.buffer[: len(self.buffer) - held])
+            self.buffer = self.buffer[len(self.buffer) - held :]
+            break
+        return self._strip_leading("".join(visible))
+
+    def flush(self):
+        """
+        Return whatever visible text is still held back at the end of the stream.
+        """
+        rest = "" if self.thinking else self.buffer
+        self.buffer = ""
+        return self._strip_leading(rest)
+
+    def _partial_tag_length(self, tag):
+        for length in range(min(len(tag) - 1, len(self.buffer)), 0, -1):
+            if tag.startswith(self.buffer[-length:]):
+                return length
+        return 0
+
+    def _strip_leading(self, text):
+        # the answer usually follows the reasoning after a blank line
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        return text
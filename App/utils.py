@@ -7,6 +7,11 @@ from nltk.corpus import wordnet
 from logger_config import setup_logger
 import psycopg2
 import os
+import hashlib
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from multiprocessing import Pool
+from time import perf_counter
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,16 +21,83 @@ logger = setup_logger("utils")
 lemmatizer = WordNetLemmatizer()
 stop_words = set(stopwords.words('english'))
 
+# "pos" tags every token and lemmatizes with its part of speech, "light"
+# skips the tagger and lemmatizes every token as a noun. BM25 indexes record
+# the mode they were built with and queries follow it.
+PREPROCESS_MODE = os.getenv("PREPROCESS_MODE", "pos")
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(os.cpu_count() or 1)))
+# Texts per work unit sent to a preprocessing process
+PREPROCESS_CHUNKSIZE = int(os.getenv("PREPROCESS_CHUNKSIZE", "64"))
+LEMMA_CACHE_SIZE = int(os.getenv("LEMMA_CACHE_SIZE", "200000"))
 
-def get_db_connection():
+
+def db_params():
     PG_PASSWORD = os.getenv("PG_PASSWORD")
     PG_HOST = os.getenv("PG_HOST")
     PG_USER = os.getenv("PG_USER")
     PG_DB = os.getenv("PG_DB")
-    return psycopg2.connect(
+    return dict(
         host=PG_HOST, dbname=PG_DB, user=PG_USER, password=PG_PASSWORD, port="5432"
     )
 
+def get_db_connection():
+    return psycopg2.connect(**db_params())
+
+@contextmanager
+def timed(timings, stage):
+    """
+    Record the duration of the block in timings[stage], if timings is a dict.
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = perf_counter() - start
+
+# Offsets only hold for the chapter text they were computed from: between
+# the scraper rewriting a chapter (new content_hash) and its re-chunking, its
+# offset chunks are stale. Chapters without either hash predate hashing and
+# are trusted.
+CHUNK_OFFSETS_CURRENT_SQL = (
+    "(chapters.chunked_hash IS NULL OR chapters.content_hash IS NULL "
+    "OR chapters.chunked_hash = chapters.content_hash)"
+)
+
+# Text of a chunk, for queries joining chunks with chapters. Chunks are
+# stored as character offsets into their chapter; chunks chunked before that
+# still carry their own chunk_content. Stale offset chunks read as NULL
+# rather than as text cut at the wrong places.
+CHUNK_TEXT_SQL = (
+    "COALESCE(chunks.chunk_content, CASE WHEN "
+    + CHUNK_OFFSETS_CURRENT_SQL
+    + " THEN substr(chapters.chapter_content, "
+    "chunks.start_char + 1, chunks.end_char - chunks.start_char) END)"
+)
+
+# Filter for chunks whose text can be read, see CHUNK_TEXT_SQL
+CHUNK_IS_CURRENT_SQL = (
+    "(chunks.chunk_content IS NOT NULL OR " + CHUNK_OFFSETS_CURRENT_SQL + ")"
+)
+
+# content_hash of chapters.chapter_content computed in SQL, for chapters
+# scraped before chapters.content_hash was stored
+CHAPTER_HASH_SQL = "encode(sha256(convert_to(chapters.chapter_content, 'UTF8')), 'hex')"
+
+def collection_name_from_title(novel_title):
+    """
+    Generate a collection name based on the novel title.
+    """
+    # Remove spaces and special characters from the novel title
+    collection_name = "".join(e.lower() for e in novel_title if e.isalnum())
+    return collection_name
+
+def content_hash(text):
+    """
+    Stable hash of a text, used to tell whether stored content changed.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
 def get_wordnet_pos(treebank_tag):
     if treebank_tag.startswith('J'):
         return wordnet.ADJ
@@ -38,26 +110,47 @@ def get_wordnet_pos(treebank_tag):
     else:
         return wordnet.NOUN
 
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatize(word, pos="n"):
+    # a novel reuses a small vocabulary, so most lookups are cache hits;
+    # "n" is wordnet.NOUN, spelled out so importing utils does not load WordNet
+    return lemmatizer.lemmatize(word, pos)
+
 def lemmatize_with_pos(tokens):
     tagged = pos_tag(tokens)
-    return [lemmatizer.lemmatize(word, get_wordnet_pos(tag)) for word, tag in tagged]
+    return [lemmatize(word, get_wordnet_pos(tag)) for word, tag in tagged]
 
-def preprocess(text, do_lemmatize=True):
+def preprocess(text, do_lemmatize=True, mode=PREPROCESS_MODE):
     logger.debug("Starting preprocessing of text.")
     # Lowercase
     text = text.lower()
     # Remove non-alphabetical characters (optional)
     text = re.sub(r'[^a-z\s]', '', text)
-    # Tokenize
-    tokens = word_tokenize(text)
+    # Tokenize; only letters and whitespace are left, so light mode just splits
+    tokens = text.split() if mode == "light" else word_tokenize(text)
     # Remove stopwords
     tokens = [w for w in tokens if w not in stop_words]
     # Lemmatize or stem
     if do_lemmatize:
-        tokens = lemmatize_with_pos(tokens)
+        if mode == "light":
+            tokens = [lemmatize(w) for w in tokens]
+        else:
+            tokens = lemmatize_with_pos(tokens)
     logger.debug("Finished preprocessing of text.")
     return tokens
 
+def preprocess_many(texts, mode=PREPROCESS_MODE, workers=PREPROCESS_WORKERS, chunksize=PREPROCESS_CHUNKSIZE):
+    """
+    preprocess every text, in order, spread over worker processes in work
+    units of chunksize texts. Each process keeps its own lemma cache.
+    """
+    texts = list(texts)
+    func = partial(preprocess, mode=mode)
+    if workers <= 1 or len(texts) <= chunksize:
+        return [func(text) for text in texts]
+    with Pool(min(workers, -(-len(texts) // chunksize))) as pool:
+        return pool.map(func, texts, chunksize=chunksize)
+
 def get_novel_id(novel_title, cursor):
     """
     Fetch the novel ID from the database using the novel title.
@@ -0,0 +1,293 @@
+import json
+import os
+import numpy as np
+from bm25_index import top_k_indices
+from index_versions import LiveIndexes, read_current_version, write_new_version
+from logger_config import setup_logger
+
+logger = setup_logger("vector_index")
+
+INDEX_ROOT = "./vector_index"
+
+# Dense retrieval backend of the retriever: "chroma", or "local" for this index
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+
+# float16, or int8 with one scale per row (4x smaller than float32)
+VECTOR_PRECISION = os.getenv("VECTOR_PRECISION", "float16")
+# Rows multiplied per block by the exact search (a float32 copy of a block
+# should stay cache and memory friendly)
+BLOCK_ROWS = int(os.getenv("VECTOR_BLOCK_ROWS", "8192"))
+# Prefixes of more rows than this are searched through the IVF lists
+IVF_MIN_ROWS = int(os.getenv("VECTOR_IVF_MIN_ROWS", "200000"))
+IVF_NPROBE = int(os.getenv("VECTOR_IVF_NPROBE", "16"))
+IVF_TRAIN_SAMPLE = 65_536
+IVF_ITERATIONS = 10
+
+# ----------------------------------------
+# ON-DISK LAYOUT
+# ----------------------------------------
+#
+# vector_index/<collection_name>/
+#     CURRENT                -> name of the live version directory
+#     v<n>/meta.json         -> num_docs, dimension, precision, model_name, nlist
+#     v<n>/vectors.npy       -> normalized embeddings (float16 or int8)
+#     v<n>/scales.npy        -> row x scale is the float32 embedding (float32)
+#     v<n>/doc_ids.npy       -> chunk id of every row (int64)
+#     v<n>/doc_chapters.npy  -> chapter number of every row (int32)
+#     v<n>/centroids.npy     -> IVF centroids, normalized (float32, nlist x dim)
+#     v<n>/list_offsets.npy  -> IVF list boundaries in list_rows (int64)
+#     v<n>/list_rows.npy     -> rows of every IVF list, ascending per list (int32)
+#
+# Rows are sorted by (chapter_number, chunk id), like the BM25 index, so
+# "chapters <= N" is a prefix [0, P) of the rows and a prefix of every IVF
+# list. A spoiler-restricted query is then an exact search of the first P
+# rows (a blocked matrix-vector product) or, for large P, a search of the
+# rows below P in the nprobe lists closest to the query; no filtering of
+# results after the fact is needed in either case.
+#
+# The IVF lists are only built for indexes of more than IVF_MIN_ROWS rows.
+# Updates write a new version directory and swap CURRENT (see index_versions.py).
+
+
+def index_path(collection_name):
+    return os.path.join(INDEX_ROOT, collection_name)
+
+
+def quantize(embeddings, precision=VECTOR_PRECISION):
+    """
+    Return (vectors, scales). int8 rows are scaled so that their largest
+    component is 127: a fixed scale would leave the small components of
+    high-dimensional unit vectors only a few levels.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if precision == "int8":
+        scales = np.abs(embeddings).max(axis=1, initial=0.0) / 127
+        scales[scales == 0] = 1.0
+        vectors = np.round(embeddings / scales[:, None]).astype(np.int8)
+        return vectors, scales.astype(np.float32)
+    return embeddings.astype(np.float16), np.ones(len(embeddings), dtype=np.float32)
+
+
+def dequantize(vectors, scales):
+    return vectors.astype(np.float32) * np.asarray(scales)[:, None]
+
+
+def assign_lists(embeddings, centroids):
+    """
+    Closest centroid of every row, computed block by block.
+    """
+    assignments = np.empty(len(embeddings), dtype=np.int32)
+    for start in range(0, len(embeddings), BLOCK_ROWS):
+        block = embeddings[start : start + BLOCK_ROWS]
+        assignments[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(embeddings, nlist, iterations=IVF_ITERATIONS, seed=0):
+    """
+    Spherical k-means on a sample of the rows.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(embeddings), max(IVF_TRAIN_SAMPLE, 32 * nlist))
+    sample = embeddings[np.sort(rng.choice(len(embeddings), sample_size, replace=False))]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # an empty list keeps its previous centroid
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+    return centroids.astype(np.float32)
+
+
+class VectorIndex:
+    """
+    Memory-mapped matrix of the normalized chunk embeddings of one novel.
+    """
+
+    ARRAYS = (
+        "vectors",
+        "scales",
+        "doc_ids",
+        "doc_chapters",
+        "centroids",
+        "list_offsets",
+        "list_rows",
+    )
+
+    def __init__(self, path, version, meta, arrays):
+        self.path = path
+        self.version = version
+        self.num_docs = meta["num_docs"]
+        self.dimension = meta["dimension"]
+        self.precision = meta["precision"]
+        self.model_name = meta["model_name"]
+        self.nlist = meta["nlist"]
+        self.vectors = arrays["vectors"]
+        self.scales = arrays["scales"]
+        self.doc_ids = arrays["doc_ids"]
+        self.doc_chapters = arrays["doc_chapters"]
+        self.centroids = arrays["centroids"]
+        self.list_offsets = arrays["list_offsets"]
+        self.list_rows = arrays["list_rows"]
+
+    @classmethod
+    def load(cls, path):
+        """
+        Open the live version of the index at path, or return None if the
+        index has not been built yet.
+        """
+        version = read_current_version(path)
+        if version is None:
+            return None
+        version_dir = os.path.join(path, version)
+        with open(os.path.join(version_dir, "meta.json")) as f:
+            meta = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(version_dir, f"{name}.npy"), mmap_mode="r")
+            for name in cls.ARRAYS
+        }
+        logger.info(
+            "Loaded vector index %s (%s docs, %s, %s IVF lists)",
+            version_dir,
+            meta["num_docs"],
+            meta["precision"],
+            meta["nlist"],
+        )
+        return cls(path, version, meta, arrays)
+
+    def prefix_size(self, spoiler_threshold=None):
+        """
+        Number of rows in chapters up to spoiler_threshold.
+        """
+        if not spoiler_threshold:
+            return self.num_docs
+        return int(np.searchsorted(self.doc_chapters, spoiler_threshold, side="right"))
+
+    def scores(self, rows, query_vector):
+        """
+        Cosine similarity of the query with the given rows (a slice or an
+        array of row numbers).
+        """
+        scores = self.vectors[rows].astype(np.float32) @ query_vector
+        return scores * self.scales[rows] if self.precision == "int8" else scores
+
+    def exact_search(self, query_vector, prefix, k):
+        """
+        Top k rows among the first prefix rows, one block at a time.
+        """
+        best_rows = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+        for start in range(0, prefix, BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, prefix)
+            block_scores = self.scores(slice(start, stop), query_vector)
+            top = top_k_indices(block_scores, k)
+            best_rows = np.concatenate([best_rows, top + start])
+            best_scores = np.concatenate([best_scores, block_scores[top]])
+        top = top_k_indices(best_scores, k)
+        return best_rows[top], best_scores[top]
+
+    def ivf_search(self, query_vector, prefix, k, nprobe=IVF_NPROBE):
+        """
+        Top k rows among the first prefix rows of the nprobe lists whose
+        centroids are closest to the query.
+        """
+        probes = top_k_indices(self.centroids @ query_vector, nprobe)
+        candidates = []
+        for list_id in probes:
+            rows = self.list_rows[self.list_offsets[list_id] : self.list_offsets[list_id + 1]]
+            candidates.append(rows[: np.searchsorted(rows, prefix)])
+        # ascending rows read the memory map front to back
+        candidates = np.sort(np.concatenate(candidates))
+        if len(candidates) < k:
+            return self.exact_search(query_vector, prefix, k)
+        candidate_scores = self.scores(candidates, query_vector)
+        top = top_k_indices(candidate_scores, k)
+        return candidates[top].astype(np.int64), candidate_scores[top]
+
+    def search(self, query_vector, k=5, spoiler_threshold=None, exact=None):
+        """
+        Return the top k (chunk_id, cosine similarity) pairs in chapters up
+        to spoiler_threshold. exact=None searches exactly unless the prefix
+        is larger than IVF_MIN_ROWS and IVF lists exist.
+        """
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        prefix = self.prefix_size(spoiler_threshold)
+        if prefix == 0:
+            return []
+        if exact is None:
+            exact = self.nlist == 0 or prefix <= IVF_MIN_ROWS
+        if exact:
+            rows, scores = self.exact_search(query_vector, prefix, k)
+        else:
+            rows, scores = self.ivf_search(query_vector, prefix, k)
+        return [(int(self.doc_ids[row]), float(score)) for row, score in zip(rows, scores)]
+
+    def embeddings(self, rows):
+        """
+        float32 embeddings of the given rows, to carry them over to a new
+        version.
+        """
+        return dequantize(self.vectors[rows], self.scales[rows])
+
+
+def write_index(
+    path, doc_ids, doc_chapters, embeddings, model_name, precision=VECTOR_PRECISION
+):
+    """
+    Sort the normalized embeddings by (chapter, chunk id), quantize them,
+    build IVF lists when there are more than IVF_MIN_ROWS rows, and swap
+    the result in as the new live version.
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    doc_chapters = np.asarray(doc_chapters, dtype=np.int32)
+    order = np.lexsort((doc_ids, doc_chapters))
+    embeddings = np.asarray(embeddings, dtype=np.float32)[order]
+    vectors, scales = quantize(embeddings, precision)
+    dimension = vectors.shape[1] if vectors.ndim == 2 else 0
+
+    nlist = int(4 * np.sqrt(len(vectors))) if len(vectors) > IVF_MIN_ROWS else 0
+    if nlist:
+        logger.info("Training %s IVF lists over %s rows", nlist, len(vectors))
+        # lists are built from the stored vectors, as they will be searched
+        stored = dequantize(vectors, scales)
+        centroids = train_centroids(stored, nlist)
+        assignments = assign_lists(stored, centroids)
+        list_rows = np.argsort(assignments, kind="stable").astype(np.int32)
+        list_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(assignments, minlength=nlist))]
+        ).astype(np.int64)
+    else:
+        centroids = np.zeros((0, dimension), dtype=np.float32)
+        list_rows = np.zeros(0, dtype=np.int32)
+        list_offsets = np.zeros(1, dtype=np.int64)
+
+    meta = {
+        "num_docs": len(vectors),
+        "dimension": dimension,
+        "precision": precision,
+        "model_name": model_name,
+        "nlist": nlist,
+    }
+    arrays = {
+        "vectors": vectors,
+        "scales": scales,
+        "doc_ids": doc_ids[order],
+        "doc_chapters": doc_chapters[order],
+        "centroids": centroids,
+        "list_offsets": list_offsets,
+        "list_rows": list_rows,
+    }
+    return write_new_version(path, {"meta": meta}, arrays)
+
+
+_live_indexes = LiveIndexes(VectorIndex.load, index_path)
+
+
+def get_index(collection_name):
+    """
+    Return the live index for a collection, reopening it only when an
+    update has swapped in a new version.
+    """
+    return _live_indexes.get(collection_name)
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# App modules import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "App"))
+
+# App loggers write to ./logs/app.log; keep test runs out of the real log
+os.chdir(tempfile.mkdtemp())
+os.makedirs("logs")
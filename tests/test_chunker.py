@@ -0,0 +1,132 @@
+import numpy as np
+
+from chunker import chunk_offsets, chunk_spans, chunk_text, locate_chunks, segment_text
+
+
+class WordTokenizer:
+    """
+    A slow (offset-less) tokenizer counting whitespace-separated words.
+    """
+
+    def __call__(self, texts, **kwargs):
+        return {"input_ids": [text.split() for text in texts]}
+
+
+def legacy_chunk_paragraphs(paragraphs, max_chunk_size, overlap):
+    """
+    The chunk_text loop before chunk_spans, over (paragraph, size) pairs.
+    """
+    chunks = []
+    current_chunk = []
+    current_chunk_size = 0
+    k = 0
+    finished = False
+    for i, (paragraph, size) in enumerate(paragraphs):
+        if i != k:
+            continue
+        if not current_chunk:
+            current_chunk.append(paragraph)
+            current_chunk_size += size
+            j = i - 1
+            while current_chunk_size <= size + overlap:
+                if j >= 0:
+                    if current_chunk_size <= max_chunk_size - paragraphs[j][1]:
+                        current_chunk.insert(0, paragraphs[j][0])
+                        current_chunk_size += paragraphs[j][1]
+                        j -= 1
+                    else:
+                        break
+                else:
+                    break
+            while current_chunk_size <= max_chunk_size:
+                k += 1
+                if (
+                    k < len(paragraphs)
+                    and current_chunk_size + paragraphs[k][1] <= max_chunk_size
+                ):
+                    current_chunk.append(paragraphs[k][0])
+                    current_chunk_size += paragraphs[k][1]
+                elif k >= len(paragraphs):
+                    finished = True
+                    chunks.append(" ".join(current_chunk))
+                    break
+                elif current_chunk_size + paragraphs[k][1] > max_chunk_size:
+                    chunks.append(" ".join(current_chunk))
+                    break
+            current_chunk = []
+            current_chunk_size = 0
+        if finished:
+            break
+    return chunks
+
+
+def random_chapter(rng, num_paragraphs, max_words):
+    """
+    Paragraphs of random word counts, with stray indentation and blank lines.
+    """
+    lines = []
+    for i in range(num_paragraphs):
+        words = " ".join(f"w{i}_{j}" for j in range(rng.integers(1, max_words + 1)))
+        lines.append(" " * int(rng.integers(0, 3)) + words)
+        if rng.random() < 0.2:
+            lines.append("  ")
+    return "\n".join(lines)
+
+
+def test_chunk_spans_matches_the_legacy_loop():
+    # only paragraphs up to max_chunk_size: the legacy loop silently dropped
+    # the rest of the chapter after a larger one
+    rng = np.random.default_rng(0)
+    for _ in range(5_000):
+        max_chunk_size = int(rng.integers(1, 600))
+        overlap = int(rng.integers(0, max_chunk_size + 50))
+        high = int(rng.choice([2, 10, max_chunk_size // 2 + 1, max_chunk_size])) + 1
+        sizes = rng.integers(0, min(high, max_chunk_size + 1), rng.integers(0, 60))
+        paragraphs = [(f"p{i}", int(size)) for i, size in enumerate(sizes)]
+
+        expected = legacy_chunk_paragraphs(paragraphs, max_chunk_size, overlap)
+        spans = chunk_spans(sizes.tolist(), max_chunk_size, overlap)
+        got = [" ".join(p for p, _ in paragraphs[start:end]) for start, end in spans]
+        assert got == expected, (sizes.tolist(), max_chunk_size, overlap)
+
+
+def test_oversized_paragraph_is_a_chunk_of_its_own():
+    assert chunk_spans([10, 100, 10], max_chunk_size=50, overlap=20) == [
+        (0, 1),
+        (1, 2),
+        (2, 3),
+    ]
+
+
+def test_chunk_text_is_the_text_at_chunk_offsets():
+    rng = np.random.default_rng(1)
+    tokenizer = WordTokenizer()
+    for _ in range(50):
+        text = random_chapter(rng, int(rng.integers(1, 40)), max_words=12)
+        offsets = chunk_offsets(text, 40, 15, tokenizer)
+        chunks = chunk_text(text, 40, 15, tokenizer)
+
+        assert chunks == [text[start:end] for start, end in offsets]
+        # same paragraphs as the legacy chunks, only the joins differ
+        legacy = legacy_chunk_paragraphs(segment_text(text, 40, 15, tokenizer), 40, 15)
+        assert [" ".join(chunk.split()) for chunk in chunks] == legacy
+
+
+def test_locate_chunks_finds_legacy_chunks():
+    rng = np.random.default_rng(2)
+    tokenizer = WordTokenizer()
+    text = random_chapter(rng, 60, max_words=12)
+    legacy = legacy_chunk_paragraphs(segment_text(text, 40, 15, tokenizer), 40, 15)
+
+    spans = locate_chunks(text, legacy)
+
+    assert spans == chunk_offsets(text, 40, 15, tokenizer)
+    assert [" ".join(text[start:end].split()) for start, end in spans] == legacy
+
+
+def test_locate_chunks_marks_missing_chunks():
+    text = "One two.\n  Three four.\nFive six."
+    chunks = ["One two.", "not there", None, "Three four. Five six."]
+    assert locate_chunks(text, chunks) == [(0, 8), None, None, (11, 32)]
+    # chunks are searched in order: an earlier text after a later one is missing
+    assert locate_chunks(text, ["Five six.", "One two."]) == [(23, 32), None]
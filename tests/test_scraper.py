@@ -0,0 +1,206 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import scraper
+
+CHALLENGE_PAGE = "<html><title>Just a moment...</title>security by Cloudflare</html>"
+
+
+def chapter_page(url):
+    return f"<html><p>Text of {url}</p></html>"
+
+
+class FakeStore:
+    """
+    chapters and chapter_fetch_state kept in memory, written through
+    scraper.write_batch the way the database is.
+    """
+
+    def __init__(self, urls):
+        self.status = {url: "pending" for url in urls}
+        self.chapters = {}
+
+    def write_batch(self, cursor, conn, inserts, updates, states, validators):
+        for _, _, _, url, content, _ in inserts:
+            self.chapters[url] = content
+        for url, status, _, _ in states:
+            self.status[url] = status
+
+    def pending_jobs(self):
+        return [
+            (url, f"Chapter {url[2:]}", False, None, None, None)
+            for url, status in self.status.items()
+            if status == "pending"
+        ]
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """
+    Run a coroutine against a local stub site. Routes map a path to a list
+    of (status, body, headers) responses served in turn, the last repeating;
+    every request is logged in requests.
+    """
+    routes, requests = {}, []
+
+    async def handle(request):
+        requests.append(request.path)
+        responses = routes[request.path]
+        status, body, headers = responses.pop(0) if len(responses) > 1 else responses[0]
+        if callable(body):
+            body = await body()
+        return web.Response(status=status, text=body, headers=headers)
+
+    async def run(test):
+        app = web.Application()
+        app.router.add_get("/{path:.*}", handle)
+        server = TestServer(app)
+        await server.start_server()
+        monkeypatch.setattr(scraper, "BASE_URL", str(server.make_url("")).rstrip("/"))
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await test(session)
+        finally:
+            await server.close()
+
+    monkeypatch.setattr(scraper, "BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(scraper, "MAX_RETRIES", 3)
+    monkeypatch.setattr(scraper, "FETCH_WORKERS", 1)
+    monkeypatch.setattr(scraper, "PARSE_PROCESSES", 1)
+    monkeypatch.setattr(scraper, "WRITE_BATCH_SIZE", 1)
+    delays = []
+    backoff_delay = scraper.backoff_delay
+
+    def recorded_backoff(attempt, retry_after=None):
+        delays.append(backoff_delay(attempt, retry_after))
+        return delays[-1]
+
+    monkeypatch.setattr(scraper, "backoff_delay", recorded_backoff)
+    return run, routes, requests, delays
+
+
+@pytest.mark.parametrize("status", [500, 503, 429])
+def test_transient_errors_are_retried_with_backoff(stub, status):
+    run, routes, requests, delays = stub
+    routes["/c1"] = [(status, "busy", {}), (status, "busy", {}), (200, "ok", {})]
+
+    page = asyncio.run(
+        run(lambda session: scraper.fetch_with_retry(session, f"{scraper.BASE_URL}/c1"))
+    )
+
+    assert page.html == "ok"
+    assert page.attempts == 3
+    assert requests == ["/c1"] * 3
+    assert len(delays) == 2
+
+
+def test_retry_after_is_honoured(stub):
+    run, routes, requests, delays = stub
+    routes["/c1"] = [(429, "slow down", {"Retry-After": "0"}), (200, "ok", {})]
+
+    asyncio.run(
+        run(lambda session: scraper.fetch_with_retry(session, f"{scraper.BASE_URL}/c1"))
+    )
+
+    assert delays == [0]
+
+
+def test_not_found_is_not_retried(stub):
+    run, routes, requests, delays = stub
+    routes["/c1"] = [(404, "missing", {})]
+
+    with pytest.raises(scraper.FetchError) as error:
+        asyncio.run(
+            run(
+                lambda session: scraper.fetch_with_retry(
+                    session, f"{scraper.BASE_URL}/c1"
+                )
+            )
+        )
+
+    assert error.value.attempts == 1
+    assert requests == ["/c1"]
+    assert delays == []
+
+
+def test_challenge_page_is_never_written(stub, monkeypatch):
+    run, routes, requests, _ = stub
+    routes["/c1"] = [(200, chapter_page("/c1"), {})]
+    routes["/c2"] = [(200, CHALLENGE_PAGE, {})]
+    store = FakeStore(["/c1", "/c2"])
+    monkeypatch.setattr(scraper, "write_batch", store.write_batch)
+
+    asyncio.run(
+        run(
+            lambda session: scraper.scrape_chapters(
+                session, store.pending_jobs(), 1, None, None
+            )
+        )
+    )
+
+    assert store.chapters == {"/c1": "Text of /c1"}
+    assert store.status == {"/c1": "done", "/c2": "failed"}
+    assert requests.count("/c2") == scraper.MAX_RETRIES
+
+
+def test_interrupted_run_resumes_from_pending_chapters(stub, monkeypatch):
+    run, routes, requests, _ = stub
+    urls = ["/c1", "/c2", "/c3", "/c4"]
+    store = FakeStore(urls)
+    monkeypatch.setattr(scraper, "write_batch", store.write_batch)
+    stalled = asyncio.Event()
+
+    async def stall():
+        stalled.set()
+        await asyncio.sleep(3600)
+
+    for url in urls:
+        routes[url] = [(200, chapter_page(url), {})]
+    routes["/c3"] = [(200, stall, {}), (200, chapter_page("/c3"), {})]
+
+    async def interrupted(session):
+        scrape = asyncio.create_task(
+            scraper.scrape_chapters(session, store.pending_jobs(), 1, None, None)
+        )
+        await stalled.wait()
+        while store.status["/c2"] != "done":
+            await asyncio.sleep(0.01)
+        scrape.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await scrape
+
+    asyncio.run(run(interrupted))
+    assert store.status == {
+        "/c1": "done",
+        "/c2": "done",
+        "/c3": "pending",
+        "/c4": "pending",
+    }
+
+    requests.clear()
+    asyncio.run(
+        run(
+            lambda session: scraper.scrape_chapters(
+                session, store.pending_jobs(), 1, None, None
+            )
+        )
+    )
+
+    assert requests == ["/c3", "/c4"]
+    assert set(store.status.values()) == {"done"}
+    assert store.chapters == {url: f"Text of {url}" for url in urls}
+
+
+def test_token_bucket_paces_requests_beyond_the_burst():
+    async def acquire_all():
+        bucket = scraper.TokenBucket(rate=100, capacity=2)
+        start = asyncio.get_running_loop().time()
+        for _ in range(4):
+            await bucket.acquire()
+        return asyncio.get_running_loop().time() - start
+
+    assert asyncio.run(acquire_all()) >= 0.015
@@ -0,0 +1,52 @@
+from think_stripper import ThinkStripper
+
+
+def strip(pieces, thinking=False):
+    stripper = ThinkStripper(thinking=thinking)
+    return "".join(stripper.feed(piece) for piece in pieces) + stripper.flush()
+
+
+def test_think_block_is_removed():
+    assert strip(["<think>reasoning</think>\n\nAnswer"]) == "Answer"
+
+
+def test_think_block_after_leading_whitespace_is_removed():
+    assert strip(["\n", " <th", "ink>reasoning</think>Answer"]) == "Answer"
+
+
+def test_close_tag_only_hides_reasoning():
+    assert strip(["reasoning here</think>Answer"], thinking=True) == "Answer"
+
+
+def test_close_tag_only_split_across_chunks():
+    pieces = ["reason", "ing </th", "ink>", "\nAns", "wer"]
+    assert strip(pieces, thinking=True) == "Answer"
+
+
+def test_bare_close_tag_at_the_start_is_dropped():
+    assert strip(["</think>", "\n\nAnswer"]) == "Answer"
+
+
+def test_open_tag_split_across_chunks():
+    assert strip(["Intro <th", "ink>hidden</thi", "nk> Answer"]) == "Intro  Answer"
+
+
+def test_text_without_tags_streams_as_it_arrives():
+    stripper = ThinkStripper()
+    assert stripper.feed("  ") == ""
+    assert stripper.feed("Just an ") == "Just an "
+    assert stripper.feed("answer") == "answer"
+    assert stripper.flush() == ""
+
+
+def test_possible_tag_is_held_until_decided():
+    stripper = ThinkStripper()
+    assert stripper.feed("<") == ""
+    assert stripper.feed("b>bold") == "<b>bold"
+
+
+def test_streams_after_the_close_tag():
+    stripper = ThinkStripper(thinking=True)
+    assert stripper.feed("thoughts</think>First") == "First"
+    assert stripper.feed(" second") == " second"
+    assert stripper.flush() == ""